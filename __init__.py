@@ -21,6 +21,16 @@
 #                                                                            #
 ##############################################################################
 
+import nfse
 import account_invoice
 import res_company
+import reference_data
+import rps_snapshot
 import wizard
+import nfse_queue
+import nfse_lot
+import nfse_transmission
+import nfse_timing
+import nfse_archive
+import nfse_scheduler
+import nfse_cache
@@ -23,7 +23,7 @@
 
 {
     "name": "NFS-e",
-    "version": "0.1",
+    "version": "0.2",
     "author": "PROGE",
     "category": "Localization",
     "website": "http://proge.com.br",
@@ -36,9 +36,23 @@
         ],
     'init_xml': [],
     'update_xml': [
+        'security/ir.model.access.csv',
+        'nfse_queue_view.xml',
+        'nfse_queue_data.xml',
+        'nfse_lot_view.xml',
+        'nfse_lot_data.xml',
+        'nfse_transmission_view.xml',
+        'nfse_timing_view.xml',
+        'nfse_timing_data.xml',
+        'nfse_archive_view.xml',
+        'nfse_scheduler_view.xml',
+        'nfse_cache_view.xml',
         'account_invoice_view.xml',
         'res_company_view.xml',
         'wizard/manage_nfse_view.xml',
+        'wizard/reconcile_nfse_view.xml',
+        'wizard/reconcile_nfse_data.xml',
+        'wizard/export_nfse_archive_view.xml',
         ],
     'demo_xml': [],
     'test': [],
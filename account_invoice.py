@@ -22,12 +22,26 @@
 ##############################################################################
 
 from osv import fields, osv
+from nfse_queue import QUEUE_STATES
+from wizard.manage_nfse import NFSE_STATES
+from nfse.prefetch import INVOICE_FIELDS, prefetch_send_data
+from nfse.rps import SNAPSHOT_FIELDS, UNSENT_INVOICES, discard_snapshots, \
+    input_hash, snapshot_rps
+from nfse.validation import validate_invoice
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Invoice fields an RPS is built from, besides the related records
+RPS_FIELDS = set(INVOICE_FIELDS + ['invoice_line', 'tax_line']) - \
+    set(SNAPSHOT_FIELDS)
 
 
 class account_invoice(osv.osv):
     _inherit = 'account.invoice'
     _columns = {
-        'nfse_status': fields.char(u'Status da NFS-e', size=44, readonly=True),
+        'nfse_status': fields.selection(NFSE_STATES, u'Status da NFS-e',
+                                        size=16, readonly=True),
         'nfse_retorno': fields.char(
             u'Retorno da NFS-e', size=256, readonly=True
             ),
@@ -35,7 +49,121 @@ class account_invoice(osv.osv):
         'nfse_codigo_verificacao': fields.char(
             u'Código de Verificação', size=128, readonly=True
             ),
+        'nfse_queue_state': fields.selection(
+            QUEUE_STATES, u'Fila de Transmissão', readonly=True
+            ),
+        'nfse_rps': fields.text(u'RPS', readonly=True),
+        'nfse_rps_hash': fields.char(u'Hash do RPS', size=40, readonly=True),
+        'nfse_archive_ids': fields.many2many(
+            'l10n_br_nfse.archive', 'l10n_br_nfse_archive_invoice_rel',
+            'invoice_id', 'archive_id', u'XML da NFS-e', readonly=True
+            ),
         }
 
+    def _auto_init(self, cr, context=None):
+        super(account_invoice, self)._auto_init(cr, context)
+        # Unsent service invoices, a small part of the table, as scanned by
+        # discard_snapshots when a company or reference record changes
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                   ('account_invoice_nfse_unsent_idx',))
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX account_invoice_nfse_unsent_idx
+                ON account_invoice (company_id)
+                WHERE """ + UNSENT_INVOICES)
+
+    def _store_nfse_rps(self, cr, uid, ids, context=None):
+        """Compute and store the RPS of the service invoices in ``ids``
+
+        Only invoices of companies issuing NFS-e, i.e. with a certificate,
+        are considered. Confirmation never fails here: an invoice whose RPS
+        cannot be built gets the problems in nfse_retorno and no stored
+        RPS, and sending reports them again. A stored RPS whose hash still
+        matches its data, e.g. when an invoice is confirmed again unchanged,
+        is kept as is.
+        """
+        service_ids = self.search(cr, uid, [('id', 'in', ids),
+                                            ('fiscal_type', '=', 'service')],
+                                  context=context)
+        if not service_ids:
+            return
+
+        company_ids = list(set(
+            inv['company_id'][0] for inv in
+            self.read(cr, uid, service_ids, ['company_id'], context)
+            ))
+        # bin_size: only whether there is a certificate matters here
+        issuing = set(
+            company['id'] for company in self.pool.get('res.company').read(
+                cr, uid, company_ids, ['nfse_cert_file'],
+                dict(context or {}, bin_size=True))
+            if company['nfse_cert_file']
+            )
+        if not issuing:
+            return
+
+        prefetched = prefetch_send_data(self.pool, cr, uid, service_ids,
+                                        context=context)
+        for inv in prefetched['invoices'].values():
+            if inv['company']['id'] not in issuing:
+                continue
+            if inv['nfse_rps'] and inv['nfse_rps_hash'] == input_hash(inv):
+                continue
+
+            problems = validate_invoice(inv)
+            if problems:
+                _logger.info('RPS of invoice %s not stored: %s', inv['id'],
+                             ' '.join(problems))
+                self.write(cr, uid, inv['id'],
+                           {'nfse_retorno': u'\n'.join(problems)[:256]},
+                           context=context)
+                continue
+
+            rps, rps_hash = snapshot_rps(inv)
+            self.write(cr, uid, inv['id'], {'nfse_rps': rps,
+                                            'nfse_rps_hash': rps_hash},
+                       context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(account_invoice, self).write(cr, uid, ids, vals, context)
+        if ids and RPS_FIELDS.intersection(vals):
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            discard_snapshots(cr, 'id IN %s', (tuple(ids),))
+        return res
+
+    def action_number(self, cr, uid, ids, context=None):
+        res = super(account_invoice, self).action_number(cr, uid, ids,
+                                                         context)
+        self._store_nfse_rps(cr, uid, ids, context)
+
+        pending_ids = self.search(cr, uid, [('id', 'in', ids),
+                                            ('fiscal_type', '=', 'service'),
+                                            ('nfse_status', '=', False)],
+                                  context=context)
+        if pending_ids:
+            self.write(cr, uid, pending_ids, {'nfse_status': 'pending'},
+                       context=context)
+            self._enqueue_auto_send(cr, uid, pending_ids, context)
+
+        return res
+
+    def _enqueue_auto_send(self, cr, uid, ids, context=None):
+        """Queue the invoices of companies emitting NFS-e on validation;
+        the micro-batcher of l10n_br_nfse.queue sends them"""
+        auto_ids = self.search(cr, uid, [
+            ('id', 'in', ids), ('company_id.nfse_auto_send', '=', True),
+            ], context=context)
+        if auto_ids:
+            self.pool.get('l10n_br_nfse.queue').enqueue(cr, uid, auto_ids,
+                                                        context)
+
+    def copy(self, cr, uid, id, default=None, context=None):
+        default = dict(default or {}, nfse_rps=False, nfse_rps_hash=False,
+                       nfse_queue_state=False, nfse_status=False,
+                       nfse_archive_ids=[])
+        return super(account_invoice, self).copy(cr, uid, id, default,
+                                                 context)
+
 
 account_invoice()
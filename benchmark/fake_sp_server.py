@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Local stand-in for the São Paulo NFS-e web service
+
+Answers the SOAP operations used by the module (EnvioLoteRPS,
+TesteEnvioLoteRPS, CancelamentoNFe, ConsultaNFe and ConsultaNFeEmitidas)
+from memory, with configurable latency and injected errors, warnings and
+HTTP faults. Signatures are not verified. Run it on its own::
+
+    python benchmark/fake_sp_server.py --port 8443 --latency 0.2 \\
+        --warning-rate 0.05 --divergence-rate 0.01
+
+and point the module at it with ``l10n_br_nfse_server = localhost:8443``.
+Without ``--certfile`` a throwaway self-signed certificate is generated
+with openssl; clients must then skip server certificate verification.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import datetime
+import itertools
+import optparse
+import os
+import random
+import shutil
+import ssl
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+NAMESPACE = 'http://www.prefeitura.sp.gov.br/nfe'
+SOAP_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+# Messages injected by the server
+ERROR = ('1001', u'Erro simulado pelo servidor de testes.')
+WARNING = ('224', u'Alerta simulado pelo servidor de testes.')
+DIVERGENCE = ('208', u'Alíquota informada (%s) difere da alíquota '
+                     u'vigente (5.00) para o código de serviço informado.')
+NOT_FOUND = ('1058', u'NFS-e não encontrada.')
+
+PAGE_SIZE = 50
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _findall(element, name):
+    return [e for e in element.iter() if _local(e.tag) == name]
+
+
+def _find(element, name):
+    for e in element.iter():
+        if _local(e.tag) == name:
+            return e
+    return None
+
+
+def _text(element, name, default=''):
+    # Elements without children are false, compare with None
+    found = None
+    if element is not None:
+        found = _find(element, name)
+    if found is None or found.text is None:
+        return default
+    return found.text.strip()
+
+
+def _tag(name, content=u'', **attrs):
+    """Serialize an element; ``content`` is text or a list of elements"""
+    if isinstance(content, (list, tuple)):
+        content = u''.join(content)
+    else:
+        content = escape(unicode(content))
+    attributes = u''.join(u' %s="%s"' % item for item in attrs.items())
+    return u'<%s%s>%s</%s>' % (name, attributes, content, name)
+
+
+class FakeService(object):
+    """In-memory behaviour of the São Paulo NFS-e web service.
+
+    Each RPS of a lot is rejected with probability ``error_rate``, gets a
+    warning with probability ``warning_rate`` and a code 208 warning
+    (divergent tax rate) with probability ``divergence_rate``; as at the
+    prefeitura, a single error rejects the whole lot. Each request fails
+    with HTTP 500 with probability ``fault_rate`` and is answered after
+    ``latency`` plus up to ``jitter`` seconds.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 warning_rate=0.0, divergence_rate=0.0, fault_rate=0.0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.warning_rate = warning_rate
+        self.divergence_rate = divergence_rate
+        self.fault_rate = fault_rate
+        self.stats = {}
+        self._random = random.Random(seed)
+        self._numbers = itertools.count(1)
+        self._notes = {}
+        self._by_rps = {}
+        self._lock = threading.Lock()
+
+    def _chance(self, rate):
+        with self._lock:
+            return rate and self._random.random() < rate
+
+    def _count(self, operation):
+        with self._lock:
+            self.stats[operation] = self.stats.get(operation, 0) + 1
+
+    def handle(self, body):
+        """Answer a SOAP request; returns ``(http_status, xml)``"""
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        try:
+            envelope = ElementTree.fromstring(body)
+            request = list(_find(envelope, 'Body'))[0]
+        except Exception:
+            return 400, self._fault(u'Requisição SOAP inválida.')
+
+        operation = _local(request.tag)
+        if operation.endswith('Request'):
+            operation = operation[:-len('Request')]
+        self._count(operation)
+
+        if self._chance(self.fault_rate):
+            return 500, self._fault(u'Falha simulada pelo servidor de testes.')
+
+        method = getattr(self, '_op_' + operation, None)
+        if method is None:
+            return 500, self._fault(u'Operação desconhecida: %s' % operation)
+
+        message = ElementTree.fromstring(
+            _text(request, 'MensagemXML').encode('utf-8')
+            )
+        retorno = u'<?xml version="1.0" encoding="UTF-8"?>' + method(message)
+
+        return 200, (
+            u'<?xml version="1.0" encoding="utf-8"?>'
+            u'<soap:Envelope xmlns:soap="%s"><soap:Body>'
+            u'<%sResponse xmlns="%s"><RetornoXML>%s</RetornoXML>'
+            u'</%sResponse></soap:Body></soap:Envelope>' % (
+                SOAP_NAMESPACE, operation, NAMESPACE, escape(retorno),
+                operation,
+                )
+            ).encode('utf-8')
+
+    def _fault(self, reason):
+        return (
+            u'<?xml version="1.0" encoding="utf-8"?>'
+            u'<soap:Envelope xmlns:soap="%s"><soap:Body><soap:Fault>'
+            u'<faultcode>soap:Server</faultcode><faultstring>%s</faultstring>'
+            u'</soap:Fault></soap:Body></soap:Envelope>' % (
+                SOAP_NAMESPACE, escape(reason)
+                )
+            ).encode('utf-8')
+
+    def _retorno(self, name, success, body=()):
+        return _tag(name, [
+            _tag('Cabecalho', [
+                _tag('Sucesso', success and 'true' or 'false'),
+                ], Versao='1'),
+            ] + list(body), xmlns=NAMESPACE)
+
+    def _chave_rps(self, inscricao, serie, numero):
+        return _tag('ChaveRPS', [
+            _tag('InscricaoPrestador', inscricao),
+            _tag('SerieRPS', serie),
+            _tag('NumeroRPS', numero),
+            ])
+
+    def _chave_nfe(self, note):
+        return _tag('ChaveNFe', [
+            _tag('InscricaoPrestador', note['inscricao']),
+            _tag('NumeroNFe', note['numero']),
+            _tag('CodigoVerificacao', note['codigo']),
+            ])
+
+    def _message(self, name, message, key):
+        code, description = message
+        return _tag(name, [
+            _tag('Codigo', code),
+            _tag('Descricao', description),
+            key,
+            ])
+
+    def _nfe(self, note):
+        return _tag('NFe', [
+            _tag('Assinatura', ''),
+            self._chave_nfe(note),
+            _tag('DataEmissaoNFe', note['emissao']),
+            _tag('DataFatoGeradorNFe', note['data_rps']),
+            _tag('CPFCNPJPrestador', [_tag('CNPJ', note['cnpj'])]),
+            _tag('StatusNFe', note['status']),
+            self._chave_rps(note['inscricao'], note['serie'],
+                            note['numero_rps']),
+            _tag('TipoRPS', 'RPS'),
+            _tag('DataEmissaoRPS', note['data_rps']),
+            _tag('TributacaoNFe', note['tributacao']),
+            _tag('ValorServicos', note['valor']),
+            _tag('CodigoServico', note['codigo_servico']),
+            _tag('AliquotaServicos', note['aliquota']),
+            _tag('ISSRetido', note['iss_retido']),
+            _tag('CPFCNPJTomador', [_tag('CNPJ', note['tomador'])]),
+            _tag('Discriminacao', note['discriminacao']),
+            ])
+
+    def _enviar(self, pedido, test):
+        cabecalho = _find(pedido, 'Cabecalho')
+        cnpj = _text(cabecalho, 'CNPJ')
+        alerts = []
+        errors = []
+        issued = []
+
+        for rps in _findall(pedido, 'RPS'):
+            chave = _find(rps, 'ChaveRPS')
+            inscricao = _text(chave, 'InscricaoPrestador')
+            serie = _text(chave, 'SerieRPS')
+            numero_rps = _text(chave, 'NumeroRPS')
+            key = self._chave_rps(inscricao, serie, numero_rps)
+
+            if self._chance(self.error_rate):
+                errors.append(self._message('Erro', ERROR, key))
+                continue
+            if self._chance(self.warning_rate):
+                alerts.append(self._message('Alerta', WARNING, key))
+            if self._chance(self.divergence_rate):
+                code, description = DIVERGENCE
+                description %= _text(rps, 'AliquotaServicos')
+                alerts.append(
+                    self._message('Alerta', (code, description), key)
+                    )
+
+            issued.append({
+                'inscricao': inscricao,
+                'serie': serie,
+                'numero_rps': numero_rps,
+                'cnpj': cnpj,
+                'status': 'N',
+                'emissao': datetime.datetime.now().strftime(
+                    '%Y-%m-%dT%H:%M:%S'
+                    ),
+                'data_rps': _text(rps, 'DataEmissao'),
+                'tributacao': _text(rps, 'TributacaoRPS', 'T'),
+                'valor': _text(rps, 'ValorServicos', '0'),
+                'codigo_servico': _text(rps, 'CodigoServico'),
+                'aliquota': _text(rps, 'AliquotaServicos', '0'),
+                'iss_retido': _text(rps, 'ISSRetido', 'false'),
+                'tomador': _text(_find(rps, 'CPFCNPJTomador'), 'CNPJ') or
+                           _text(_find(rps, 'CPFCNPJTomador'), 'CPF'),
+                'discriminacao': _text(rps, 'Discriminacao'),
+                })
+
+        success = not errors
+        body = []
+
+        if success and not test:
+            for note in issued:
+                with self._lock:
+                    note['numero'] = str(self._numbers.next())
+                    note['codigo'] = ''.join(
+                        self._random.choice(string.ascii_uppercase +
+                                            string.digits)
+                        for i in range(8)
+                        )
+                    self._notes[(note['inscricao'], note['numero'])] = note
+                    self._by_rps[(note['inscricao'], note['serie'],
+                                  note['numero_rps'])] = note
+                body.append(_tag('ChaveNFeRPS', [
+                    self._chave_nfe(note),
+                    self._chave_rps(note['inscricao'], note['serie'],
+                                    note['numero_rps']),
+                    ]))
+
+        return self._retorno('RetornoEnvioLoteRPS', success,
+                             alerts + errors + body)
+
+    def _op_EnvioLoteRPS(self, pedido):
+        return self._enviar(pedido, False)
+
+    def _op_TesteEnvioLoteRPS(self, pedido):
+        return self._enviar(pedido, True)
+
+    def _op_CancelamentoNFe(self, pedido):
+        errors = []
+
+        for detalhe in _findall(pedido, 'Detalhe'):
+            chave = _find(detalhe, 'ChaveNFe')
+            key = (_text(chave, 'InscricaoPrestador'),
+                   _text(chave, 'NumeroNFe'))
+            with self._lock:
+                note = self._notes.get(key)
+            if note is None:
+                errors.append(self._message('Erro', NOT_FOUND, _tag(
+                    'ChaveNFe', [_tag('InscricaoPrestador', key[0]),
+                                 _tag('NumeroNFe', key[1])]
+                    )))
+            elif self._chance(self.error_rate):
+                errors.append(self._message('Erro', ERROR,
+                                            self._chave_nfe(note)))
+            else:
+                note['status'] = 'C'
+
+        return self._retorno('RetornoCancelamentoNFe', not errors, errors)
+
+    def _op_ConsultaNFe(self, pedido):
+        notes = []
+
+        for detalhe in _findall(pedido, 'Detalhe'):
+            chave_nfe = _find(detalhe, 'ChaveNFe')
+            chave_rps = _find(detalhe, 'ChaveRPS')
+            with self._lock:
+                if chave_nfe is not None:
+                    note = self._notes.get(
+                        (_text(chave_nfe, 'InscricaoPrestador'),
+                         _text(chave_nfe, 'NumeroNFe'))
+                        )
+                else:
+                    note = self._by_rps.get(
+                        (_text(chave_rps, 'InscricaoPrestador'),
+                         _text(chave_rps, 'SerieRPS'),
+                         _text(chave_rps, 'NumeroRPS'))
+                        )
+            if note is not None:
+                notes.append(self._nfe(note))
+
+        return self._retorno('RetornoConsulta', True, notes)
+
+    def _op_ConsultaNFeEmitidas(self, pedido):
+        inscricao = _text(pedido, 'Inscricao')
+        start = _text(pedido, 'dtInicio')
+        end = _text(pedido, 'dtFim')
+        page = int(_text(pedido, 'NumeroPagina', '1') or 1)
+
+        with self._lock:
+            notes = sorted(
+                (n for n in self._notes.values()
+                 if n['inscricao'] == inscricao and
+                 start <= n['emissao'][:10] <= end),
+                key=lambda n: int(n['numero'])
+                )
+
+        page_notes = notes[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        return self._retorno('RetornoConsulta', True,
+                             [self._nfe(n) for n in page_notes])
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive, as the prefeitura does
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, content_type, data):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # Health checks only look at the status
+        self._reply(200, 'text/html', '<html><body>NFS-e</body></html>')
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        status, data = self.server.service.handle(self.rfile.read(length))
+        self._reply(status, 'text/xml; charset=utf-8', data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTPS server answering with a FakeService"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, certfile, keyfile=None,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.service = service
+        self.verbose = verbose
+        self.socket = ssl.wrap_socket(self.socket, keyfile, certfile,
+                                      server_side=True)
+
+    def handle_error(self, request, client_address):
+        # Mostly clients dropping idle keep-alive connections
+        if self.verbose:
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+
+def make_certificate(directory):
+    """Generate a self-signed certificate; returns its PEM file"""
+    path = os.path.join(directory, 'server.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-subj', '/CN=localhost', '-days', '1',
+        '-keyout', path, '-out', path,
+        ], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    return path
+
+
+def start(service, port=0, certfile=None, keyfile=None, verbose=False):
+    """Serve ``service`` from a daemon thread
+
+    Returns the server; its port is ``server.server_address[1]``.
+    """
+    directory = None
+    if certfile is None:
+        directory = tempfile.mkdtemp(prefix='fake_sp_')
+        certfile = make_certificate(directory)
+
+    try:
+        server = FakeServer(('localhost', port), service, certfile, keyfile,
+                            verbose)
+    finally:
+        # The certificate is loaded when the socket is wrapped
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_options(parser):
+    """Add the FakeService settings to an optparse parser"""
+    group = optparse.OptionGroup(parser, 'Fake web service')
+    group.add_option('--latency', type='float', default=0.0,
+                     help='seconds added to every response')
+    group.add_option('--jitter', type='float', default=0.0,
+                     help='random extra latency, up to this many seconds')
+    group.add_option('--error-rate', type='float', default=0.0,
+                     help='probability of rejecting each RPS')
+    group.add_option('--warning-rate', type='float', default=0.0,
+                     help='probability of a warning on each RPS')
+    group.add_option('--divergence-rate', type='float', default=0.0,
+                     help='probability of a code 208 warning on each RPS')
+    group.add_option('--fault-rate', type='float', default=0.0,
+                     help='probability of an HTTP 500 on each request')
+    group.add_option('--seed', type='int', default=None,
+                     help='seed of the injected failures')
+    parser.add_option_group(group)
+
+
+def service_from_options(options):
+    return FakeService(options.latency, options.jitter, options.error_rate,
+                       options.warning_rate, options.divergence_rate,
+                       options.fault_rate, options.seed)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8443)
+    parser.add_option('--certfile', help='PEM server certificate')
+    parser.add_option('--keyfile', help='PEM key, if not in the certificate')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='log every request')
+    add_options(parser)
+    options, args = parser.parse_args(argv)
+
+    service = service_from_options(options)
+    server = start(service, options.port, options.certfile, options.keyfile,
+                   options.verbose)
+    print 'Fake NFS-e service listening on localhost:%d' % \
+        server.server_address[1]
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print ', '.join('%s: %d' % item for item in
+                        sorted(service.stats.items()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
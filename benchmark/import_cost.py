@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Import time and resident memory of pysped_nfse, eager versus lazy
+
+Each scenario runs several times in a fresh interpreter; the median is
+reported against a bare interpreter::
+
+    python benchmark/import_cost.py --repeat 7
+
+``eager`` is what every server process paid when the wizard imported
+pysped_nfse at load time, ``lazy`` what it pays now that nfse/lazy.py
+defers it, and ``first use`` what the first NFS-e operation of a process
+adds on top.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+
+NFSE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'nfse')
+
+PROBE = """
+import resource, time
+start = time.time()
+%s
+elapsed = time.time() - start
+with open('/proc/self/statm') as statm:
+    rss = int(statm.read().split()[1]) * resource.getpagesize()
+print elapsed, rss
+"""
+
+LAZY = """
+import imp
+lazy = imp.load_source('lazy', %r)
+""" % os.path.join(NFSE_DIR, 'lazy.py')
+
+SCENARIOS = [
+    ('bare', 'pass'),
+    ('eager', """
+from pysped_nfse.processador import ProcessadorNFSe, SIGNATURE
+from pysped_nfse.processador_sp import ProcessadorNFSeSP, tpRPS, tpNFe
+from pysped_nfse.nfse_xsd import *
+from pysped_nfse.exception import CommunicationError
+"""),
+    ('lazy', LAZY),
+    ('first use', LAZY + """
+lazy.pysped.ProcessadorNFSeSP
+lazy.pysped.CommunicationError
+"""),
+    ]
+
+
+def measure(statement, repeat):
+    """Return the median ``(seconds, rss_bytes)`` of ``statement``, or
+    None when it fails, e.g. without pysped_nfse installed"""
+    samples = []
+    for i in range(repeat):
+        try:
+            output = subprocess.check_output([sys.executable, '-c',
+                                              PROBE % statement],
+                                             stderr=open(os.devnull, 'w'))
+        except subprocess.CalledProcessError:
+            return None
+        elapsed, rss = output.split()
+        samples.append((float(elapsed), int(rss)))
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='runs per scenario')
+    options, args = parser.parse_args(argv)
+
+    results = [(name, measure(statement, options.repeat))
+               for name, statement in SCENARIOS]
+    bare_rss = results[0][1][1]
+
+    print '%-10s %10s %10s' % ('scenario', 'import ms', '+RSS MB')
+    for name, result in results:
+        if result is None:
+            print '%-10s %10s %10s' % (name, 'failed', 'failed')
+            continue
+        elapsed, rss = result
+        print '%-10s %10.1f %10.1f' % (name, elapsed * 1000,
+                                       (rss - bare_rss) / 1048576.0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Offline throughput benchmark of the NFS-e operations
+
+Runs the manage_nfse wizard inside this process, against a database with
+the module installed and a FakeService started on a local port::
+
+    python benchmark/run_benchmark.py -c /etc/openerp-server.conf \\
+        -d nfse_bench --template 42 --invoices 2000 --latency 0.1
+
+``--template`` is a validated service invoice with complete fiscal data.
+It is copied and validated ``--invoices`` times, then the copies are sent,
+checked and cancelled. Each operation reports invoices per second, SQL
+queries and resident memory; ``--output`` saves the results as JSON to
+compare runs. The generated invoices are committed, so use a copy of a
+database (``createdb -T``), never a production one.
+"""
+
+import datetime
+import json
+import optparse
+import resource
+import ssl
+import sys
+import threading
+import time
+
+import fake_sp_server
+
+UID = 1
+
+# Wizard method of each operation, in the order they can run
+OPERATIONS = [
+    ('test', 'test_send_nfse'),
+    ('send', 'send_nfse'),
+    ('check', 'check_nfse'),
+    ('cancel', 'cancel_nfse'),
+    ]
+
+
+class QueryCounter(object):
+    """Count the SQL statements executed through OpenERP cursors"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def install(self, cursor_class):
+        execute = cursor_class.execute
+        counter = self
+
+        def counted_execute(cursor, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return execute(cursor, *args, **kwargs)
+
+        cursor_class.execute = counted_execute
+
+
+def rss_mb():
+    """Current resident memory of the process"""
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1048576.0
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def generate_invoices(pool, cr, template_id, count, netsvc):
+    """Copy and validate the template invoice ``count`` times"""
+    inv_obj = pool.get('account.invoice')
+    wf_service = netsvc.LocalService('workflow')
+
+    template = inv_obj.read(cr, UID, template_id, ['fiscal_type'])
+    if template['fiscal_type'] != 'service':
+        raise ValueError('Invoice %d is not a service invoice' % template_id)
+
+    today = datetime.date.today().strftime('%Y-%m-%d')
+    invoice_ids = []
+
+    for i in xrange(count):
+        invoice_id = inv_obj.copy(cr, UID, template_id,
+                                  {'date_invoice': today})
+        wf_service.trg_validate(UID, 'account.invoice', invoice_id,
+                                'invoice_open', cr)
+        invoice_ids.append(invoice_id)
+        if len(invoice_ids) % 100 == 0:
+            cr.commit()
+
+    cr.commit()
+    return invoice_ids
+
+
+def run_operation(pool, db, osv, name, method, invoice_ids, counter,
+                  service):
+    """Run one wizard operation on its own cursor and measure it
+
+    As in the server, the transaction is rolled back when the wizard
+    raises, except for what the wizard committed itself.
+    """
+    wizard_obj = pool.get('l10n_br_nfse.manage_nfse')
+    cr = db.cursor()
+
+    try:
+        wizard_id = wizard_obj.create(cr, UID, {
+            'selected_invoices': [(6, 0, invoice_ids)],
+            'remote_test': True,
+            })
+        cr.commit()
+
+        queries = counter.count
+        requests = sum(service.stats.values())
+        rss = rss_mb()
+        start = time.time()
+
+        try:
+            getattr(wizard_obj, method)(cr, UID, [wizard_id], {})
+            cr.commit()
+            outcome = wizard_obj.read(cr, UID, wizard_id, ['state'])['state']
+        except osv.except_osv, e:
+            cr.rollback()
+            outcome = unicode(e.name).encode('utf-8')
+
+        elapsed = time.time() - start
+    finally:
+        cr.close()
+
+    return {
+        'operation': name,
+        'invoices': len(invoice_ids),
+        'seconds': elapsed,
+        'invoices_per_second': len(invoice_ids) / max(elapsed, 1e-6),
+        'queries': counter.count - queries,
+        'queries_per_invoice': float(counter.count - queries) /
+                               max(len(invoice_ids), 1),
+        'requests': sum(service.stats.values()) - requests,
+        'rss_mb': rss_mb(),
+        'rss_growth_mb': rss_mb() - rss,
+        'peak_rss_mb': peak_rss_mb(),
+        'outcome': outcome,
+        }
+
+
+def report(results):
+    columns = [
+        ('operation', '%-9s', '%-9s'),
+        ('invoices', '%9s', '%9d'),
+        ('seconds', '%9s', '%9.2f'),
+        ('invoices_per_second', '%9s', '%9.1f'),
+        ('queries', '%9s', '%9d'),
+        ('queries_per_invoice', '%9s', '%9.1f'),
+        ('requests', '%9s', '%9d'),
+        ('rss_mb', '%9s', '%9.1f'),
+        ('rss_growth_mb', '%9s', '%9.1f'),
+        ('peak_rss_mb', '%9s', '%9.1f'),
+        ('outcome', ' %s', ' %s'),
+        ]
+    headers = ['op', 'invoices', 'seconds', 'inv/s', 'queries', 'q/inv',
+               'requests', 'rss MB', '+rss MB', 'peak MB', 'outcome']
+
+    print ''.join(fmt % header
+                  for (field, fmt, value_fmt), header in zip(columns, headers))
+    for result in results:
+        print ''.join(value_fmt % result[field]
+                      for field, fmt, value_fmt in columns)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog -d DATABASE --template ID '
+                                         '[options]')
+    parser.add_option('-c', '--config', help='OpenERP configuration file')
+    parser.add_option('-d', '--database', help='database to benchmark on')
+    parser.add_option('--template', type='int',
+                      help='validated service invoice to copy')
+    parser.add_option('--invoices', type='int', default=1000,
+                      help='number of invoices to generate')
+    parser.add_option('--operations', default='send,check,cancel',
+                      help='comma separated, among %s' %
+                           ', '.join(name for name, method in OPERATIONS))
+    parser.add_option('--output', help='save the results as JSON')
+    fake_sp_server.add_options(parser)
+    options, args = parser.parse_args(argv)
+
+    if not options.database or not options.template:
+        parser.error('--database and --template are required')
+
+    operations = dict(OPERATIONS)
+    selected = options.operations.split(',')
+    for name in selected:
+        if name not in operations:
+            parser.error('unknown operation %s' % name)
+
+    from openerp import netsvc, pooler, sql_db, tools
+    from openerp.osv import osv
+
+    arguments = ['-d', options.database]
+    if options.config:
+        arguments += ['-c', options.config]
+    tools.config.parse_config(arguments)
+
+    service = fake_sp_server.service_from_options(options)
+    server = fake_sp_server.start(service)
+
+    # Send everything at once, straight to the fake service
+    tools.config['l10n_br_nfse_server'] = 'localhost:%d' % \
+        server.server_address[1]
+    tools.config['l10n_br_nfse_queue_send'] = False
+    tools.config['l10n_br_nfse_async_send'] = False
+    # The fake service uses a self-signed certificate
+    if hasattr(ssl, '_create_unverified_context'):
+        ssl._create_default_https_context = ssl._create_unverified_context
+
+    counter = QueryCounter()
+    counter.install(sql_db.Cursor)
+
+    db, pool = pooler.get_db_and_pool(options.database)
+
+    cr = db.cursor()
+    try:
+        start = time.time()
+        invoice_ids = generate_invoices(pool, cr, options.template,
+                                        options.invoices, netsvc)
+        print 'Generated %d invoices in %.1fs' % (len(invoice_ids),
+                                                  time.time() - start)
+    finally:
+        cr.close()
+
+    results = [run_operation(pool, db, osv, name, operations[name],
+                             invoice_ids, counter, service)
+               for name, method in OPERATIONS if name in selected]
+
+    server.shutdown()
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Store NFS-e statuses as selection keys instead of labels"""
+
+LABELS = {
+    'Transmitida': 'sent',
+    'Falhou ao transmitir': 'send_failed',
+    'Cancelada': 'cancelled',
+    'Falhou ao cancelar': 'cancel_failed',
+    }
+
+
+def migrate(cr, version):
+    if not version:
+        return
+
+    for label, key in LABELS.items():
+        cr.execute("""
+            UPDATE account_invoice SET nfse_status = %s
+            WHERE nfse_status = %s
+            """, (key, label))
+
+    # Confirmed service invoices never sent are now explicitly pending
+    cr.execute("""
+        UPDATE account_invoice SET nfse_status = 'pending'
+        WHERE nfse_status IS NULL AND fiscal_type = 'service'
+          AND state IN ('open', 'sefaz_export', 'paid')
+        """)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Splitting of RPS batches into lots accepted by the web service"""
+
+import itertools
+import sys
+import threading
+
+from config import get_param
+import timing
+
+# Bytes added to every RPS by the XML envelope, its tags and its signature
+RPS_OVERHEAD = 1024
+
+
+def estimate_size(rps):
+    """Rough size in bytes of the serialized RPS"""
+    size = RPS_OVERHEAD
+    for tag, value in rps.items():
+        if value is None:
+            continue
+        if not isinstance(value, unicode):
+            value = str(value).decode('utf-8')
+        size += 2 * len(tag) + 5 + len(value.encode('utf-8'))
+    return size
+
+
+def chunk_lotes(lote_rps, max_rps=None, max_bytes=None):
+    """Yield lists of RPS bounded by count and estimated payload size"""
+    if max_rps is None:
+        max_rps = get_param('max_rps_per_lot', 50)
+    if max_bytes is None:
+        max_bytes = get_param('max_lot_bytes', 500000)
+
+    lote = []
+    lote_size = 0
+
+    for rps in lote_rps:
+        size = estimate_size(rps)
+
+        if lote and (len(lote) >= max_rps or lote_size + size > max_bytes):
+            yield lote
+            lote = []
+            lote_size = 0
+
+        lote.append(rps)
+        lote_size += size
+
+    if lote:
+        yield lote
+
+
+def windows(items, size):
+    """Yield consecutive lists of at most ``size`` items of ``items``,
+    which may be any iterable, e.g. a generator"""
+    items = iter(items)
+    while True:
+        window = list(itertools.islice(items, size))
+        if not window:
+            return
+        yield window
+
+
+def lot_protocol(res):
+    """Return the protocol or number the prefeitura gave to a lot"""
+    protocol = getattr(res, 'NumeroProtocolo', None)
+    if protocol is None:
+        try:
+            protocol = res.Cabecalho.InformacoesLote.NumeroLote
+        except AttributeError:
+            return None
+    return str(protocol)
+
+
+def lot_sent(res):
+    """Return ``(numero_rps, numero_nfe, codigo_verificacao)`` of the RPS
+    a lot response reports as converted into NFS-e"""
+    return [(chave.ChaveRPS.NumeroRPS, int(chave.ChaveNFe.NumeroNFe),
+             chave.ChaveNFe.CodigoVerificacao)
+            for chave in res.ChaveNFeRPS]
+
+
+class _Call(threading.Thread):
+    def __init__(self, func, item):
+        super(_Call, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.item = item
+        self.result = None
+        self.exc_info = None
+        self.operation = timing.current()
+        self.start()
+
+    def run(self):
+        with timing.bound(self.operation):
+            try:
+                self.result = self.func(self.item)
+            except Exception:
+                self.exc_info = sys.exc_info()
+
+    def wait(self):
+        self.join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+def pipeline(items, func):
+    """Yield ``(item, func(item))`` for each item, one call at a time.
+
+    ``func`` runs in a background thread, so when ``items`` is a generator
+    the next item is produced while the previous call is still in flight.
+    Exceptions raised by ``func`` are re-raised in the caller.
+    """
+    pending = None
+
+    for item in items:
+        if pending is not None:
+            yield pending.item, pending.wait()
+        pending = _Call(func, item)
+
+    if pending is not None:
+        yield pending.item, pending.wait()
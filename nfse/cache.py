@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Process-wide caches of NFS-e processors and fiscal reference data"""
+
+import atexit
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import get_param
+
+
+class LRUCache(object):
+    """Thread-safe LRU mapping whose entries expire after ``ttl`` seconds.
+
+    ``on_evict`` is called with ``(key, value)`` whenever an entry leaves the
+    cache, be it by expiration, by size or by explicit invalidation. Lookups
+    are counted in ``hits`` and ``misses``.
+    """
+
+    def __init__(self, max_size=32, ttl=3600, on_evict=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self, key):
+        expires, value = self._data.pop(key)
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+
+            expires, value = self._data.pop(key)
+
+            if expires < time.time():
+                if self.on_evict:
+                    self.on_evict(key, value)
+                self.misses += 1
+                return default
+
+            # Reinsert to mark it as the most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._evict(key)
+
+            self._data[key] = (time.time() + self.ttl, value)
+
+            while len(self._data) > self.max_size:
+                self._evict(next(iter(self._data)))
+
+    def invalidate(self, predicate):
+        """Drop every entry whose key matches ``predicate``"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._evict(key)
+
+    def clear(self):
+        self.invalidate(lambda key: True)
+
+
+class ProcessorCache(object):
+    """Keep one processor per company and certificate.
+
+    Entries are keyed by ``(company_id, fingerprint)``, where the fingerprint
+    is computed from the stored certificate and its password, so a changed
+    certificate never reuses a stale processor even in other server processes.
+    Each certificate is written once to a private temporary file, kept until
+    the process exits: an evicted processor may still be reading it in
+    another thread.
+    """
+
+    def __init__(self, max_size=16, ttl=3600):
+        self._entries = LRUCache(max_size, ttl)
+        self._cert_files = {}
+        self._lock = threading.Lock()
+        atexit.register(self._remove_cert_files)
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def fingerprint(company):
+        digest = hashlib.sha1(company.nfse_cert_file or '')
+        digest.update(company.nfse_cert_password or '')
+        return digest.hexdigest()
+
+    def _remove_cert_files(self):
+        with self._lock:
+            for cert_file in self._cert_files.values():
+                try:
+                    os.unlink(cert_file)
+                except OSError:
+                    pass
+            self._cert_files = {}
+
+    def get(self, company, factory):
+        """Return the processor of ``company``, building it with ``factory``
+
+        ``factory`` is called as ``factory(cert_file, cert_password)``.
+        """
+        fingerprint = self.fingerprint(company)
+        key = (company.id, fingerprint)
+        processor = self._entries.get(key)
+
+        if processor is None:
+            with self._lock:
+                processor = self._entries.get(key)
+                if processor is None:
+                    processor = factory(
+                        self._cert_file(company, fingerprint),
+                        company.nfse_cert_password,
+                        )
+                    self._entries.set(key, processor)
+
+        return processor
+
+    def _cert_file(self, company, fingerprint):
+        """Return the file holding the certificate, writing it once per
+        fingerprint; called with the lock held"""
+        if fingerprint not in self._cert_files:
+            fd, cert_file = tempfile.mkstemp(prefix='nfse-')
+            try:
+                os.write(fd, base64.decodestring(company.nfse_cert_file))
+            finally:
+                os.close(fd)
+            self._cert_files[fingerprint] = cert_file
+        return self._cert_files[fingerprint]
+
+    def invalidate(self, company_ids):
+        company_ids = set(company_ids)
+        self._entries.invalidate(lambda key: key[0] in company_ids)
+
+    def clear(self):
+        self._entries.clear()
+
+
+_spares_lock = threading.Lock()
+
+
+@contextmanager
+def exclusive(processor):
+    """Lend ``processor`` to the calling thread alone
+
+    pysped processors are not known to be thread safe. While the cached
+    processor is lent to a thread, the others get spare copies, built by its
+    ``nfse_factory`` and kept in its ``nfse_spares`` for reuse.
+    """
+    lock = getattr(processor, 'nfse_lock', None)
+    if lock is None:
+        yield processor
+        return
+
+    if lock.acquire(False):
+        try:
+            yield processor
+        finally:
+            lock.release()
+        return
+
+    with _spares_lock:
+        spare = processor.nfse_spares and processor.nfse_spares.pop() or None
+    if spare is None:
+        spare = processor.nfse_factory()
+    try:
+        yield spare
+    finally:
+        with _spares_lock:
+            processor.nfse_spares.append(spare)
+
+
+class ReferenceCache(object):
+    """Keep the records of rarely changing models read to build RPS.
+
+    Entries are keyed by ``(dbname, model, fields, id)``. Writes to a cached
+    model must call ``invalidate``; the ``ttl`` bounds how long other server
+    processes may keep a stale record.
+    """
+
+    def __init__(self, max_size=2048, ttl=3600):
+        self._entries = LRUCache(max_size, ttl)
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    def read(self, pool, cr, uid, model, ids, fields, context=None):
+        """Return ``{id: record}`` of ``ids``, reading only those missing
+        from the cache. The records are copies, free to be modified."""
+        fields = tuple(fields)
+        result = {}
+        missing = []
+
+        for record_id in set(i for i in ids if i):
+            record = self._entries.get((cr.dbname, model, fields, record_id))
+            if record is None:
+                missing.append(record_id)
+            else:
+                result[record_id] = dict(record)
+
+        if missing:
+            for record in pool.get(model).read(cr, uid, missing, list(fields),
+                                               context=context):
+                self._entries.set((cr.dbname, model, fields, record['id']),
+                                  record)
+                result[record['id']] = dict(record)
+
+        return result
+
+    def invalidate(self, cr, model, ids):
+        ids = set(ids)
+        self._entries.invalidate(
+            lambda key: key[0] == cr.dbname and key[1] == model and
+            key[3] in ids
+            )
+
+    def clear(self):
+        self._entries.clear()
+
+
+processor_cache = ProcessorCache(
+    get_param('processor_cache_size', 16),
+    get_param('processor_cache_ttl', 3600),
+    )
+
+reference_cache = ReferenceCache(
+    get_param('reference_cache_size', 2048),
+    get_param('reference_cache_ttl', 3600),
+    )
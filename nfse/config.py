@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Settings read from the OpenERP server configuration file.
+
+Every option is prefixed with ``l10n_br_nfse_``, e.g.::
+
+    [options]
+    l10n_br_nfse_processor_cache_size = 16
+"""
+
+import tools
+
+PREFIX = 'l10n_br_nfse_'
+
+
+def get_param(name, default):
+    """Return option ``name`` coerced to the type of ``default``"""
+    value = tools.config.get(PREFIX + name)
+
+    if value is None:
+        return default
+
+    if isinstance(default, bool):
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+    try:
+        return type(default)(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Capture of the HTTP traffic of the NFS-e web service calls"""
+
+import httplib
+import threading
+from contextlib import contextmanager
+
+
+_captured = threading.local()
+
+
+@contextmanager
+def capture():
+    """Record the HTTP traffic of the current thread
+
+    Yields a list that receives ``(request_body, response_body)`` for each
+    request answered inside the block, whatever client made it, so the
+    SOAP calls of pysped_nfse are seen exactly as they went over the wire,
+    signature included. The list is filled when the block exits.
+
+    The httplib hooks are installed by the first block entered and removed
+    when the last one exits; outside of them other threads' traffic goes
+    through the hooks untouched.
+    """
+    _hook_httplib()
+    previous = getattr(_captured, 'exchanges', None)
+    exchanges = _captured.exchanges = []
+    try:
+        yield exchanges
+    finally:
+        _captured.exchanges = previous
+        _unhook_httplib()
+        exchanges[:] = [(''.join(sent).split('\r\n\r\n', 1)[-1],
+                         ''.join(received))
+                        for sent, received in exchanges if received]
+
+
+_hook_lock = threading.Lock()
+# Number of capture blocks open, and the httplib methods they replaced
+_hook_users = [0]
+_hooked = {}
+
+
+def _hook_httplib():
+    with _hook_lock:
+        _hook_users[0] += 1
+        if _hook_users[0] > 1:
+            return
+
+        putrequest = _hooked['putrequest'] = \
+            httplib.HTTPConnection.putrequest
+        send = _hooked['send'] = httplib.HTTPConnection.send
+        read = _hooked['read'] = httplib.HTTPResponse.read
+
+        def captured_putrequest(self, *args, **kwargs):
+            exchanges = getattr(_captured, 'exchanges', None)
+            if exchanges is not None:
+                exchanges.append(([], []))
+            return putrequest(self, *args, **kwargs)
+
+        def captured_send(self, data):
+            exchanges = getattr(_captured, 'exchanges', None)
+            if exchanges and isinstance(data, basestring):
+                exchanges[-1][0].append(data)
+            return send(self, data)
+
+        def captured_read(self, *args, **kwargs):
+            data = read(self, *args, **kwargs)
+            exchanges = getattr(_captured, 'exchanges', None)
+            if exchanges:
+                exchanges[-1][1].append(data)
+            return data
+
+        httplib.HTTPConnection.putrequest = captured_putrequest
+        httplib.HTTPConnection.send = captured_send
+        httplib.HTTPResponse.read = captured_read
+
+
+def _unhook_httplib():
+    with _hook_lock:
+        _hook_users[0] -= 1
+        if _hook_users[0]:
+            return
+
+        httplib.HTTPConnection.putrequest = _hooked.pop('putrequest')
+        httplib.HTTPConnection.send = _hooked.pop('send')
+        httplib.HTTPResponse.read = _hooked.pop('read')
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Cached health check of the NFS-e web services with a circuit breaker"""
+
+import socket
+import threading
+import time
+import urllib2
+
+from config import get_param
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _Endpoint(object):
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.checked_at = None
+        self.probing = False
+
+
+class ServerHealthCheck(object):
+    """Probe NFS-e endpoints, remembering the outcome for a while.
+
+    A successful probe is cached for ``ttl`` seconds. After
+    ``failure_threshold`` consecutive failures the circuit opens and every
+    check fails immediately for ``reset_timeout`` seconds; then a single probe
+    is let through (half-open), closing the circuit again if it succeeds.
+    """
+
+    def __init__(self, ttl=60, timeout=10, failure_threshold=3,
+                 reset_timeout=120):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, url):
+        if url not in self._endpoints:
+            self._endpoints[url] = _Endpoint()
+        return self._endpoints[url]
+
+    def state(self, url):
+        with self._lock:
+            return self._endpoint(url).state
+
+    def _probe(self, url):
+        try:
+            return urllib2.urlopen(url, timeout=self.timeout).getcode() == 200
+        except (urllib2.URLError, socket.error, IOError):
+            return False
+
+    def is_up(self, url):
+        now = time.time()
+
+        with self._lock:
+            endpoint = self._endpoint(url)
+
+            if endpoint.state == OPEN:
+                if now - endpoint.opened_at < self.reset_timeout:
+                    return False
+                endpoint.state = HALF_OPEN
+
+            elif endpoint.state == HALF_OPEN and endpoint.probing:
+                # Only one trial request is let through while half-open
+                return False
+
+            elif endpoint.state == CLOSED and endpoint.checked_at and \
+                    now - endpoint.checked_at < self.ttl:
+                return True
+
+            endpoint.probing = endpoint.state == HALF_OPEN
+
+        server_up = self._probe(url)
+
+        with self._lock:
+            endpoint.probing = False
+            if server_up:
+                endpoint.state = CLOSED
+                endpoint.failures = 0
+                endpoint.checked_at = time.time()
+            else:
+                endpoint.failures += 1
+                endpoint.checked_at = None
+                if endpoint.state == HALF_OPEN or \
+                        endpoint.failures >= self.failure_threshold:
+                    endpoint.state = OPEN
+                    endpoint.opened_at = time.time()
+
+        return server_up
+
+
+health_check = ServerHealthCheck(
+    ttl=get_param('health_check_ttl', 60),
+    timeout=get_param('health_check_timeout', 10),
+    failure_threshold=get_param('health_check_failures', 3),
+    reset_timeout=get_param('health_check_reset', 120),
+    )
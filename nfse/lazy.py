@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Lazy access to pysped_nfse
+
+pysped_nfse pulls in large generated XSD bindings and the signing
+libraries. It is imported on first use rather than when OpenERP loads the
+module, so server processes that never handle NFS-e do not pay for it::
+
+    from nfse.lazy import pysped
+    processor = pysped.ProcessadorNFSeSP(cert_file, password)
+
+Exception classes can be named in ``except`` clauses, which are only
+evaluated when an exception is being handled.
+"""
+
+import importlib
+import threading
+
+# Names served by the facade and the modules they come from
+NAMES = {
+    'ProcessadorNFSeSP': 'pysped_nfse.processador_sp',
+    'CommunicationError': 'pysped_nfse.exception',
+    }
+
+
+class LazyPysped(object):
+    def __init__(self, names):
+        self._names = names
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._names:
+            raise AttributeError(name)
+        with self._lock:
+            value = getattr(importlib.import_module(self._names[name]), name)
+        # Later lookups find the attribute without going through here
+        setattr(self, name, value)
+        return value
+
+    def loaded(self):
+        """Whether any part of pysped_nfse has been imported yet"""
+        return any(name in self.__dict__ for name in self._names)
+
+
+pysped = LazyPysped(NAMES)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Set-based loading of the data needed to build RPS batches.
+
+Instead of walking browse records invoice by invoice, every model involved
+is read once for the whole selection, so the number of queries does not
+grow with the number of invoices.
+"""
+
+from cache import reference_cache
+
+INVOICE_FIELDS = [
+    'number', 'internal_number', 'date_invoice', 'amount_untaxed',
+    'amount_tax', 'partner_id', 'company_id', 'fiscal_type',
+    'fiscal_operation_id', 'document_serie_id', 'nfse_rps', 'nfse_rps_hash',
+    ]
+COMPANY_FIELDS = ['name', 'partner_id', 'cnpj', 'inscr_mun', 'tributacao']
+PARTNER_FIELDS = [
+    'name', 'legal_name', 'cnpj_cpf', 'inscr_mun', 'inscr_est', 'tipo_pessoa',
+    ]
+ADDRESS_FIELDS = [
+    'type', 'partner_id', 'street', 'number', 'street2', 'district',
+    'l10n_br_city_id', 'state_id', 'zip', 'email',
+    ]
+
+
+def m2o_id(value):
+    """Return the id of a many2one value as returned by read()"""
+    if isinstance(value, (list, tuple)):
+        return value[0]
+    return value or False
+
+
+def _relation(pool, model, field):
+    return pool.get(model)._columns[field]._obj
+
+
+def _read(pool, cr, uid, model, ids, fields, context=None):
+    ids = list(set(i for i in ids if i))
+    if not ids:
+        return {}
+    records = pool.get(model).read(cr, uid, ids, fields, context=context)
+    return dict((r['id'], r) for r in records)
+
+
+def _read_cached(pool, cr, uid, model, ids, fields, context=None):
+    """Same as _read, through the reference cache"""
+    return reference_cache.read(pool, cr, uid, model, ids, fields, context)
+
+
+def _read_by(pool, cr, uid, model, field, ids, fields, context=None,
+             order=None):
+    """Read the records of ``model`` whose ``field`` is in ``ids``, grouped
+    by the value of ``field``"""
+    grouped = dict((i, []) for i in ids)
+    if not ids:
+        return grouped
+
+    obj = pool.get(model)
+    found = obj.search(cr, uid, [(field, 'in', list(ids))], order=order,
+                       context=context)
+    records = dict(
+        (r['id'], r) for r in obj.read(cr, uid, found, fields + [field],
+                                       context=context)
+        )
+
+    for record_id in found:
+        record = records[record_id]
+        grouped.setdefault(m2o_id(record[field]), []).append(record)
+
+    return grouped
+
+
+def _default_addresses(addresses_by_partner):
+    """Pick each partner's address the same way res.partner.address_get does
+    for the 'default' type"""
+    result = {}
+    for partner_id, addresses in addresses_by_partner.items():
+        default = [a for a in addresses if a['type'] == 'default']
+        result[partner_id] = (default or addresses or [None])[0]
+    return result
+
+
+def prefetch_send_data(pool, cr, uid, invoice_ids, context=None,
+                       snapshots=False):
+    """Load invoices, companies, partners, addresses, taxes and lines.
+
+    Returns a dict of dicts keyed by record id. Each company and partner
+    carries its default address under ``'address'``, resolved once no matter
+    how many invoices share it. With ``snapshots``, invoices holding a
+    stored RPS get their company only: their other data is not read.
+    """
+    invoices = _read(pool, cr, uid, 'account.invoice', invoice_ids,
+                     INVOICE_FIELDS, context)
+
+    companies = _read(pool, cr, uid, 'res.company',
+                      [m2o_id(i['company_id']) for i in invoices.values()],
+                      COMPANY_FIELDS, context)
+
+    for invoice in invoices.values():
+        invoice['company'] = companies[m2o_id(invoice['company_id'])]
+
+    if snapshots:
+        invoices_to_build = dict((i, inv) for i, inv in invoices.items()
+                                 if not inv['nfse_rps'])
+    else:
+        invoices_to_build = invoices
+    if not invoices_to_build:
+        return {
+            'invoices': invoices,
+            'companies': companies,
+            }
+
+    partner_ids = set(m2o_id(i['partner_id'])
+                      for i in invoices_to_build.values())
+    partner_ids.update(m2o_id(i['company']['partner_id'])
+                       for i in invoices_to_build.values())
+    partner_ids.discard(False)
+    partners = _read(pool, cr, uid, 'res.partner', partner_ids,
+                     PARTNER_FIELDS, context)
+
+    addresses = _default_addresses(_read_by(
+        pool, cr, uid, 'res.partner.address', 'partner_id', partner_ids,
+        ADDRESS_FIELDS, context, order='type, name',
+        ))
+
+    states = _read_cached(pool, cr, uid, 'res.country.state',
+                          [m2o_id(a['state_id'])
+                           for a in addresses.values() if a],
+                          ['ibge_code', 'code'], context)
+    cities = _read_cached(
+        pool, cr, uid,
+        _relation(pool, 'res.partner.address', 'l10n_br_city_id'),
+        [m2o_id(a['l10n_br_city_id']) for a in addresses.values() if a],
+        ['ibge_code'], context,
+        )
+
+    for address in addresses.values():
+        if address:
+            address['state'] = states.get(m2o_id(address['state_id']))
+            address['city'] = cities.get(m2o_id(address['l10n_br_city_id']))
+
+    for partner in partners.values():
+        partner['address'] = addresses.get(partner['id'])
+
+    for company in companies.values():
+        company['address'] = addresses.get(m2o_id(company['partner_id']))
+
+    fiscal_operations = _read_cached(
+        pool, cr, uid,
+        _relation(pool, 'account.invoice', 'fiscal_operation_id'),
+        [m2o_id(i['fiscal_operation_id'])
+         for i in invoices_to_build.values()],
+        ['code'], context,
+        )
+    document_series = _read_cached(
+        pool, cr, uid,
+        _relation(pool, 'account.invoice', 'document_serie_id'),
+        [m2o_id(i['document_serie_id']) for i in invoices_to_build.values()],
+        ['code'], context,
+        )
+
+    tax_lines = _read_by(pool, cr, uid, 'account.invoice.tax', 'invoice_id',
+                         invoices_to_build.keys(),
+                         ['tax_code_id', 'amount', 'aliquota'], context)
+    tax_codes = _read(pool, cr, uid, 'account.tax.code',
+                      [m2o_id(t['tax_code_id'])
+                       for taxes in tax_lines.values() for t in taxes],
+                      ['domain'], context)
+    invoice_lines = _read_by(pool, cr, uid, 'account.invoice.line',
+                             'invoice_id', invoices_to_build.keys(), ['name'],
+                             context, order='sequence, id')
+
+    for invoice in invoices_to_build.values():
+        invoice['partner'] = partners[m2o_id(invoice['partner_id'])]
+        invoice['fiscal_operation'] = fiscal_operations.get(
+            m2o_id(invoice['fiscal_operation_id'])
+            )
+        invoice['document_serie'] = document_series.get(
+            m2o_id(invoice['document_serie_id'])
+            )
+        invoice['taxes'] = [
+            dict(t, domain=tax_codes.get(m2o_id(t['tax_code_id']),
+                                         {}).get('domain'))
+            for t in tax_lines[invoice['id']]
+            ]
+        invoice['lines'] = [l['name'] for l in invoice_lines[invoice['id']]]
+
+    return {
+        'invoices': invoices,
+        'companies': companies,
+        }
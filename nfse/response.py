@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Streaming parser of the responses of the prefeitura de São Paulo
+
+pysped_nfse binds whole responses into object trees. The accepted RPS of a
+lot are read here instead from the raw response captured on the wire (see
+nfse.connection.capture), one record at a time: the write-back consumes
+them while the document is parsed and the bound tree is never walked.
+"""
+
+from cStringIO import StringIO
+from xml.etree import cElementTree
+
+# Elements yielded as records, by local name
+RECORDS = ('ChaveNFeRPS', 'NFe', 'Alerta', 'Erro')
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(element):
+    return dict((_local(child.tag), child) for child in element)
+
+
+def _text(parent, name):
+    element = parent.get(name)
+    if element is None or element.text is None:
+        return None
+    return element.text.strip()
+
+
+def _record(element):
+    kind = _local(element.tag)
+    children = _children(element)
+    chave_rps = _children(children.get('ChaveRPS', ()))
+    chave_nfe = _children(children.get('ChaveNFe', ()))
+    return {
+        'kind': kind,
+        'numero_rps': _text(chave_rps, 'NumeroRPS'),
+        'serie_rps': _text(chave_rps, 'SerieRPS'),
+        'numero_nfe': _text(chave_nfe, 'NumeroNFe'),
+        'codigo_verificacao': _text(chave_nfe, 'CodigoVerificacao'),
+        'status': _text(children, 'StatusNFe'),
+        'code': _text(children, 'Codigo'),
+        'message': _text(children, 'Descricao'),
+        }
+
+
+def _retorno(data):
+    """Return the Retorno document, unwrapped from its SOAP envelope"""
+    events = cElementTree.iterparse(StringIO(data), ('start', 'end'))
+    for event, element in events:
+        if event == 'start' and _local(element.tag) != 'Envelope':
+            # Already the Retorno document
+            return data
+        break
+    for event, element in events:
+        if event == 'end' and _local(element.tag) == 'RetornoXML':
+            return (element.text or '').encode('utf-8')
+    return data
+
+
+def iter_records(data):
+    """Yield a dict per ChaveNFeRPS, NFe, Alerta and Erro of a response
+
+    ``data`` is the response body, a SOAP envelope or the Retorno document
+    itself. Each dict has ``kind`` (the element name), ``numero_rps``,
+    ``serie_rps``, ``numero_nfe``, ``codigo_verificacao``, ``status``,
+    ``code`` and ``message``, None when absent.
+    """
+    for event, element in cElementTree.iterparse(StringIO(_retorno(data))):
+        if _local(element.tag) in RECORDS:
+            yield _record(element)
+            # Drop the parsed subtree, keeping memory flat
+            element.clear()
+
+
+def iter_sent(data):
+    """Yield ``(numero_rps, numero_nfe, codigo_verificacao)`` of the RPS
+    a response reports as converted into NFS-e"""
+    for record in iter_records(data):
+        if record['kind'] in ('ChaveNFeRPS', 'NFe') and \
+                record['numero_nfe']:
+            yield (record['numero_rps'], int(record['numero_nfe']),
+                   record['codigo_verificacao'])
+
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""In-memory construction of RPS and lot headers from prefetched data"""
+
+import hashlib
+import json
+import re
+
+from osv import osv
+
+# IBGE code of São Paulo within its state
+SAO_PAULO = '50308'
+
+IMPOSTOS = ('pis', 'cofins', 'inss', 'ir', 'csll', 'iss', 'iss_retido')
+
+# Invoice fields holding the snapshot itself, left out of its hash
+SNAPSHOT_FIELDS = ('nfse_rps', 'nfse_rps_hash')
+
+# Confirmed service invoices whose NFS-e is still to be sent, the condition
+# of the partial index account_invoice_nfse_unsent_idx
+UNSENT_INVOICES = """fiscal_type = 'service'
+          AND state IN ('open', 'sefaz_export', 'paid')
+          AND (nfse_status IS NULL
+               OR nfse_status IN ('pending', 'send_failed'))"""
+
+
+def only_digits(value):
+    return re.sub('[^0-9]', '', value or '')
+
+
+def _city_code(address):
+    return address and address['city'] and address['city']['ibge_code'] or None
+
+
+def build_rps(inv):
+    """Return the RPS dict of an invoice loaded by prefetch_send_data"""
+    company = inv['company']
+    partner = inv['partner']
+    partner_addr = partner['address'] or {}
+
+    if partner_addr.get('city') and partner_addr.get('state'):
+        city_ibge_code = str(partner_addr['state']['ibge_code']) + \
+            str(partner_addr['city']['ibge_code'])
+    else:
+        city_ibge_code = None
+
+    valor_servicos = inv['amount_untaxed']
+    valor_deducoes = 0
+    if inv['amount_tax'] < 0:
+        valor_deducoes = inv['amount_tax'] * -1
+
+    valores = dict((x, 0) for x in IMPOSTOS)
+    aliquota = 0
+
+    for inv_tax in inv['taxes']:
+        if inv_tax['domain'] in IMPOSTOS:
+            valores[inv_tax['domain']] += round(inv_tax['amount'], 2)
+            if inv_tax['domain'] == 'iss':
+                aliquota = round(inv_tax['aliquota'], 2)
+
+    iss_retido = valores['iss_retido'] < 0
+
+    discriminacao = '|'.join(inv['lines'])
+
+    inscricao_municipal_tomador = partner['inscr_mun']
+
+    # São Paulo
+    if _city_code(company['address']) == SAO_PAULO:
+        if _city_code(partner_addr) == SAO_PAULO and \
+            not inscricao_municipal_tomador:
+            raise osv.except_osv(
+                u'Faltam dados no cadastro do tomador.',
+                u'Informe a inscrição municipal do parceiro %s.' %
+                partner['name'],
+                )
+        elif _city_code(partner_addr) != SAO_PAULO:
+            inscricao_municipal_tomador = None
+
+    service_code = inv['fiscal_operation']['code']
+
+    if partner['cnpj_cpf']:
+        cnpj_tomador = only_digits(partner['cnpj_cpf'])
+    else:
+        raise osv.except_osv(
+            u'Faltam dados no cadastro do cliente.',
+            u'O CNPJ do cliente %s é obrigatório.' % partner['name'],
+            )
+
+    return {
+        # FIXME: por enquanto somente RPS suportado
+        'TipoRPS': 'RPS',
+        'DataEmissao': inv['date_invoice'],
+        # TODO: tpStatusNFe
+        'StatusRPS': 'N',
+        'TributacaoRPS': company['tributacao'] or 'T',
+        'ValorServicos': valor_servicos,
+        'ValorDeducoes': valor_deducoes,
+        'ValorPIS': valores['pis'],
+        'ValorCOFINS': valores['cofins'],
+        'ValorINSS': valores['inss'],
+        'ValorIR': valores['ir'],
+        'ValorCSLL': valores['csll'],
+        'CodigoServico': int(service_code),
+        'AliquotaServicos': aliquota,
+        'ISSRetido': iss_retido,
+        'CPFCNPJTomador': cnpj_tomador,
+        'TipoInscricaoTomador': partner['tipo_pessoa'],
+        'InscricaoMunicipalTomador': inscricao_municipal_tomador,
+        'InscricaoEstadualTomador': partner['inscr_est'] or None,
+        'RazaoSocialTomador': partner['legal_name'],
+        'Logradouro': partner_addr.get('street'),
+        'NumeroEndereco': partner_addr.get('number'),
+        'ComplementoEndereco': partner_addr.get('street2'),
+        'Bairro': partner_addr.get('district'),
+        'Cidade': city_ibge_code,
+        'UF': partner_addr.get('state') and \
+            partner_addr['state']['code'] or None,
+        'CEP': partner_addr.get('zip'),
+        'EmailTomador': partner_addr.get('email'),
+        'Discriminacao': discriminacao,
+        'SerieRPS': int(inv['document_serie']['code']),
+        'NumeroRPS': inv['internal_number'],
+        }
+
+
+def check_remetente(company):
+    if not company['cnpj']:
+        raise osv.except_osv(
+            u'Faltam dados no cadastro da empresa.',
+            u'O CNPJ da empresa %s é obrigatório.' % company['name'],
+            )
+
+
+def input_hash(inv):
+    """Hash of everything build_rps reads from a prefetched invoice"""
+    data = dict((k, v) for k, v in inv.items() if k not in SNAPSHOT_FIELDS)
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str)
+                        ).hexdigest()
+
+
+def snapshot_rps(inv):
+    """Return ``(rps_json, hash)`` to be stored on the invoice"""
+    return json.dumps(build_rps(inv)), input_hash(inv)
+
+
+def get_rps(inv):
+    """Return the stored RPS of an invoice, or build it when there is none
+
+    Writes to the data an RPS is built from discard the stored ones, see
+    discard_snapshots, so a stored RPS is trusted as is.
+    """
+    if inv.get('nfse_rps'):
+        return json.loads(inv['nfse_rps'])
+    return build_rps(inv)
+
+
+def discard_snapshots(cr, condition, params=()):
+    """Clear the stored RPS of the unsent invoices matching ``condition``,
+    an SQL expression on account_invoice; they are built again when sent"""
+    cr.execute("""
+        UPDATE account_invoice SET nfse_rps = NULL, nfse_rps_hash = NULL
+        WHERE nfse_rps IS NOT NULL
+          AND """ + UNSENT_INVOICES + """
+          AND """ + condition, params)
+
+
+def build_cabecalho(company, lote_rps):
+    """Return the header of a lot made of ``lote_rps``"""
+    check_remetente(company)
+
+    datas = sorted(rps['DataEmissao'] for rps in lote_rps)
+
+    return {
+        'CPFCNPJRemetente': only_digits(company['cnpj']),
+        'InscricaoMunicipalPrestador': only_digits(company['inscr_mun']),
+        'transacao': True,
+        'dtInicio': datas[0],
+        'dtFim': datas[-1],
+        'QtdRPS': len(lote_rps),
+        'ValorTotalServicos': sum(rps['ValorServicos'] for rps in lote_rps),
+        'ValorTotalDeducoes': sum(rps['ValorDeducoes'] for rps in lote_rps),
+        'Versao': 1,
+        }
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Rate limiting and adaptive concurrency of calls to the web services"""
+
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import exclusive
+from config import get_param
+from lazy import pysped
+
+# Seconds over which the observed call rate is computed
+RATE_WINDOW = 60
+
+
+class Scheduler(object):
+    """Token bucket and AIMD concurrency limit for one endpoint.
+
+    Calls start at most ``rate`` per second, with bursts of ``burst``, and
+    at most ``limit`` of them are in flight. The limit grows by one per
+    round of calls answered within ``target_latency`` seconds and is
+    halved, at most once per round, when a call fails to communicate or
+    answers slower than that.
+    """
+
+    def __init__(self, rate=5.0, burst=10, max_concurrency=8,
+                 target_latency=5.0):
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.limit = max(1.0, max_concurrency / 2.0)
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self.waiting = 0
+        self.calls = 0
+        self.errors = 0
+        self.latency = None
+        self._refilled = time.time()
+        self._decreased = 0
+        self._completed = collections.deque()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self):
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    self._refill(time.time())
+                    if self.in_flight >= int(self.limit):
+                        self._cond.wait()
+                    elif self.tokens < 1:
+                        self._cond.wait((1 - self.tokens) / self.rate)
+                    else:
+                        break
+            finally:
+                self.waiting -= 1
+            self.tokens -= 1
+            self.in_flight += 1
+
+    def release(self, latency, failed):
+        with self._cond:
+            now = time.time()
+            self.in_flight -= 1
+            self.calls += 1
+            self._completed.append(now)
+
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+            if failed or latency > self.target_latency:
+                self.errors += failed and 1 or 0
+                # One decrease per round trip, not one per failed call
+                if now - self._decreased > self.latency:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._decreased = now
+            else:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1.0 / self.limit)
+
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        start = time.time()
+        failed = False
+        try:
+            yield
+        except pysped.CommunicationError:
+            failed = True
+            raise
+        finally:
+            self.release(time.time() - start, failed)
+
+    def status(self):
+        """Return the current rate, limits and queue depth"""
+        with self._cond:
+            now = time.time()
+            while self._completed and \
+                    self._completed[0] < now - RATE_WINDOW:
+                self._completed.popleft()
+            self._refill(now)
+            return {
+                'rate': len(self._completed) / float(RATE_WINDOW),
+                'max_rate': self.rate,
+                'tokens': self.tokens,
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'calls': self.calls,
+                'errors': self.errors,
+                'latency': self.latency or 0.0,
+                }
+
+
+class SchedulerRegistry(object):
+    """One scheduler per endpoint and certificate, shared by all threads"""
+
+    def __init__(self):
+        self._schedulers = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, certificate):
+        key = (endpoint, certificate)
+        with self._lock:
+            if key not in self._schedulers:
+                self._schedulers[key] = Scheduler(
+                    get_param('rate_limit', 5.0),
+                    get_param('rate_burst', 10),
+                    get_param('max_workers', 8),
+                    get_param('target_latency', 5.0),
+                    )
+            return self._schedulers[key]
+
+    def status(self):
+        """Return ``[(endpoint, certificate, status)]``"""
+        with self._lock:
+            items = self._schedulers.items()
+        return [(endpoint, certificate, scheduler.status())
+                for (endpoint, certificate), scheduler in items]
+
+
+def throttled(processor, method, *args, **kwargs):
+    """Call ``method`` of ``processor`` through its scheduler, on a
+    processor used by no other thread meanwhile"""
+    scheduler = getattr(processor, 'nfse_scheduler', None)
+    with exclusive(processor) as lent:
+        func = getattr(lent, method)
+        if scheduler is None:
+            return func(*args, **kwargs)
+        with scheduler.slot():
+            return func(*args, **kwargs)
+
+
+schedulers = SchedulerRegistry()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Timing of the phases of NFS-e operations.
+
+An operation (send, test, cancel, check...) collects spans, one per phase
+and call, from every thread working for it::
+
+    op = Operation('send')
+    with bound(op):
+        with span('db_read'):
+            ...
+
+Worker threads started by run_concurrently and pipeline inherit the
+operation of the thread that started them. Outside an operation, span()
+does nothing.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class Operation(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, phase, duration, count=1):
+        with self._lock:
+            self.spans.append((phase, duration, count))
+
+    def summary(self):
+        """Return ``{phase: (total seconds, calls, items)}``"""
+        result = {}
+        for phase, duration, count in self.spans:
+            total, calls, items = result.get(phase, (0.0, 0, 0))
+            result[phase] = (total + duration, calls + 1, items + count)
+        return result
+
+
+def current():
+    return getattr(_local, 'operation', None)
+
+
+@contextmanager
+def bound(operation):
+    """Make ``operation`` the current one in this thread"""
+    previous = current()
+    _local.operation = operation
+    try:
+        yield operation
+    finally:
+        _local.operation = previous
+
+
+@contextmanager
+def span(phase, count=1):
+    operation = current()
+    started = time.time()
+    try:
+        yield
+    finally:
+        if operation is not None:
+            operation.add(phase, time.time() - started, count)
+
+
+def instrumented(name):
+    """Run the decorated model method as operation ``name``, storing its
+    timings through l10n_br_nfse.timing"""
+    def decorator(method):
+        def wrapper(self, cr, *args, **kwargs):
+            return self.pool.get('l10n_br_nfse.timing').timed(
+                cr, name, method, self, cr, *args, **kwargs
+                )
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
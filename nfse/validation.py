@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Offline validation of RPS batches.
+
+Applies the business rules enforced when building the RPS plus the
+restrictions of the São Paulo schema (TiposNFe_v01.xsd) to a whole batch,
+reporting every problem of every invoice at once. The generated
+pysped_nfse.nfse_xsd bindings do not check the schema facets themselves,
+so those are listed here.
+"""
+
+import re
+
+from osv import osv
+
+from rps import SAO_PAULO, build_rps, only_digits
+
+
+def _digits(size_min, size_max):
+    pattern = re.compile(r'^[0-9]{%d,%d}$' % (size_min, size_max))
+    return lambda value: bool(pattern.match(str(value)))
+
+
+def _max_length(size):
+    return lambda value: len(value) <= size
+
+
+def _valor(value):
+    return value >= 0 and value < 10 ** 13 and round(value, 2) == value
+
+
+# RPS field: (check, description of the restriction)
+SCHEMA = {
+    'CPFCNPJTomador': (lambda v: len(v) in (11, 14) and v.isdigit(),
+                       u'deve ter 11 (CPF) ou 14 (CNPJ) dígitos'),
+    'InscricaoMunicipalTomador': (_digits(1, 8), u'deve ter até 8 dígitos'),
+    'NumeroRPS': (_digits(1, 12), u'deve ter até 12 dígitos'),
+    'SerieRPS': (lambda v: len(str(v)) <= 5, u'deve ter até 5 caracteres'),
+    'CodigoServico': (_digits(4, 5), u'deve ter 4 ou 5 dígitos'),
+    'Discriminacao': (lambda v: 0 < len(v) <= 2000,
+                      u'deve ter entre 1 e 2000 caracteres'),
+    'RazaoSocialTomador': (_max_length(75), u'deve ter até 75 caracteres'),
+    'Logradouro': (_max_length(50), u'deve ter até 50 caracteres'),
+    'NumeroEndereco': (_max_length(10), u'deve ter até 10 caracteres'),
+    'ComplementoEndereco': (_max_length(30), u'deve ter até 30 caracteres'),
+    'Bairro': (_max_length(30), u'deve ter até 30 caracteres'),
+    'Cidade': (_digits(7, 7), u'deve ter 7 dígitos'),
+    'UF': (lambda v: len(v) == 2, u'deve ter 2 caracteres'),
+    'CEP': (lambda v: len(only_digits(v)) == 8, u'deve ter 8 dígitos'),
+    'EmailTomador': (_max_length(75), u'deve ter até 75 caracteres'),
+    'ValorServicos': (_valor, u'deve ser um valor positivo'),
+    'ValorDeducoes': (_valor, u'deve ser um valor positivo'),
+    }
+
+REQUIRED = ('DataEmissao', 'NumeroRPS', 'SerieRPS', 'CodigoServico',
+            'CPFCNPJTomador', 'Discriminacao')
+
+
+def validate_company(company):
+    """Return the problems of a company as a list of messages"""
+    problems = []
+    cnpj = only_digits(company['cnpj'])
+    if not cnpj:
+        problems.append(u'O CNPJ da empresa %s é obrigatório.' %
+                        company['name'])
+    elif len(cnpj) != 14:
+        problems.append(u'O CNPJ da empresa %s deve ter 14 dígitos.' %
+                        company['name'])
+    if not _digits(1, 8)(only_digits(company['inscr_mun'])):
+        problems.append(u'A inscrição municipal da empresa %s deve ter ' %
+                        company['name'] + u'até 8 dígitos.')
+    return problems
+
+
+def validate_invoice(inv):
+    """Return the problems of a prefetched invoice as a list of messages"""
+    problems = []
+    partner = inv['partner']
+    partner_addr = partner['address'] or {}
+    company_addr = inv['company']['address'] or {}
+
+    if inv['fiscal_type'] != 'service':
+        problems.append(u'A fatura não é de serviço.')
+    if not partner['cnpj_cpf']:
+        problems.append(u'O CNPJ do cliente %s é obrigatório.' %
+                        partner['name'])
+
+    city_code = lambda addr: addr.get('city') and addr['city']['ibge_code']
+    if city_code(company_addr) == SAO_PAULO and \
+            city_code(partner_addr) == SAO_PAULO and not partner['inscr_mun']:
+        problems.append(u'Informe a inscrição municipal do parceiro %s.' %
+                        partner['name'])
+
+    if not inv['fiscal_operation'] or \
+            not only_digits(inv['fiscal_operation']['code']):
+        problems.append(u'A operação fiscal deve ter um código de serviço '
+                        u'numérico.')
+    if not inv['document_serie'] or \
+            not only_digits(inv['document_serie']['code']):
+        problems.append(u'A série do documento deve ter código numérico.')
+
+    if problems:
+        return problems
+
+    try:
+        rps = build_rps(inv)
+    except (osv.except_osv, ValueError, TypeError), e:
+        return [getattr(e, 'value', None) or unicode(e)]
+
+    for field in REQUIRED:
+        if rps.get(field) in (None, ''):
+            problems.append(u'O campo %s é obrigatório.' % field)
+
+    for field, (check, description) in SCHEMA.items():
+        value = rps.get(field)
+        if value in (None, ''):
+            continue
+        if not check(value):
+            problems.append(u'O campo %s %s.' % (field, description))
+
+    return problems
+
+
+def validate_batch(invoices):
+    """Validate prefetched invoices
+
+    Returns ``{invoice_id: [messages]}`` holding only invoices with
+    problems; company problems are reported on each of their invoices.
+    """
+    result = {}
+    company_problems = {}
+
+    for inv in invoices:
+        company = inv['company']
+        if company['id'] not in company_problems:
+            company_problems[company['id']] = validate_company(company)
+
+        problems = company_problems[company['id']] + validate_invoice(inv)
+        if problems:
+            result[inv['id']] = problems
+
+    return result
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Bounded thread pool for calls to the NFS-e web services"""
+
+import Queue
+import sys
+import threading
+
+import timing
+
+
+def run_concurrently(func, items, max_workers=4):
+    """Call ``func`` on every item using at most ``max_workers`` threads.
+
+    Returns a list of ``(item, result, exc_info)`` in the order of ``items``,
+    where ``exc_info`` is the ``sys.exc_info()`` of a failed call or None.
+    A failing call does not stop the others.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue.Queue()
+
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    operation = timing.current()
+
+    def work():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (item, func(item), None)
+            except Exception:
+                results[index] = (item, None, sys.exc_info())
+
+    def worker():
+        with timing.bound(operation):
+            work()
+
+    workers = min(max_workers, len(items))
+
+    if workers <= 1:
+        work()
+    else:
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return results
+
+
+def reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
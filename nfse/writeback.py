@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Set-based updates of per-row values"""
+
+# Rows per UPDATE statement
+CHUNK_SIZE = 1000
+
+
+def update_rows(cr, table, columns, rows):
+    """Write a different value to each row with one statement per chunk
+
+    ``columns`` is a list of ``(name, sql_type)`` and ``rows`` a list of
+    tuples ``(id, value, ...)`` in the same order. The ORM is bypassed:
+    values shared by all rows, and ``write_date``, must be written with
+    ``write`` by the caller.
+    """
+    assignments = ', '.join('%s = v.%s::%s' % (name, name, sql_type)
+                            for name, sql_type in columns)
+    names = ', '.join(['id'] + [name for name, sql_type in columns])
+    placeholder = '(%s)' % ', '.join(['%s'] * (len(columns) + 1))
+
+    for start in xrange(0, len(rows), CHUNK_SIZE):
+        chunk = rows[start:start + CHUNK_SIZE]
+        cr.execute(
+            'UPDATE %s AS t SET %s FROM (VALUES %s) AS v(%s) '
+            'WHERE t.id = v.id' % (table, assignments,
+                                   ', '.join([placeholder] * len(chunk)),
+                                   names),
+            [value for row in chunk for value in row]
+            )
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+import base64
+import datetime
+import hashlib
+import zipfile
+import zlib
+
+# Archives read at once when exporting
+EXPORT_CHUNK = 50
+
+
+def decompress(value):
+    return value and zlib.decompress(base64.decodestring(value)) or ''
+
+
+class l10n_br_nfse_archive(osv.osv):
+    """Signed XML of the lots sent to the prefeitura
+
+    The request and the response of each lot are kept zlib-compressed and
+    linked to the lot's invoices. A request archived again, e.g. when a
+    lot is retried unchanged, is stored only once.
+    """
+
+    _name = 'l10n_br_nfse.archive'
+    _description = 'NFS-e XML archive'
+    _order = 'date desc, id desc'
+    _columns = {
+        'name': fields.char(u'Lote', size=64, readonly=True, select=True),
+        'company_id': fields.many2one('res.company', u'Empresa',
+                                      readonly=True, select=True),
+        'date': fields.datetime(u'Data', readonly=True, select=True),
+        'accepted': fields.boolean(u'Aceito', readonly=True),
+        'digest': fields.char(u'SHA-1 da requisição', size=40, readonly=True),
+        'request': fields.binary(u'Requisição (zlib)', readonly=True),
+        'response': fields.binary(u'Resposta (zlib)', readonly=True),
+        'size': fields.integer(u'Tamanho (bytes)', readonly=True),
+        'compressed_size': fields.integer(u'Tamanho compactado (bytes)',
+                                          readonly=True),
+        'invoice_ids': fields.many2many('account.invoice',
+                                        'l10n_br_nfse_archive_invoice_rel',
+                                        'archive_id', 'invoice_id',
+                                        u'Faturas', readonly=True),
+        }
+    _sql_constraints = [
+        ('digest_uniq', 'unique (company_id, digest)',
+         u'Esta requisição já foi arquivada.'),
+        ]
+
+    def store(self, cr, uid, company_id, name, request, response,
+              invoice_ids, accepted=True, context=None):
+        """Archive the XML of a lot, returning the archive id"""
+        if isinstance(request, unicode):
+            request = request.encode('utf-8')
+        if isinstance(response, unicode):
+            response = response.encode('utf-8')
+        request = request or ''
+        response = response or ''
+        digest = hashlib.sha1(request).hexdigest()
+
+        existing = self.search(cr, uid, [('company_id', '=', company_id),
+                                         ('digest', '=', digest)],
+                               context=context)
+        if existing:
+            self.write(cr, uid, existing, {
+                'invoice_ids': [(4, i) for i in invoice_ids],
+                }, context=context)
+            return existing[0]
+
+        packed_request = zlib.compress(request)
+        packed_response = zlib.compress(response)
+
+        return self.create(cr, uid, {
+            'name': name,
+            'company_id': company_id,
+            'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'accepted': accepted,
+            'digest': digest,
+            'request': base64.encodestring(packed_request),
+            'response': base64.encodestring(packed_response),
+            'size': len(request) + len(response),
+            'compressed_size': len(packed_request) + len(packed_response),
+            'invoice_ids': [(6, 0, invoice_ids)],
+            }, context=context)
+
+    def export_zip(self, cr, uid, fileobj, date_start, date_end,
+                   company_id=None, context=None):
+        """Write the XML archived in the period as a zip to ``fileobj``
+
+        Archives are read and decompressed a few at a time, so memory does
+        not depend on the size of the period. Returns the number of lots.
+        """
+        domain = [('date', '>=', date_start),
+                  ('date', '<=', date_end + ' 23:59:59')]
+        if company_id:
+            domain.append(('company_id', '=', company_id))
+        archive_ids = self.search(cr, uid, domain, order='id',
+                                  context=context)
+
+        context = dict(context or {}, bin_size=False)
+        export = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+
+        for start in xrange(0, len(archive_ids), EXPORT_CHUNK):
+            for archive in self.read(
+                    cr, uid, archive_ids[start:start + EXPORT_CHUNK],
+                    ['name', 'date', 'request', 'response'], context):
+                prefix = '%s_%s_%d' % (archive['date'][:10],
+                                       archive['name'] or 'lote',
+                                       archive['id'])
+                export.writestr(prefix + '_envio.xml',
+                                decompress(archive['request']))
+                export.writestr(prefix + '_retorno.xml',
+                                decompress(archive['response']))
+
+        export.close()
+        return len(archive_ids)
+
+
+l10n_br_nfse_archive()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+from nfse.cache import processor_cache, reference_cache
+
+CACHES = [
+    ('processor', u'Certificados e processadores', processor_cache),
+    ('reference', u'Cadastros fiscais do RPS', reference_cache),
+    ]
+
+
+class l10n_br_nfse_cache_status(osv.osv_memory):
+    """Size and hit ratio of the NFS-e caches
+
+    Rebuilt on every search, from the server process answering it.
+    """
+
+    _name = 'l10n_br_nfse.cache.status'
+    _description = 'NFS-e cache status'
+    _columns = {
+        'name': fields.char(u'Cache', size=64, readonly=True),
+        'size': fields.integer(u'Entradas', readonly=True),
+        'hits': fields.integer(u'Acertos', readonly=True),
+        'misses': fields.integer(u'Faltas', readonly=True),
+        'hit_ratio': fields.float(u'Taxa de acerto (%)', readonly=True),
+        }
+
+    def search(self, cr, uid, args, offset=0, limit=None, order=None,
+               context=None, count=False):
+        old_ids = super(l10n_br_nfse_cache_status, self).search(
+            cr, uid, [], context=context)
+        if old_ids:
+            self.unlink(cr, uid, old_ids, context=context)
+
+        for key, name, cache in CACHES:
+            lookups = cache.hits + cache.misses
+            self.create(cr, uid, {
+                'name': name,
+                'size': len(cache),
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'hit_ratio': lookups and 100.0 * cache.hits / lookups or 0.0,
+                }, context=context)
+
+        return super(l10n_br_nfse_cache_status, self).search(
+            cr, uid, args, offset, limit, order, context, count)
+
+
+l10n_br_nfse_cache_status()
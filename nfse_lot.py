@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+from nfse.lazy import pysped
+from nfse.config import get_param
+from nfse.batching import lot_sent
+from nfse.rps import only_digits
+from nfse.scheduler import throttled
+from nfse.workers import run_concurrently
+from nfse.timing import instrumented
+import datetime
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class l10n_br_nfse_lot(osv.osv):
+    """RPS lot submitted asynchronously
+
+    The prefeitura answers an asynchronous submission with a protocol only;
+    the poll_lots cron job asks for the processing status with exponential
+    backoff and applies the returned ChaveNFeRPS to the invoices. The job
+    ships inactive and is activated by the first lot registered, which
+    only a pysped_nfse able to submit asynchronously produces.
+    """
+
+    _name = 'l10n_br_nfse.lot'
+    _description = 'NFS-e lot'
+    _order = 'id desc'
+    _columns = {
+        'name': fields.char(u'Protocolo', size=64, required=True,
+                            readonly=True, select=True),
+        'company_id': fields.many2one('res.company', u'Empresa',
+                                      required=True, readonly=True),
+        'state': fields.selection([('submitted', u'Enviado'),
+                                   ('done', u'Processado'),
+                                   ('failed', u'Falhou'),
+                                   ], u'Situação', readonly=True,
+                                  select=True),
+        'invoice_ids': fields.many2many('account.invoice',
+                                        'l10n_br_nfse_lot_invoice_rel',
+                                        'lot_id', 'invoice_id',
+                                        u'Faturas', readonly=True),
+        'attempts': fields.integer(u'Consultas', readonly=True),
+        'next_poll': fields.datetime(u'Próxima consulta', readonly=True),
+        'message': fields.text(u'Mensagem', readonly=True),
+        'create_date': fields.datetime(u'Enviado em', readonly=True),
+        }
+    _defaults = {
+        'state': 'submitted',
+        'attempts': 0,
+        }
+
+    def register(self, cr, uid, company_id, protocol, invoice_ids,
+                 context=None):
+        lot_id = self.create(cr, uid, {
+            'name': protocol,
+            'company_id': company_id,
+            'invoice_ids': [(6, 0, invoice_ids)],
+            'next_poll': self._next_poll(0),
+            }, context=context)
+        cr.execute("""
+            UPDATE ir_cron SET active = True
+            WHERE model = %s AND function = 'poll_lots' AND NOT active
+            """, (self._name,))
+        return lot_id
+
+    def _next_poll(self, attempts):
+        delay = min(get_param('lot_poll_delay', 30) * 2 ** attempts,
+                    get_param('lot_max_poll_delay', 1800))
+        return (datetime.datetime.now() + datetime.timedelta(seconds=delay)
+                ).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _prepare_query(self, lot):
+        """Return the processor and request that poll ``lot``
+
+        Built on the main thread: browse records must not be read from the
+        worker threads.
+        """
+        manage_obj = self.pool.get('l10n_br_nfse.manage_nfse')
+        processor = manage_obj._get_processor(lot.company_id)
+        return processor, {
+            'CPFCNPJRemetente': only_digits(lot.company_id.cnpj),
+            'NumeroLote': lot.name,
+            'Versao': 1,
+            }
+
+    def _apply(self, cr, uid, lot, response, context=None):
+        manage_obj = self.pool.get('l10n_br_nfse.manage_nfse')
+        queue_obj = self.pool.get('l10n_br_nfse.queue')
+        journal = self.pool.get('l10n_br_nfse.transmission')
+        success, res, warnings, errors = response
+
+        invoice_rps = dict((inv.internal_number,
+                            {'id': inv.id, 'number': inv.number})
+                           for inv in lot.invoice_ids)
+
+        if success and getattr(res, 'ChaveNFeRPS', None):
+            sent_ids = manage_obj._write_send_result(
+                cr, uid, lot_sent(res), invoice_rps, context
+                )
+            journal.settle_sent(cr, uid, sent_ids, lot.name, context)
+            manage_obj._write_warnings(cr, uid, invoice_rps, warnings,
+                                       context)
+            message = manage_obj._format_messages(warnings, {})
+            self.write(cr, uid, lot.id, {'state': 'done',
+                                         'message': message},
+                       context=context)
+            queue_obj.finish_invoices(cr, uid, sent_ids, 'done',
+                                      context=context)
+
+        elif success:
+            # Still being processed by the prefeitura
+            self.write(cr, uid, lot.id, {
+                'attempts': lot.attempts + 1,
+                'next_poll': self._next_poll(lot.attempts + 1),
+                }, context=context)
+
+        else:
+            message = manage_obj._format_messages(warnings, errors)
+            invoice_ids = [inv.id for inv in lot.invoice_ids]
+            self.write(cr, uid, lot.id, {'state': 'failed',
+                                         'message': message},
+                       context=context)
+            self.pool.get('account.invoice').write(
+                cr, uid, invoice_ids, {'nfse_retorno': message[:256]},
+                context=context
+                )
+            queue_obj.finish_invoices(cr, uid, invoice_ids, 'failed',
+                                      message, context)
+            journal.settle(cr, uid, invoice_ids, {'state': 'rejected',
+                                                  'message': message},
+                           context)
+
+    @instrumented('poll')
+    def poll_lots(self, cr, uid, context=None):
+        """Cron job: check the processing status of submitted lots"""
+        lot_ids = self.search(cr, uid, [
+            ('state', '=', 'submitted'),
+            ('next_poll', '<=',
+             datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+            ], context=context)
+        lots = self.browse(cr, uid, lot_ids, context=context)
+        calls = [(lot,) + self._prepare_query(lot) for lot in lots]
+
+        def query(call):
+            lot, processor, request = call
+            return throttled(processor, 'consultar_lote', request)
+
+        for call, response, exc_info in run_concurrently(
+                query, calls, get_param('max_workers', 8)):
+            lot = call[0]
+
+            if exc_info is None:
+                self._apply(cr, uid, lot, response, context)
+                continue
+
+            if not isinstance(exc_info[1], pysped.CommunicationError):
+                _logger.error('NFS-e lot %s could not be polled', lot.name,
+                              exc_info=exc_info)
+            self.write(cr, uid, lot.id, {
+                'attempts': lot.attempts + 1,
+                'next_poll': self._next_poll(lot.attempts + 1),
+                }, context=context)
+
+        return True
+
+
+l10n_br_nfse_lot()
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+from nfse.config import get_param
+from nfse.timing import instrumented
+from wizard.manage_nfse import UNSENT_STATES, ServerUnavailable
+import datetime
+import logging
+
+_logger = logging.getLogger(__name__)
+
+QUEUE_STATES = [
+    ('pending', u'Pendente'),
+    ('processing', u'Em processamento'),
+    ('done', u'Processada'),
+    ('failed', u'Falhou'),
+    ]
+
+
+class l10n_br_nfse_queue(osv.osv):
+    """NFS-e transmission queue
+
+    The manage_nfse wizard enqueues invoices and returns at once; the
+    process_queue cron job sends them in lots, retrying with exponential
+    backoff when the prefeitura cannot be reached. Companies emitting on
+    validation have their invoices queued by action_number and sent in
+    micro-batches by process_micro_batches.
+    """
+
+    _name = 'l10n_br_nfse.queue'
+    _description = 'NFS-e transmission queue'
+    _order = 'id'
+    _columns = {
+        'invoice_id': fields.many2one('account.invoice', u'Fatura',
+                                      required=True, ondelete='cascade',
+                                      readonly=True, select=True),
+        'company_id': fields.related('invoice_id', 'company_id',
+                                     type='many2one', relation='res.company',
+                                     string=u'Empresa', store=True,
+                                     readonly=True),
+        'state': fields.selection(QUEUE_STATES, u'Situação', readonly=True,
+                                  select=True),
+        'attempts': fields.integer(u'Tentativas', readonly=True),
+        'next_attempt': fields.datetime(u'Próxima tentativa', readonly=True),
+        'message': fields.text(u'Mensagem', readonly=True),
+        'create_date': fields.datetime(u'Criado em', readonly=True),
+        'write_date': fields.datetime(u'Atualizado em', readonly=True),
+        }
+    _defaults = {
+        'state': 'pending',
+        'attempts': 0,
+        }
+
+    def _set_state(self, cr, uid, ids, state, values=None, context=None):
+        """Update queue entries and mirror their state on the invoices"""
+        if not ids:
+            return
+        values = dict(values or {}, state=state)
+        self.write(cr, uid, ids, values, context=context)
+        invoice_ids = [q['invoice_id'][0] for q in
+                       self.read(cr, uid, ids, ['invoice_id'], context)]
+        self.pool.get('account.invoice').write(
+            cr, uid, invoice_ids, {'nfse_queue_state': state}, context=context
+            )
+
+    def enqueue(self, cr, uid, invoice_ids, context=None):
+        """Queue invoices for transmission, skipping those already queued"""
+        queued = self.search(cr, uid, [
+            ('invoice_id', 'in', invoice_ids),
+            ('state', 'in', ('pending', 'processing')),
+            ], context=context)
+        queued_invoices = set(q['invoice_id'][0] for q in
+                              self.read(cr, uid, queued, ['invoice_id'],
+                                        context))
+
+        new_ids = [self.create(cr, uid, {'invoice_id': invoice_id},
+                               context=context)
+                   for invoice_id in invoice_ids
+                   if invoice_id not in queued_invoices]
+        self._set_state(cr, uid, new_ids, 'pending', context=context)
+
+        return new_ids
+
+    def finish_invoices(self, cr, uid, invoice_ids, state, message=False,
+                        context=None):
+        """Close the entries still processing for the given invoices"""
+        entry_ids = self.search(cr, uid, [
+            ('invoice_id', 'in', invoice_ids),
+            ('state', '=', 'processing'),
+            ], context=context)
+        self._set_state(cr, uid, entry_ids, state, {'message': message},
+                        context)
+
+    def _backoff(self, attempts):
+        delay = get_param('queue_retry_delay', 60) * 2 ** (attempts - 1)
+        return min(delay, get_param('queue_max_retry_delay', 3600))
+
+    def _retry(self, cr, uid, entries, message, context=None):
+        """Schedule another attempt, giving up after too many"""
+        max_attempts = get_param('queue_max_attempts', 8)
+        now = datetime.datetime.now()
+
+        for entry in entries:
+            attempts = entry['attempts'] + 1
+            values = {'attempts': attempts, 'message': message}
+            if attempts >= max_attempts:
+                self._set_state(cr, uid, [entry['id']], 'failed', values,
+                                context)
+            else:
+                values['next_attempt'] = (
+                    now + datetime.timedelta(seconds=self._backoff(attempts))
+                    ).strftime('%Y-%m-%d %H:%M:%S')
+                self._set_state(cr, uid, [entry['id']], 'pending', values,
+                                context)
+
+    def _claim(self, cr, uid, limit, company_id=None, skip_fresh=False):
+        """Mark up to ``limit`` due entries as processing and return them,
+        only those of ``company_id`` if given
+
+        With ``skip_fresh``, entries of companies emitting on validation
+        are left to process_micro_batches while within their batch window.
+        """
+        cr.execute("""
+            UPDATE l10n_br_nfse_queue SET state = 'processing',
+                write_date = now() at time zone 'UTC'
+            WHERE id IN (
+                SELECT q.id FROM l10n_br_nfse_queue q
+                WHERE q.state = 'pending'
+                  AND (q.next_attempt IS NULL
+                       OR q.next_attempt <= now() at time zone 'UTC')
+                  AND (%s IS NULL OR q.company_id = %s)
+                  AND NOT (%s AND EXISTS (
+                      SELECT 1 FROM res_company c
+                      WHERE c.id = q.company_id
+                        AND c.nfse_auto_send
+                        AND q.create_date > now() at time zone 'UTC'
+                            - coalesce(c.nfse_batch_window, 0)
+                              * interval '1 second'))
+                ORDER BY q.id LIMIT %s
+                FOR UPDATE OF q)
+            RETURNING id
+            """, (company_id, company_id, skip_fresh, limit))
+        return [row[0] for row in cr.fetchall()]
+
+    def _due_batches(self, cr, uid, context=None):
+        """Return ``[(company_id, size)]`` of the companies emitting on
+        validation whose due entries fill a lot or have waited long
+        enough"""
+        cr.execute("""
+            SELECT c.id, c.nfse_batch_size
+            FROM l10n_br_nfse_queue q
+            JOIN res_company c ON c.id = q.company_id
+            WHERE c.nfse_auto_send
+              AND q.state = 'pending'
+              AND (q.next_attempt IS NULL
+                   OR q.next_attempt <= now() at time zone 'UTC')
+            GROUP BY c.id, c.nfse_batch_size, c.nfse_batch_window
+            HAVING count(*) >= coalesce(c.nfse_batch_size, 1)
+                OR min(q.create_date) <= now() at time zone 'UTC'
+                    - coalesce(c.nfse_batch_window, 0) * interval '1 second'
+            """)
+        return [(company_id, max(size or 0, 1))
+                for company_id, size in cr.fetchall()]
+
+    def _release_stale(self, cr, uid, context=None):
+        """Put back entries left processing by an interrupted worker
+
+        Entries of invoices in a lot still being polled stay processing on
+        purpose, however long the prefeitura takes.
+        """
+        cr.execute("""
+            UPDATE l10n_br_nfse_queue SET state = 'pending'
+            WHERE state = 'processing'
+              AND write_date < now() at time zone 'UTC' - interval '1 hour'
+              AND NOT EXISTS (
+                  SELECT 1 FROM l10n_br_nfse_lot_invoice_rel rel
+                  JOIN l10n_br_nfse_lot lot ON lot.id = rel.lot_id
+                  WHERE rel.invoice_id = l10n_br_nfse_queue.invoice_id
+                    AND lot.state = 'submitted')
+            """)
+
+    @instrumented('send')
+    def _process_entries(self, cr, uid, entry_ids, context=None):
+        manage_obj = self.pool.get('l10n_br_nfse.manage_nfse')
+        entries = self.read(cr, uid, entry_ids,
+                            ['invoice_id', 'attempts'], context)
+        self._set_state(cr, uid, entry_ids, 'processing', context=context)
+        entry_by_invoice = dict((e['invoice_id'][0], e) for e in entries)
+
+        to_send = self.pool.get('account.invoice').search(cr, uid, [
+            ('id', 'in', entry_by_invoice.keys()),
+            '|', ('nfse_status', '=', False),
+            ('nfse_status', 'in', UNSENT_STATES),
+            ], context=context)
+        self._set_state(
+            cr, uid, [e['id'] for i, e in entry_by_invoice.items()
+                      if i not in to_send], 'done', context=context
+            )
+        if not to_send:
+            return
+
+        invalid = {}
+        recovered = []
+        try:
+            results = manage_obj._send_invoices(
+                cr, uid, None, to_send, False, context, invalid, recovered
+                )
+        except ServerUnavailable, e:
+            self._retry(cr, uid, [entry_by_invoice[i] for i in to_send],
+                        e.value, context)
+            return
+        except osv.except_osv, e:
+            # Data errors are not fixed by waiting; invoices whose own data
+            # is wrong were already left out through ``invalid``
+            self._set_state(cr, uid, [entry_by_invoice[i]['id']
+                                      for i in to_send],
+                            'failed', {'message': e.value}, context)
+            return
+
+        self._set_state(cr, uid,
+                        [entry_by_invoice[i]['id'] for i in recovered],
+                        'done', {'message': False}, context)
+
+        for invoice_id, message in invalid.items():
+            self._set_state(cr, uid, [entry_by_invoice[invoice_id]['id']],
+                            'failed', {'message': message}, context)
+
+        for batch, outcome in results:
+            handled = set(outcome['sent_ids'])
+            self._set_state(
+                cr, uid, [entry_by_invoice[i]['id'] for i in handled],
+                'done', {'message': False}, context
+                )
+            warned = manage_obj._write_warnings(
+                cr, uid, batch['invoice_rps'], outcome['warnings'], context
+                )
+            for invoice_id, message in warned.items():
+                if invoice_id in entry_by_invoice:
+                    self.write(cr, uid, [entry_by_invoice[invoice_id]['id']],
+                               {'message': message}, context=context)
+            # Submitted lots stay processing until l10n_br_nfse.lot polls them
+            handled.update(outcome['submitted_ids'])
+
+            for chave in outcome['errors']:
+                invoice = batch['invoice_rps'].get(str(chave.NumeroRPS))
+                if invoice and invoice['id'] not in handled:
+                    handled.add(invoice['id'])
+                    self._set_state(
+                        cr, uid, [entry_by_invoice[invoice['id']]['id']],
+                        'failed', {'message': manage_obj._format_messages(
+                            {}, {chave: outcome['errors'][chave]}
+                            )}, context
+                        )
+
+            pending = [entry_by_invoice[inv['id']]
+                       for inv in batch['invoice_rps'].values()
+                       if inv['id'] not in handled]
+
+            if outcome['communication_error']:
+                e = outcome['communication_error']
+                self._retry(cr, uid, pending,
+                            u'Código: {}\nDescrição: {}'.format(e.status,
+                                                              e.reason),
+                            context)
+            elif outcome['exc_info']:
+                _logger.error('NFS-e queue batch failed',
+                              exc_info=outcome['exc_info'])
+                self._set_state(
+                    cr, uid, [e['id'] for e in pending], 'failed',
+                    {'message': unicode(outcome['exc_info'][1])}, context
+                    )
+            else:
+                self._set_state(
+                    cr, uid, [e['id'] for e in pending], 'failed',
+                    {'message': u'Lote rejeitado pela prefeitura.'}, context
+                    )
+
+    def process_micro_batches(self, cr, uid, context=None):
+        """Cron job: send the invoices of companies emitting on validation
+
+        Sends one lot of each company whose entries fill its lot size or
+        whose oldest entry waited its window. Returns at once when no
+        company emits on validation.
+        """
+        cr.execute("SELECT 1 FROM res_company WHERE nfse_auto_send LIMIT 1")
+        if not cr.fetchone():
+            return True
+
+        for company_id, size in self._due_batches(cr, uid, context):
+            entry_ids = self._claim(cr, uid, size, company_id)
+            if not entry_ids:
+                continue
+            cr.commit()
+
+            try:
+                self._process_entries(cr, uid, entry_ids, context)
+                cr.commit()
+            except Exception:
+                cr.rollback()
+                _logger.exception('NFS-e micro-batch failed')
+                self._set_state(cr, uid, entry_ids, 'failed',
+                                {'message': u'Erro interno ao processar.'},
+                                context)
+                cr.commit()
+
+        return True
+
+    def process_queue(self, cr, uid, context=None):
+        """Cron job: drain the queue in lots, committing after each one"""
+        lot_size = get_param('queue_lot_size', 200)
+        self._release_stale(cr, uid, context)
+
+        while True:
+            entry_ids = self._claim(cr, uid, lot_size, skip_fresh=True)
+            if not entry_ids:
+                break
+            cr.commit()
+
+            try:
+                self._process_entries(cr, uid, entry_ids, context)
+                cr.commit()
+            except Exception:
+                cr.rollback()
+                _logger.exception('NFS-e queue processing failed')
+                self._set_state(cr, uid, entry_ids, 'failed',
+                                {'message': u'Erro interno ao processar.'},
+                                context)
+                cr.commit()
+
+        return True
+
+
+l10n_br_nfse_queue()
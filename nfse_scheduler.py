@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+from nfse.scheduler import schedulers
+
+
+class l10n_br_nfse_scheduler_status(osv.osv_memory):
+    """Current state of the web service schedulers
+
+    Rebuilt from the schedulers on every search. They live in memory, so
+    with several server processes only the one answering is shown.
+    """
+
+    _name = 'l10n_br_nfse.scheduler.status'
+    _description = 'NFS-e scheduler status'
+    _order = 'endpoint, certificate'
+    _columns = {
+        'endpoint': fields.char(u'Servidor', size=128, readonly=True),
+        'certificate': fields.char(u'Certificado', size=40, readonly=True),
+        'rate': fields.float(u'Chamadas por segundo', readonly=True),
+        'max_rate': fields.float(u'Limite por segundo', readonly=True),
+        'limit': fields.integer(u'Chamadas simultâneas', readonly=True),
+        'in_flight': fields.integer(u'Em andamento', readonly=True),
+        'waiting': fields.integer(u'Na fila', readonly=True),
+        'calls': fields.integer(u'Chamadas', readonly=True),
+        'errors': fields.integer(u'Erros', readonly=True),
+        'latency': fields.float(u'Latência média (s)', readonly=True),
+        }
+
+    def search(self, cr, uid, args, offset=0, limit=None, order=None,
+               context=None, count=False):
+        old_ids = super(l10n_br_nfse_scheduler_status, self).search(
+            cr, uid, [], context=context)
+        if old_ids:
+            self.unlink(cr, uid, old_ids, context=context)
+
+        for endpoint, certificate, status in schedulers.status():
+            vals = dict((name, status[name]) for name in self._columns
+                        if name in status)
+            vals.update(endpoint=endpoint, certificate=certificate[:8])
+            self.create(cr, uid, vals, context=context)
+
+        return super(l10n_br_nfse_scheduler_status, self).search(
+            cr, uid, args, offset, limit, order, context, count)
+
+
+l10n_br_nfse_scheduler_status()
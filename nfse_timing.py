@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+from nfse.config import get_param
+from nfse import timing
+import logging
+import pooler
+import tools
+
+_logger = logging.getLogger(__name__)
+
+OPERATIONS = [
+    ('send', u'Envio'),
+    ('test', u'Teste de envio'),
+    ('cancel', u'Cancelamento'),
+    ('check', u'Consulta'),
+    ('poll', u'Consulta de lotes'),
+    ('reconcile', u'Conciliação'),
+    ]
+
+
+class l10n_br_nfse_timing(osv.osv):
+    """Duration of each phase of the NFS-e operations
+
+    Phases: db_read, certificate, health_check, build, transmit (which
+    includes the XML signature made by the processor) and write_back.
+    Rows older than l10n_br_nfse_timing_retention_days (30 by default)
+    are purged daily.
+    """
+
+    _name = 'l10n_br_nfse.timing'
+    _description = 'NFS-e timing'
+    _order = 'id desc'
+    _log_access = False
+    _columns = {
+        'date': fields.datetime(u'Data', readonly=True, select=True),
+        'operation': fields.selection(OPERATIONS, u'Operação',
+                                      readonly=True),
+        'phase': fields.char(u'Fase', size=32, readonly=True),
+        'duration': fields.float(u'Duração (ms)', readonly=True),
+        'calls': fields.integer(u'Chamadas', readonly=True),
+        'items': fields.integer(u'Itens', readonly=True),
+        }
+
+    def store(self, cr, operation):
+        """Log an operation and persist one row per phase
+
+        Rows are inserted on their own cursor so timings of operations
+        that end in an error are kept too. Operations that did no work,
+        such as a cron run finding nothing to do, are not kept.
+        """
+        summary = operation.summary()
+        if not [phase for phase in summary if phase != 'total']:
+            return
+
+        _logger.debug('NFS-e %s: %s', operation.name, ', '.join(
+            '%s %.1fms/%d' % (phase, total * 1000, items)
+            for phase, (total, calls, items) in sorted(summary.items())
+            ))
+
+        if not get_param('timing_store', True):
+            return
+
+        timing_cr = pooler.get_db(cr.dbname).cursor()
+        try:
+            for phase, (total, calls, items) in summary.items():
+                timing_cr.execute("""
+                    INSERT INTO l10n_br_nfse_timing
+                        (date, operation, phase, duration, calls, items)
+                    VALUES (now() at time zone 'UTC', %s, %s, %s, %s, %s)
+                    """, (operation.name, phase, total * 1000, calls, items))
+            timing_cr.commit()
+        finally:
+            timing_cr.close()
+
+    def timed(self, cr, name, func, *args, **kwargs):
+        """Call ``func`` as operation ``name`` and store its timings"""
+        operation = timing.Operation(name)
+        try:
+            with timing.bound(operation):
+                with timing.span('total'):
+                    return func(*args, **kwargs)
+        finally:
+            self.store(cr, operation)
+
+    def purge(self, cr, uid, context=None):
+        """Cron job: delete the timings older than the retention period"""
+        cr.execute("""
+            DELETE FROM l10n_br_nfse_timing
+            WHERE date < now() at time zone 'UTC' - %s * interval '1 day'
+            """, (get_param('timing_retention_days', 30),))
+        return True
+
+
+l10n_br_nfse_timing()
+
+
+class l10n_br_nfse_timing_report(osv.osv):
+    """Daily latency percentiles and throughput per operation and phase
+
+    Percentiles are interpolated by percentile_cont on PostgreSQL 9.4+ and
+    taken by nearest rank on older servers.
+    """
+
+    _name = 'l10n_br_nfse.timing.report'
+    _description = 'NFS-e timing report'
+    _auto = False
+    _order = 'day desc, operation, phase'
+    _columns = {
+        'day': fields.date(u'Dia', readonly=True),
+        'operation': fields.selection(OPERATIONS, u'Operação',
+                                      readonly=True),
+        'phase': fields.char(u'Fase', size=32, readonly=True),
+        'runs': fields.integer(u'Execuções', readonly=True),
+        'items': fields.integer(u'Itens', readonly=True),
+        'p50': fields.float(u'p50 (ms)', readonly=True),
+        'p95': fields.float(u'p95 (ms)', readonly=True),
+        'throughput': fields.float(u'Itens por segundo', readonly=True),
+        }
+
+    def init(self, cr):
+        tools.drop_view_if_exists(cr, 'l10n_br_nfse_timing_report')
+
+        cr.execute("SHOW server_version_num")
+        if int(cr.fetchone()[0]) >= 90400:
+            percentile = """percentile_cont(%s)
+                        WITHIN GROUP (ORDER BY duration)"""
+        else:
+            percentile = """(array_agg(duration ORDER BY duration))[
+                        greatest(ceil(%s * count(*))::integer, 1)]"""
+
+        cr.execute("""
+            CREATE VIEW l10n_br_nfse_timing_report AS (
+                SELECT min(id) AS id,
+                    date_trunc('day', date)::date AS day,
+                    operation,
+                    phase,
+                    count(*) AS runs,
+                    sum(items) AS items,
+                    %s AS p50,
+                    %s AS p95,
+                    CASE WHEN sum(duration) > 0
+                        THEN sum(items) / (sum(duration) / 1000.0)
+                        ELSE 0 END AS throughput
+                FROM l10n_br_nfse_timing
+                GROUP BY date_trunc('day', date), operation, phase
+            )""" % (percentile % 0.5, percentile % 0.95))
+
+
+l10n_br_nfse_timing_report()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+import pooler
+from nfse.writeback import update_rows
+
+JOURNAL_STATES = [
+    ('sent', u'Enviado'),
+    ('accepted', u'Aceito'),
+    ('rejected', u'Rejeitado'),
+    ('error', u'Erro de comunicação'),
+    ]
+
+
+class l10n_br_nfse_transmission(osv.osv):
+    """Journal of RPS transmissions
+
+    One entry per invoice and attempt. Entries are written on a separate
+    cursor and committed at once, so they survive the rollback of the
+    transaction that sent the RPS: an invoice whose RPS the prefeitura
+    accepted is never sent again, and an attempt without outcome is
+    checked remotely before resending.
+
+    ``invoice_id`` is a plain integer: a foreign key would make the journal
+    transaction wait for the lock that the sending transaction holds on the
+    invoice row (PostgreSQL < 9.3), which never comes. ``invoice_ref_id``
+    shows it as a link.
+    """
+
+    _name = 'l10n_br_nfse.transmission'
+    _description = 'NFS-e transmission journal'
+    _order = 'id desc'
+    def _get_invoice_ref(self, cr, uid, ids, name, arg, context=None):
+        entries = self.read(cr, uid, ids, ['invoice_id'], context=context)
+        existing = set()
+        if entries:
+            cr.execute("SELECT id FROM account_invoice WHERE id IN %s",
+                       (tuple(e['invoice_id'] for e in entries),))
+            existing = set(row[0] for row in cr.fetchall())
+        return dict((e['id'], e['invoice_id'] in existing and
+                     e['invoice_id'] or False) for e in entries)
+
+    def _search_invoice_ref(self, cr, uid, obj, name, args, context=None):
+        domain = []
+        for field, operator, value in args:
+            if isinstance(value, basestring):
+                value = [i for i, label in
+                         self.pool.get('account.invoice').name_search(
+                             cr, uid, value, operator=operator,
+                             context=context, limit=None)]
+                operator = 'in'
+            domain.append(('invoice_id', operator, value))
+        return domain
+
+    _columns = {
+        'invoice_id': fields.integer(u'Id da fatura', required=True,
+                                     readonly=True, select=True),
+        'invoice_ref_id': fields.function(
+            _get_invoice_ref, fnct_search=_search_invoice_ref,
+            type='many2one', relation='account.invoice', string=u'Fatura',
+            ),
+        'company_id': fields.many2one('res.company', u'Empresa',
+                                      readonly=True),
+        'lot': fields.char(u'Lote', size=64, readonly=True),
+        'numero_rps': fields.char(u'Número do RPS', size=32, readonly=True),
+        'attempt': fields.integer(u'Tentativa', readonly=True),
+        'state': fields.selection(JOURNAL_STATES, u'Resultado',
+                                  readonly=True, select=True),
+        'nfse_numero': fields.integer(u'Número da NFS-e', readonly=True),
+        'nfse_codigo_verificacao': fields.char(u'Código de Verificação',
+                                               size=128, readonly=True),
+        'message': fields.text(u'Mensagem', readonly=True),
+        'create_date': fields.datetime(u'Data', readonly=True),
+        }
+    _defaults = {
+        'state': 'sent',
+        }
+
+    def _run(self, cr, func):
+        """Run ``func(journal_cr)`` on its own committed transaction"""
+        journal_cr = pooler.get_db(cr.dbname).cursor()
+        try:
+            result = func(journal_cr)
+            journal_cr.commit()
+            return result
+        finally:
+            journal_cr.close()
+
+    def start(self, cr, uid, invoices, context=None):
+        """Record a new attempt for each invoice before it is transmitted
+
+        ``invoices`` is a list of prefetched invoice dicts.
+        """
+        if not invoices:
+            return
+
+        def start(journal_cr):
+            journal_cr.execute("""
+                SELECT invoice_id, count(*) FROM l10n_br_nfse_transmission
+                WHERE invoice_id IN %s GROUP BY invoice_id
+                """, (tuple(inv['id'] for inv in invoices),))
+            attempts = dict(journal_cr.fetchall())
+
+            for inv in invoices:
+                self.create(journal_cr, uid, {
+                    'invoice_id': inv['id'],
+                    'company_id': inv['company']['id'],
+                    'numero_rps': inv['internal_number'],
+                    'attempt': attempts.get(inv['id'], 0) + 1,
+                    }, context=context)
+
+        self._run(cr, start)
+
+    def settle(self, cr, uid, invoice_ids, values, context=None):
+        """Update the open attempts of the given invoices"""
+        if not invoice_ids:
+            return
+
+        def settle(journal_cr):
+            entry_ids = self.search(journal_cr, uid, [
+                ('invoice_id', 'in', list(invoice_ids)),
+                ('state', '=', 'sent'),
+                ], context=context)
+            if entry_ids:
+                self.write(journal_cr, uid, entry_ids, values,
+                           context=context)
+
+        self._run(cr, settle)
+
+    def settle_sent(self, cr, uid, invoice_ids, lot=None, context=None):
+        """Mark invoices just written as sent as accepted, keeping the
+        NFS-e number and verification code they received"""
+        if not invoice_ids:
+            return
+
+        keys = dict(
+            (inv['id'], (inv['nfse_numero'], inv['nfse_codigo_verificacao']))
+            for inv in self.pool.get('account.invoice').read(
+                cr, uid, invoice_ids,
+                ['nfse_numero', 'nfse_codigo_verificacao'], context=context)
+            )
+        values = {'state': 'accepted', 'message': False}
+        if lot:
+            values['lot'] = lot
+
+        def settle_sent(journal_cr):
+            entry_ids = self.search(journal_cr, uid, [
+                ('invoice_id', 'in', list(invoice_ids)),
+                ('state', '=', 'sent'),
+                ], context=context)
+            if not entry_ids:
+                return
+            entries = self.read(journal_cr, uid, entry_ids, ['invoice_id'],
+                                context=context)
+            update_rows(journal_cr, self._table,
+                        [('nfse_numero', 'integer'),
+                         ('nfse_codigo_verificacao', 'varchar')],
+                        [(e['id'],) + keys[e['invoice_id']]
+                         for e in entries])
+            self.write(journal_cr, uid, entry_ids, values, context=context)
+
+        self._run(cr, settle_sent)
+
+    def recover(self, cr, uid, invoice_ids, context=None):
+        """Look up the latest attempt of each invoice
+
+        Returns ``(accepted, in_doubt)``: the accepted entries by invoice id,
+        and the ids of invoices whose latest attempt has no outcome.
+        """
+        accepted = {}
+        in_doubt = []
+
+        if not invoice_ids:
+            return accepted, in_doubt
+
+        cr.execute("""
+            SELECT DISTINCT ON (invoice_id) invoice_id, state, nfse_numero,
+                nfse_codigo_verificacao
+            FROM l10n_br_nfse_transmission
+            WHERE invoice_id IN %s
+            ORDER BY invoice_id, id DESC
+            """, (tuple(invoice_ids),))
+
+        for invoice_id, state, numero, codigo in cr.fetchall():
+            if state == 'accepted':
+                accepted[invoice_id] = {
+                    'nfse_numero': numero,
+                    'nfse_codigo_verificacao': codigo,
+                    }
+            elif state == 'sent':
+                in_doubt.append(invoice_id)
+
+        return accepted, in_doubt
+
+
+l10n_br_nfse_transmission()
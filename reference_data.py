@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import osv
+from nfse.cache import reference_cache
+from nfse.rps import discard_snapshots
+
+# Invoices whose partner, or the partner of whose company, has an address
+# with ``{field}`` in %(ids)s
+BY_ADDRESS = """(partner_id IN (
+        SELECT partner_id FROM res_partner_address WHERE {field} IN %(ids)s)
+    OR company_id IN (
+        SELECT c.id FROM res_company c
+        JOIN res_partner_address a ON a.partner_id = c.partner_id
+        WHERE a.{field} IN %(ids)s))"""
+
+
+class reference_cache_invalidation(object):
+    """Drop the changed records from the reference cache of RPS building
+
+    The stored RPS of the unsent invoices using them, as selected by
+    ``_invoice_condition`` (an SQL expression on account_invoice taking
+    ``%(ids)s``), are discarded too.
+    """
+
+    _invoice_condition = None
+
+    def _invalidate(self, cr, ids):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        reference_cache.invalidate(cr, self._name, ids)
+        if ids:
+            discard_snapshots(cr, self._invoice_condition,
+                              {'ids': tuple(ids)})
+        return ids
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(reference_cache_invalidation, self).write(
+            cr, uid, ids, vals, context)
+        self._invalidate(cr, ids)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        ids = self._invalidate(cr, ids)
+        return super(reference_cache_invalidation, self).unlink(
+            cr, uid, ids, context)
+
+
+class res_country_state(reference_cache_invalidation, osv.osv):
+    _inherit = 'res.country.state'
+    _invoice_condition = BY_ADDRESS.format(field='state_id')
+
+
+res_country_state()
+
+
+class l10n_br_base_city(reference_cache_invalidation, osv.osv):
+    _inherit = 'l10n_br_base.city'
+    _invoice_condition = BY_ADDRESS.format(field='l10n_br_city_id')
+
+
+l10n_br_base_city()
+
+
+class l10n_br_account_fiscal_operation(reference_cache_invalidation,
+                                       osv.osv):
+    _inherit = 'l10n_br_account.fiscal.operation'
+    _invoice_condition = 'fiscal_operation_id IN %(ids)s'
+
+
+l10n_br_account_fiscal_operation()
+
+
+class l10n_br_account_document_serie(reference_cache_invalidation, osv.osv):
+    _inherit = 'l10n_br_account.document.serie'
+    _invoice_condition = 'document_serie_id IN %(ids)s'
+
+
+l10n_br_account_document_serie()
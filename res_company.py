@@ -22,6 +22,13 @@
 ##############################################################################
 
 from osv import fields, osv
+from nfse.cache import processor_cache
+from nfse.rps import discard_snapshots
+
+# Fields whose change must discard the cached NFS-e processor
+CERTIFICATE_FIELDS = ('nfse_cert_file', 'nfse_cert_password')
+# Fields whose change must discard the RPS stored on unsent invoices
+RPS_FIELDS = ('tributacao', 'partner_id')
 
 
 class res_company(osv.osv):
@@ -35,10 +42,39 @@ class res_company(osv.osv):
              ),
             u'Tributação',
             ),
+        'nfse_auto_send': fields.boolean(
+            u'Emitir NFS-e ao confirmar',
+            help=u'Coloca as faturas de serviço na fila de transmissão ao '
+                 u'confirmá-las; elas são enviadas em pequenos lotes.',
+            ),
+        'nfse_batch_window': fields.integer(
+            u'Espera máxima do lote (s)',
+            help=u'Tempo máximo que uma fatura aguarda outras para formar '
+                 u'um lote; os lotes são verificados a cada minuto.',
+            ),
+        'nfse_batch_size': fields.integer(
+            u'Tamanho do lote',
+            help=u'Quantidade de faturas que dispara o envio sem esperar.',
+            ),
         }
     _defaults = {
         'tributacao': 'T',
+        'nfse_auto_send': False,
+        'nfse_batch_window': 30,
+        'nfse_batch_size': 50,
         }
 
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(res_company, self).write(cr, uid, ids, vals, context)
+
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if any(field in vals for field in CERTIFICATE_FIELDS):
+            processor_cache.invalidate(ids)
+        if ids and any(field in vals for field in RPS_FIELDS):
+            discard_snapshots(cr, 'company_id IN %s', (tuple(ids),))
+
+        return res
+
 
 res_company()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2013 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+"""Discard the stored RPS of unsent invoices when the data they were built
+from changes: partners and their addresses, invoice lines and taxes, and
+the domain of tax codes"""
+
+from osv import osv
+from nfse.prefetch import ADDRESS_FIELDS, PARTNER_FIELDS
+from nfse.rps import discard_snapshots
+
+# Invoices of a partner or of a company whose partner is it
+BY_PARTNER = """(partner_id IN %s OR company_id IN (
+    SELECT id FROM res_company WHERE partner_id IN %s))"""
+
+
+def _discard_by_partner(cr, partner_ids):
+    partner_ids = tuple(set(i for i in partner_ids if i))
+    if partner_ids:
+        discard_snapshots(cr, BY_PARTNER, (partner_ids, partner_ids))
+
+
+def _ids(ids):
+    if isinstance(ids, (int, long)):
+        return [ids]
+    return ids
+
+
+class res_partner(osv.osv):
+    _inherit = 'res.partner'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(res_partner, self).write(cr, uid, ids, vals, context)
+        if set(PARTNER_FIELDS + ['address']).intersection(vals):
+            _discard_by_partner(cr, _ids(ids))
+        return res
+
+
+res_partner()
+
+
+class res_partner_address(osv.osv):
+    _inherit = 'res.partner.address'
+
+    def _partner_ids(self, cr, uid, ids):
+        return [m2o[0] for m2o in (
+            address['partner_id']
+            for address in self.read(cr, uid, ids, ['partner_id'])
+            ) if m2o]
+
+    def create(self, cr, uid, vals, context=None):
+        # A new address may become the default one of its partner
+        _discard_by_partner(cr, [vals.get('partner_id')])
+        return super(res_partner_address, self).create(cr, uid, vals,
+                                                       context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if set(ADDRESS_FIELDS).intersection(vals):
+            ids = _ids(ids)
+            _discard_by_partner(cr, self._partner_ids(cr, uid, ids) +
+                                [vals.get('partner_id')])
+        return super(res_partner_address, self).write(cr, uid, ids, vals,
+                                                      context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        ids = _ids(ids)
+        _discard_by_partner(cr, self._partner_ids(cr, uid, ids))
+        return super(res_partner_address, self).unlink(cr, uid, ids,
+                                                       context)
+
+
+res_partner_address()
+
+
+class rps_snapshot_invoice_child(object):
+    """Lines and taxes: any change alters the RPS of their invoice"""
+
+    def _discard(self, cr, ids):
+        if ids:
+            discard_snapshots(cr, 'id IN (SELECT invoice_id FROM ' +
+                              self._table + ' WHERE id IN %s)',
+                              (tuple(ids),))
+
+    def create(self, cr, uid, vals, context=None):
+        if vals.get('invoice_id'):
+            discard_snapshots(cr, 'id = %s', (vals['invoice_id'],))
+        return super(rps_snapshot_invoice_child, self).create(
+            cr, uid, vals, context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        ids = _ids(ids)
+        # Before, in case the record moves to another invoice
+        self._discard(cr, ids)
+        res = super(rps_snapshot_invoice_child, self).write(
+            cr, uid, ids, vals, context)
+        self._discard(cr, ids)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        ids = _ids(ids)
+        self._discard(cr, ids)
+        return super(rps_snapshot_invoice_child, self).unlink(
+            cr, uid, ids, context)
+
+
+class account_invoice_line(rps_snapshot_invoice_child, osv.osv):
+    _inherit = 'account.invoice.line'
+
+
+account_invoice_line()
+
+
+class account_invoice_tax(rps_snapshot_invoice_child, osv.osv):
+    _inherit = 'account.invoice.tax'
+
+
+account_invoice_tax()
+
+
+class account_tax_code(osv.osv):
+    _inherit = 'account.tax.code'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(account_tax_code, self).write(cr, uid, ids, vals,
+                                                  context)
+        # The domain tells which tax of the RPS an invoice tax line is
+        if 'domain' in vals and ids:
+            discard_snapshots(cr, 'id IN (SELECT invoice_id FROM '
+                              'account_invoice_tax WHERE tax_code_id IN %s)',
+                              (tuple(_ids(ids)),))
+        return res
+
+
+account_tax_code()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+import unittest
+
+from ..nfse.batching import RPS_OVERHEAD, chunk_lotes, estimate_size, windows
+
+
+def rps(number, description=''):
+    return {'NumeroRPS': number, 'Discriminacao': description}
+
+
+class TestChunkLotes(unittest.TestCase):
+
+    def test_estimate_size(self):
+        size = estimate_size({'Tag': u'valor\xe9', 'Vazio': None})
+        self.assertEqual(size, RPS_OVERHEAD + 2 * 3 + 5 + 7)
+
+    def test_empty(self):
+        self.assertEqual(list(chunk_lotes([], 10, 10 ** 6)), [])
+
+    def test_max_rps(self):
+        lotes = list(chunk_lotes([rps(i) for i in range(7)], 3, 10 ** 6))
+        self.assertEqual([len(lote) for lote in lotes], [3, 3, 1])
+        self.assertEqual([r['NumeroRPS'] for lote in lotes for r in lote],
+                         range(7))
+
+    def test_max_bytes(self):
+        items = [rps(i, 'x' * 1000) for i in range(5)]
+        size = estimate_size(items[0])
+        lotes = list(chunk_lotes(items, 50, 2 * size))
+        self.assertEqual([len(lote) for lote in lotes], [2, 2, 1])
+
+    def test_oversized_rps_alone(self):
+        items = [rps(1), rps(2, 'x' * 10000), rps(3)]
+        lotes = list(chunk_lotes(items, 50, 5000))
+        self.assertEqual([[r['NumeroRPS'] for r in lote] for lote in lotes],
+                         [[1], [2], [3]])
+
+    def test_generator(self):
+        lotes = chunk_lotes((rps(i) for i in range(4)), 2, 10 ** 6)
+        self.assertEqual([len(lote) for lote in lotes], [2, 2])
+
+
+class TestWindows(unittest.TestCase):
+
+    def test_windows(self):
+        self.assertEqual(list(windows(iter(range(5)), 2)),
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(windows([], 2)), [])
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+import base64
+import os
+import unittest
+
+from ..nfse.cache import LRUCache, ProcessorCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertEqual(cache.get('a', 0), 0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_evicted(self):
+        evicted = []
+        cache = LRUCache(max_size=2, on_evict=lambda k, v: evicted.append(k))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(evicted, ['b'])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_expired(self):
+        evicted = []
+        cache = LRUCache(ttl=-1, on_evict=lambda k, v: evicted.append(k))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(evicted, ['a'])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 1)
+
+    def test_replace(self):
+        evicted = []
+        cache = LRUCache(on_evict=lambda k, v: evicted.append(v))
+        cache.set('a', 1)
+        cache.set('a', 2)
+        self.assertEqual(evicted, [1])
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        for key in range(4):
+            cache.set(key, key)
+        cache.invalidate(lambda key: key % 2)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(1), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class Company(object):
+
+    def __init__(self, id, cert='certificado', password='senha'):
+        self.id = id
+        self.nfse_cert_file = base64.encodestring(cert)
+        self.nfse_cert_password = password
+
+
+class TestProcessorCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ProcessorCache()
+        self.built = []
+
+    def tearDown(self):
+        self.cache._remove_cert_files()
+
+    def factory(self, cert_file, password):
+        with open(cert_file, 'rb') as f:
+            self.built.append((f.read(), password))
+        return object()
+
+    def test_reused(self):
+        company = Company(1)
+        processor = self.cache.get(company, self.factory)
+        self.assertTrue(self.cache.get(company, self.factory) is processor)
+        self.assertEqual(self.built, [('certificado', 'senha')])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_changed_certificate(self):
+        company = Company(1)
+        processor = self.cache.get(company, self.factory)
+        company.nfse_cert_password = 'outra'
+        self.assertFalse(self.cache.get(company, self.factory) is processor)
+        self.assertEqual(len(self.built), 2)
+
+    def test_companies_apart(self):
+        self.cache.get(Company(1), self.factory)
+        self.cache.get(Company(2), self.factory)
+        self.assertEqual(len(self.cache), 2)
+        # The same certificate is written once
+        self.assertEqual(len(self.cache._cert_files), 1)
+
+    def test_invalidate(self):
+        self.cache.get(Company(1), self.factory)
+        self.cache.get(Company(2), self.factory)
+        self.cache.invalidate([1])
+        self.assertEqual(len(self.cache), 1)
+        self.cache.get(Company(1), self.factory)
+        self.assertEqual(len(self.built), 3)
+
+    def test_cert_files_removed(self):
+        self.cache.get(Company(1), self.factory)
+        cert_files = self.cache._cert_files.values()
+        self.cache._remove_cert_files()
+        self.assertFalse([f for f in cert_files if os.path.exists(f)])
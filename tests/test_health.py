@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+import unittest
+
+from ..nfse.health import CLOSED, HALF_OPEN, OPEN, ServerHealthCheck
+
+URL = 'https://nfe.prefeitura.sp.gov.br/ws/lotenfe.asmx'
+
+
+class FakeHealthCheck(ServerHealthCheck):
+    """Answers probes from ``results`` instead of the network"""
+
+    def __init__(self, results, **kwargs):
+        super(FakeHealthCheck, self).__init__(**kwargs)
+        self.results = list(results)
+        self.probes = 0
+
+    def _probe(self, url):
+        self.probes += 1
+        return self.results.pop(0)
+
+
+class TestServerHealthCheck(unittest.TestCase):
+
+    def test_success_cached(self):
+        check = FakeHealthCheck([True], ttl=60)
+        self.assertTrue(check.is_up(URL))
+        self.assertTrue(check.is_up(URL))
+        self.assertEqual(check.probes, 1)
+
+    def test_expired(self):
+        check = FakeHealthCheck([True, True], ttl=60)
+        check.is_up(URL)
+        check._endpoint(URL).checked_at -= 61
+        self.assertTrue(check.is_up(URL))
+        self.assertEqual(check.probes, 2)
+
+    def test_failure_not_cached(self):
+        check = FakeHealthCheck([False, True], failure_threshold=3)
+        self.assertFalse(check.is_up(URL))
+        self.assertTrue(check.is_up(URL))
+        self.assertEqual(check.state(URL), CLOSED)
+
+    def test_opens_after_threshold(self):
+        check = FakeHealthCheck([False] * 3, failure_threshold=3)
+        for i in range(3):
+            self.assertFalse(check.is_up(URL))
+        self.assertEqual(check.state(URL), OPEN)
+        # Open: fails without probing
+        self.assertFalse(check.is_up(URL))
+        self.assertEqual(check.probes, 3)
+
+    def test_half_open_closes(self):
+        check = FakeHealthCheck([False, True], failure_threshold=1,
+                                reset_timeout=120)
+        check.is_up(URL)
+        check._endpoint(URL).opened_at -= 121
+        self.assertTrue(check.is_up(URL))
+        self.assertEqual(check.state(URL), CLOSED)
+
+    def test_half_open_reopens(self):
+        check = FakeHealthCheck([False, False], failure_threshold=3,
+                                reset_timeout=120)
+        endpoint = check._endpoint(URL)
+        endpoint.state = OPEN
+        endpoint.opened_at -= 121
+        self.assertFalse(check.is_up(URL))
+        # A single failed trial opens the circuit again
+        self.assertEqual(check.state(URL), OPEN)
+
+    def test_half_open_single_trial(self):
+        check = FakeHealthCheck([], reset_timeout=120)
+        endpoint = check._endpoint(URL)
+        endpoint.state = HALF_OPEN
+        endpoint.probing = True
+        self.assertFalse(check.is_up(URL))
+        self.assertEqual(check.probes, 0)
+
+    def test_endpoints_apart(self):
+        check = FakeHealthCheck([False, True], failure_threshold=1)
+        self.assertFalse(check.is_up(URL))
+        self.assertTrue(check.is_up(URL + '?other'))
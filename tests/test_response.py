@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+import unittest
+from xml.sax.saxutils import escape
+
+from ..nfse.response import iter_records, iter_sent
+
+NAMESPACE = 'http://www.prefeitura.sp.gov.br/nfe'
+
+RETORNO = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<RetornoEnvioLoteRPS xmlns="%s">'
+    '<Cabecalho Versao="1"><Sucesso>true</Sucesso></Cabecalho>'
+    '<Alerta><Codigo>208</Codigo>'
+    '<Descricao>Alíquota divergente.</Descricao>'
+    '<ChaveRPS><InscricaoPrestador>12345678</InscricaoPrestador>'
+    '<SerieRPS>A</SerieRPS><NumeroRPS>41</NumeroRPS></ChaveRPS></Alerta>'
+    '<ChaveNFeRPS>'
+    '<ChaveNFe><InscricaoPrestador>12345678</InscricaoPrestador>'
+    '<NumeroNFe>1001</NumeroNFe>'
+    '<CodigoVerificacao>ABCD1234</CodigoVerificacao></ChaveNFe>'
+    '<ChaveRPS><InscricaoPrestador>12345678</InscricaoPrestador>'
+    '<SerieRPS>A</SerieRPS><NumeroRPS>41</NumeroRPS></ChaveRPS>'
+    '</ChaveNFeRPS>'
+    '<ChaveNFeRPS>'
+    '<ChaveNFe><InscricaoPrestador>12345678</InscricaoPrestador>'
+    '<NumeroNFe>1002</NumeroNFe>'
+    '<CodigoVerificacao>EFGH5678</CodigoVerificacao></ChaveNFe>'
+    '<ChaveRPS><InscricaoPrestador>12345678</InscricaoPrestador>'
+    '<SerieRPS>A</SerieRPS><NumeroRPS>42</NumeroRPS></ChaveRPS>'
+    '</ChaveNFeRPS>'
+    '</RetornoEnvioLoteRPS>'
+    ) % NAMESPACE
+
+REJEITADO = (
+    '<RetornoEnvioLoteRPS xmlns="%s">'
+    '<Cabecalho Versao="1"><Sucesso>false</Sucesso></Cabecalho>'
+    '<Erro><Codigo>1001</Codigo><Descricao>Erro.</Descricao>'
+    '<ChaveRPS><SerieRPS>A</SerieRPS><NumeroRPS>43</NumeroRPS></ChaveRPS>'
+    '</Erro>'
+    '</RetornoEnvioLoteRPS>'
+    ) % NAMESPACE
+
+
+def envelope(retorno):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<soap:Envelope '
+        'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+        '<soap:Body><EnvioLoteRPSResponse xmlns="%s">'
+        '<RetornoXML>%s</RetornoXML>'
+        '</EnvioLoteRPSResponse></soap:Body></soap:Envelope>'
+        ) % (NAMESPACE, escape(retorno))
+
+
+class TestIterRecords(unittest.TestCase):
+
+    def test_records(self):
+        records = list(iter_records(RETORNO))
+        self.assertEqual([r['kind'] for r in records],
+                         ['Alerta', 'ChaveNFeRPS', 'ChaveNFeRPS'])
+        self.assertEqual(records[0]['code'], '208')
+        self.assertEqual(records[0]['numero_rps'], '41')
+        self.assertEqual(records[0]['numero_nfe'], None)
+        self.assertEqual(records[2]['serie_rps'], 'A')
+        self.assertEqual(records[2]['codigo_verificacao'], 'EFGH5678')
+
+    def test_envelope(self):
+        self.assertEqual(list(iter_records(envelope(RETORNO))),
+                         list(iter_records(RETORNO)))
+
+    def test_errors(self):
+        records = list(iter_records(envelope(REJEITADO)))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['kind'], 'Erro')
+        self.assertEqual(records[0]['code'], '1001')
+        self.assertEqual(records[0]['message'], 'Erro.')
+        self.assertEqual(records[0]['numero_rps'], '43')
+
+    def test_lazy(self):
+        records = iter_records(RETORNO)
+        self.assertEqual(records.next()['kind'], 'Alerta')
+        self.assertEqual(records.next()['numero_nfe'], '1001')
+
+
+class TestIterSent(unittest.TestCase):
+
+    def test_sent(self):
+        self.assertEqual(list(iter_sent(envelope(RETORNO))),
+                         [('41', 1001, 'ABCD1234'),
+                          ('42', 1002, 'EFGH5678')])
+
+    def test_rejected(self):
+        self.assertEqual(list(iter_sent(REJEITADO)), [])
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+import threading
+import time
+import unittest
+
+from ..nfse.scheduler import Scheduler
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst(self):
+        scheduler = Scheduler(rate=1.0, burst=3, max_concurrency=8)
+        for i in range(3):
+            scheduler.acquire()
+            scheduler.release(0.1, False)
+        self.assertTrue(scheduler.tokens < 1)
+
+    def test_refill(self):
+        scheduler = Scheduler(rate=2.0, burst=4)
+        scheduler.tokens = 0.0
+        scheduler._refill(scheduler._refilled + 0.5)
+        self.assertAlmostEqual(scheduler.tokens, 1.0)
+        # Never above the burst
+        scheduler._refill(scheduler._refilled + 60)
+        self.assertEqual(scheduler.tokens, 4)
+
+    def test_waits_for_a_token(self):
+        scheduler = Scheduler(rate=20.0, burst=1)
+        scheduler.acquire()
+        scheduler.release(0.01, False)
+        start = time.time()
+        scheduler.acquire()
+        scheduler.release(0.01, False)
+        self.assertTrue(time.time() - start >= 0.03)
+
+    def test_concurrency_limit(self):
+        scheduler = Scheduler(rate=1000.0, burst=100, max_concurrency=2)
+        self.assertEqual(int(scheduler.limit), 1)
+        scheduler.acquire()
+        waiter = threading.Thread(target=scheduler.acquire)
+        waiter.start()
+        waiter.join(0.1)
+        # The second call waits for the first one to finish
+        self.assertTrue(waiter.is_alive())
+        self.assertEqual(scheduler.status()['waiting'], 1)
+        scheduler.release(0.01, False)
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(scheduler.in_flight, 1)
+
+
+class TestAIMD(unittest.TestCase):
+
+    def scheduler(self):
+        scheduler = Scheduler(rate=1000.0, burst=100, max_concurrency=8,
+                              target_latency=1.0)
+        scheduler.limit = 4.0
+        return scheduler
+
+    def call(self, scheduler, latency, failed=False):
+        scheduler.acquire()
+        scheduler.release(latency, failed)
+
+    def test_additive_increase(self):
+        scheduler = self.scheduler()
+        self.call(scheduler, 0.1)
+        self.assertAlmostEqual(scheduler.limit, 4.25)
+
+    def test_increase_capped(self):
+        scheduler = self.scheduler()
+        for i in range(200):
+            self.call(scheduler, 0.1)
+        self.assertEqual(scheduler.limit, 8)
+
+    def test_halved_on_failure(self):
+        scheduler = self.scheduler()
+        self.call(scheduler, 0.1, failed=True)
+        self.assertEqual(scheduler.limit, 2.0)
+        self.assertEqual(scheduler.errors, 1)
+
+    def test_halved_when_slow(self):
+        scheduler = self.scheduler()
+        self.call(scheduler, 2.0)
+        self.assertEqual(scheduler.limit, 2.0)
+        self.assertEqual(scheduler.errors, 0)
+
+    def test_once_per_round(self):
+        scheduler = self.scheduler()
+        scheduler.latency = 10.0
+        self.call(scheduler, 10.0, failed=True)
+        self.call(scheduler, 10.0, failed=True)
+        self.assertEqual(scheduler.limit, 2.0)
+        self.assertEqual(scheduler.errors, 2)
+
+    def test_never_below_one(self):
+        scheduler = self.scheduler()
+        for i in range(10):
+            scheduler._decreased = 0
+            self.call(scheduler, 0.1, failed=True)
+        self.assertEqual(scheduler.limit, 1.0)
+
+    def test_status(self):
+        scheduler = self.scheduler()
+        self.call(scheduler, 0.5)
+        self.call(scheduler, 1.5, failed=True)
+        status = scheduler.status()
+        self.assertEqual(status['calls'], 2)
+        self.assertEqual(status['errors'], 1)
+        self.assertEqual(status['in_flight'], 0)
+        self.assertAlmostEqual(status['latency'], 0.7)
+        self.assertTrue(status['rate'] > 0)
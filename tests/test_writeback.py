@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+import unittest
+
+from ..nfse import writeback
+from ..nfse.writeback import update_rows
+
+
+class Cursor(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+
+class TestUpdateRows(unittest.TestCase):
+
+    def test_statement(self):
+        cr = Cursor()
+        update_rows(cr, 'l10n_br_account_invoice',
+                    [('nfse_numero', 'integer'), ('nfse_codigo', 'varchar')],
+                    [(1, 10, 'A'), (2, 11, 'B')])
+        self.assertEqual(cr.queries, [(
+            'UPDATE l10n_br_account_invoice AS t SET '
+            'nfse_numero = v.nfse_numero::integer, '
+            'nfse_codigo = v.nfse_codigo::varchar '
+            'FROM (VALUES (%s, %s, %s), (%s, %s, %s)) '
+            'AS v(id, nfse_numero, nfse_codigo) WHERE t.id = v.id',
+            [1, 10, 'A', 2, 11, 'B'],
+            )])
+
+    def test_no_rows(self):
+        cr = Cursor()
+        update_rows(cr, 'account_invoice', [('state', 'varchar')], [])
+        self.assertEqual(cr.queries, [])
+
+    def test_chunks(self):
+        cr = Cursor()
+        rows = [(i, i) for i in range(writeback.CHUNK_SIZE * 2 + 1)]
+        update_rows(cr, 'account_invoice', [('nfse_numero', 'integer')], rows)
+        self.assertEqual([len(params) for query, params in cr.queries],
+                         [writeback.CHUNK_SIZE * 2] * 2 + [2])
+        self.assertEqual([v for query, params in cr.queries for v in params],
+                         [v for row in rows for v in row])
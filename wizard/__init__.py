@@ -22,3 +22,5 @@
 ##############################################################################
 
 import manage_nfse
+import reconcile_nfse
+import export_nfse_archive
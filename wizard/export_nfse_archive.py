@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+import base64
+import datetime
+import tempfile
+
+
+class export_nfse_archive(osv.osv_memory):
+    """Export the archived NFS-e XML of a period as a zip file
+
+    The zip is built in an anonymous temporary file, removed once it is
+    read back, and returned for download.
+
+    States:
+    - init: wizard just opened
+    - done: zip file written
+    """
+
+    _name = "l10n_br_nfse.export_archive"
+    _description = "Export NFS-e XML archive"
+    _columns = {
+        'company_id': fields.many2one('res.company', u'Empresa'),
+        'date_start': fields.date(u'Data inicial', required=True),
+        'date_end': fields.date(u'Data final', required=True),
+        'state': fields.selection([('init', 'init'),
+                                   ('done', 'done'),
+                                   ], 'state', readonly=True),
+        'count': fields.integer(u'Lotes exportados', readonly=True),
+        'data': fields.binary(u'Arquivo', readonly=True),
+        'filename': fields.char(u'Nome do arquivo', size=64, readonly=True),
+        }
+    _defaults = {
+        'state': 'init',
+        'date_start': lambda *a: datetime.date.today().replace(
+            day=1
+            ).strftime('%Y-%m-%d'),
+        'date_end': lambda *a: datetime.date.today().strftime('%Y-%m-%d'),
+        }
+
+    def export(self, cr, uid, ids, context=None):
+        archive_obj = self.pool.get('l10n_br_nfse.archive')
+        wizard = self.browse(cr, uid, ids[0], context=context)
+        company_id = wizard.company_id and wizard.company_id.id or None
+        filename = 'nfse_%s_%s.zip' % (wizard.date_start, wizard.date_end)
+
+        with tempfile.TemporaryFile() as output:
+            count = archive_obj.export_zip(
+                cr, uid, output, wizard.date_start, wizard.date_end,
+                company_id, context
+                )
+            output.seek(0)
+            data = base64.encodestring(output.read())
+
+        self.write(cr, uid, ids, {'state': 'done', 'count': count,
+                                  'data': data, 'filename': filename},
+                   context=context)
+        return True
+
+
+export_nfse_archive()
@@ -23,25 +23,46 @@
 
 from osv import fields, osv
 from tools.translate import _
-import base64
-import urllib2
+import hashlib
 import sys
-from pysped_nfse.processador import ProcessadorNFSe, SIGNATURE
-from pysped_nfse.processador_sp import ProcessadorNFSeSP, tpRPS, tpNFe
-from pysped_nfse.nfse_xsd import *
-from pysped_nfse.exception import CommunicationError
-from uuid import uuid4
+import threading
+from ..nfse.lazy import pysped
+from ..nfse.cache import processor_cache
+from ..nfse.health import health_check
+from ..nfse.connection import capture
+from ..nfse.prefetch import prefetch_send_data
+from ..nfse.config import get_param
+from ..nfse.timing import instrumented, span
+from ..nfse.response import iter_sent
+from ..nfse.rps import get_rps, build_cabecalho, check_remetente
+from ..nfse.scheduler import schedulers, throttled
+from ..nfse.validation import validate_batch
+from ..nfse.batching import chunk_lotes, pipeline, lot_protocol, \
+    lot_sent, windows
+from ..nfse.workers import run_concurrently, reraise
+from ..nfse.writeback import update_rows
 import datetime
 import re
 import unicodedata
 import string
+import logging
 
-NFSE_STATUS = {
-    'send_ok': 'Transmitida',
-    'send_failed': 'Falhou ao transmitir',
-    'cancel_ok': 'Cancelada',
-    'cancel_failed': 'Falhou ao cancelar',
-    }
+_logger = logging.getLogger(__name__)
+
+NFSE_STATES = [
+    ('pending', u'Não transmitida'),
+    ('sent', u'Transmitida'),
+    ('send_failed', u'Falhou ao transmitir'),
+    ('cancelled', u'Cancelada'),
+    ('cancel_failed', u'Falhou ao cancelar'),
+    ]
+
+# States of invoices whose RPS must still be sent
+UNSENT_STATES = ['pending', 'send_failed']
+
+
+class ServerUnavailable(osv.except_osv):
+    """The web service cannot be reached; worth trying again later"""
 
 
 class manage_nfse(osv.osv_memory):
@@ -53,6 +74,7 @@ class manage_nfse(osv.osv_memory):
     - done: nfse was successfully sent
     - failed: some or all operations failed
     - nothing: nothing to do
+    - queued: invoices were queued for transmission
     """
 
     _name = "l10n_br_nfse.manage_nfse"
@@ -65,10 +87,16 @@ class manage_nfse(osv.osv_memory):
                                    ('done', 'done'),
                                    ('failed', 'failed'),
                                    ('nothing', 'nothing'),
+                                   ('queued', 'queued'),
                                    ], 'state', readonly=True),
         'selected_invoices': fields.many2many('account.invoice',
                                               string=u'Faturas Selecionadas',
                                               ),
+        'remote_test': fields.boolean(
+            u'Testar também na prefeitura',
+            help=u'Além da validação local, envia os dados para o ' + \
+                 u'serviço de teste da prefeitura.'
+            ),
         }
     _defaults = {
         'state': 'init',
@@ -95,19 +123,14 @@ class manage_nfse(osv.osv_memory):
 
     def _check_server(self, cr, uid, ids, server_host):
         """Check if server is up"""
-        server_up = False
-
         if not server_host.startswith('http'):
             server_host = 'https://' + server_host
 
-        try:
-            if urllib2.urlopen(server_host).getcode() == 200:
-                server_up = True
-        except urllib2.HTTPError:
-            server_up = False
+        with span('health_check'):
+            server_up = health_check.is_up(server_host)
 
         if not server_up:
-            raise osv.except_osv(
+            raise ServerUnavailable(
                 u'Erro de comunicação!',
                 u'Não foi possível a conexão com o servidor. ' + \
                 u'Tente novamente mais tarde.'
@@ -118,7 +141,7 @@ class manage_nfse(osv.osv_memory):
     def _check_invoices_are_services(self, invoices):
         check = True
         for inv in invoices:
-            if inv.fiscal_type != 'service':
+            if inv['fiscal_type'] != 'service':
                 check = False
                 break
         return check
@@ -132,14 +155,38 @@ class manage_nfse(osv.osv_memory):
                 company.name,
                 )
 
-    def _show_warnings_and_errors(self, invoice_rps, warnings, errors):
+    def _get_processor(self, company):
+        """Return the cached NFS-e processor of the given company"""
+        self._check_certificate(company)
+        with span('certificate'):
+            return processor_cache.get(company, self._build_processor)
+
+    def _build_processor(self, cert_file, cert_password):
+        processor = pysped.ProcessadorNFSeSP(cert_file, cert_password)
+        # Another host, e.g. the benchmark's fake web service
+        server = get_param('server', '')
+        if server:
+            processor.servidor = server
+        # Calls from every thread share the limits of endpoint and certificate
+        with open(cert_file, 'rb') as cert:
+            certificate = hashlib.sha1(cert.read()).hexdigest()
+        processor.nfse_scheduler = schedulers.get(processor.servidor,
+                                                  certificate)
+        # Threads calling it at the same time get copies, see exclusive()
+        processor.nfse_lock = threading.Lock()
+        processor.nfse_spares = []
+        processor.nfse_factory = \
+            lambda: self._build_processor(cert_file, cert_password)
+        return processor
+
+    def _format_warnings_and_errors(self, invoice_rps, warnings, errors):
         message = ''
 
         if len(warnings):
             message += u'Alertas:\n'
             for chave in warnings:
                 invoice = invoice_rps[str(chave.NumeroRPS)]
-                message += u'Nota Fiscal {}:\n'.format(invoice.number) + \
+                message += u'Nota Fiscal {}:\n'.format(invoice['number']) + \
                     '\n'.join(
                         [u'{} - {}'.format(code, desc)
                          for code, desc in warnings[chave]]
@@ -149,293 +196,825 @@ class manage_nfse(osv.osv_memory):
             message += u'\nErros:\n'
             for chave in errors:
                 invoice = invoice_rps[str(chave.NumeroRPS)]
-                message += u'Nota Fiscal {}:\n'.format(invoice.number) + \
+                message += u'Nota Fiscal {}:\n'.format(invoice['number']) + \
                     '\n'.join(
                         [u'{} - {}'.format(code, desc)
                          for code, desc in errors[chave]]
                         ) + '\n'
 
-        raise osv.except_osv(
-            u'O sistema da prefeitura verificou problemas nos dados informados',
-            message
-            )
+        return message
+
+    def _empty_outcome(self):
+        return {
+            'success': True,
+            'responses': [],
+            'warnings': {},
+            'errors': {},
+            'communication_error': None,
+            'protocols': [],
+            'exc_info': None,
+            'sent_ids': [],
+            'submitted_ids': [],
+            'exchanges': [],
+            }
+
+    def _transmit_batch(self, batch, test):
+        """Send the lots of one company, without touching the database
+
+        Runs in a worker thread. Returns the responses of the accepted lots
+        and the merged warnings and errors; a communication error stops the
+        company's remaining lots and is returned, not raised. With the
+        l10n_br_nfse_async_send option, lots are submitted asynchronously
+        and only their protocols are returned, to be polled later. The
+        signed XML exchanged for each lot, as captured on the wire, is
+        returned in ``exchanges`` for the archive, and the accepted RPS are
+        later read from the captured response instead of the bound one.
+        """
+        proc = batch['processor']
+        company = batch['company']
+        asynchronous = not test and get_param('async_send', False)
+        if asynchronous and not (hasattr(proc, 'enviar_lote_rps_async') and
+                                 hasattr(proc, 'consultar_lote')):
+            # Needs enviar_lote_rps_async and consultar_lote from pysped_nfse
+            _logger.warning('l10n_br_nfse_async_send is set but the '
+                            'installed pysped_nfse cannot send lots '
+                            'asynchronously; sending synchronously')
+            asynchronous = False
+
+        if test:
+            transmit = 'testar_envio_lote_rps'
+        elif asynchronous:
+            transmit = 'enviar_lote_rps_async'
+        else:
+            transmit = 'enviar_lote_rps'
 
-    def _send_nfse(self, cr, uid, ids, context, test=True):
-        """Test NFS-e dispatch"""
-        result = {}
+        # Headers are built here while the previous lot is in flight
+        lotes = ((lote, build_cabecalho(company, lote))
+                 for lote in chunk_lotes(batch['lote_rps']))
 
-        inv_obj = self.pool.get('account.invoice')
-        active_ids = [i.id for i in
-                      self.browse(cr, uid, ids[0]).selected_invoices]
+        def send_lote(lote_cabecalho):
+            lote, cabecalho = lote_cabecalho
+            # The processor signs the lot as part of the transmission
+            with span('transmit', len(lote)):
+                with capture() as exchanges:
+                    response = throttled(proc, transmit,
+                                         cabecalho=cabecalho, lote_rps=lote)
+            return response, exchanges
 
-        if len(active_ids) == 0:
-            raise osv.except_osv(
-                u'Atenção!',
-                u'Não há notas confirmadas para efetuar o envio.'
-                )
+        outcome = self._empty_outcome()
 
-        conditions = [('id', 'in', active_ids),
-                      '|', ('nfe_status', '=', None),
-                      ('nfse_status', '!=', NFSE_STATUS['send_ok'])]
-        invoices_to_send = inv_obj.search(cr, uid, conditions)
-
-        lote_rps = []
-        valor_total_servicos = 0
-        valor_total_deducoes = 0
-        datas = []
+        try:
+            for (lote, cabecalho), (response, exchanges) in \
+                    pipeline(lotes, send_lote):
+                success, res, warnings, errors = response
+                outcome['success'] = outcome['success'] and success
+                outcome['warnings'].update(warnings)
+                outcome['errors'].update(errors)
+                if exchanges and not test:
+                    # The signed request and the response of the lot
+                    request_xml, response_xml = exchanges[-1]
+                    outcome['exchanges'].append(
+                        (lote, success, lot_protocol(res), request_xml,
+                         response_xml)
+                        )
+                if success and asynchronous:
+                    outcome['protocols'].append((lot_protocol(res), lote))
+                elif success:
+                    # Only the keys are kept, never the bound tree
+                    if exchanges:
+                        sent = iter_sent(exchanges[-1][1])
+                    else:
+                        sent = lot_sent(res)
+                    outcome['responses'].append(
+                        (lot_protocol(res), len(lote), sent)
+                        )
+        except pysped.CommunicationError, e:
+            outcome['success'] = False
+            outcome['communication_error'] = e
+
+        return outcome
+
+    def _prepare_batches(self, cr, uid, ids, invoice_ids, context=None,
+                         invalid=None, skip=()):
+        """Partition invoices per company and build their RPS
+
+        Each company is sent as its own batch, under its own certificate and
+        header. When ``invalid`` is a dict, invoices that cannot be sent
+        because of their data or their company's (not a service invoice,
+        no CNPJ or certificate) are recorded there by id instead of raising.
+        Batches of the companies in ``skip`` get no processor.
+        """
+        with span('db_read', len(invoice_ids)):
+            prefetched = prefetch_send_data(self.pool, cr, uid, invoice_ids,
+                                            context=context, snapshots=True)
+        invoices = [prefetched['invoices'][i] for i in invoice_ids]
 
-        invoices = inv_obj.browse(cr, uid, invoices_to_send, context=context)
-        
         if not self._check_invoices_are_services(invoices):
-            raise osv.except_osv(
-                u'Não foi possível completar a operação.',
-                u'Uma ou mais faturas não são de serviço.',
-                )
+            if invalid is None:
+                raise osv.except_osv(
+                    u'Não foi possível completar a operação.',
+                    u'Uma ou mais faturas não são de serviço.',
+                    )
+            for inv in invoices:
+                if inv['fiscal_type'] != 'service':
+                    invalid[inv['id']] = u'A fatura não é de serviço.'
+            invoices = [inv for inv in invoices
+                        if inv['fiscal_type'] == 'service']
 
-        invoice_rps = {}
+        batches = []
+        company_batch = {}
+        rejected = {}
 
         for inv in invoices:
-            company = self.pool.get('res.company').browse(
-                cr, uid, inv.company_id.id
-                )
-
-            self._check_certificate(company)
-
-            cert_file_content = base64.decodestring(company.nfse_cert_file)
-
-            caminho_temporario = u'/tmp/'
-            cert_file = caminho_temporario + uuid4().hex
-            arq_tmp = open(cert_file, 'w')
-            arq_tmp.write(cert_file_content)
-            arq_tmp.close()
-
-            cert_password = company.nfse_cert_password
+            company = inv['company']
+
+            if company['id'] not in company_batch:
+                proc = None
+                try:
+                    check_remetente(company)
+                    if company['id'] not in skip:
+                        proc = self._get_processor(
+                            self.pool.get('res.company').browse(
+                                cr, uid, company['id'])
+                            )
+                except osv.except_osv, e:
+                    if invalid is None:
+                        raise
+                    rejected[company['id']] = e.value
+                if proc is not None:
+                    self._check_server(cr, uid, ids, proc.servidor)
+                company_batch[company['id']] = {
+                    'company': company,
+                    'processor': proc,
+                    'lote_rps': [],
+                    'invoice_rps': {},
+                    }
+                batches.append(company_batch[company['id']])
+
+            if company['id'] in rejected:
+                invalid[inv['id']] = rejected[company['id']]
+                continue
 
-            company_addr_ids = self.pool.get('res.partner').address_get(cr, uid, [company.partner_id.id], ['default'])
-            company_addr = self.pool.get('res.partner.address').browse(cr, uid, [company_addr_ids['default']])[0]
-            partner_addr_ids = self.pool.get('res.partner').address_get(cr, uid, [inv.partner_id.id], ['default'])
-            partner_addr = self.pool.get('res.partner.address').browse(cr, uid, [partner_addr_ids['default']])[0]
+            try:
+                with span('build'):
+                    rps = get_rps(inv)
+            except osv.except_osv, e:
+                if invalid is None:
+                    raise
+                invalid[inv['id']] = e.value
+                continue
+
+            batch = company_batch[company['id']]
+            batch['lote_rps'].append(rps)
+            batch['invoice_rps'][inv['internal_number']] = inv
+
+        return [b for b in batches if len(b['lote_rps'])]
+
+    def _rps_check_request(self, inv):
+        company = inv.company_id
+        return {
+            'CPFCNPJRemetente': re.sub('[^0-9]', '', company.cnpj),
+            'InscricaoPrestador': company.inscr_mun,
+            'SerieRPS': inv.document_serie_id.code,
+            'NumeroRPS': inv.internal_number,
+            'Versao': 1,
+            }
+
+    def _recover_sent(self, cr, uid, ids, invoice_ids, context=None):
+        """Find invoices whose RPS the prefeitura has already accepted
+
+        The transmission journal is checked first; invoices whose last
+        attempt has no recorded outcome are looked up by RPS at the
+        prefeitura. Recovered invoices get their NFS-e number back and their
+        ids are returned, so they are not sent again.
+        """
+        inv_obj = self.pool.get('account.invoice')
+        journal = self.pool.get('l10n_br_nfse.transmission')
+
+        unnumbered = inv_obj.search(cr, uid, [('id', 'in', invoice_ids),
+                                              ('nfse_numero', '=', False)],
+                                    context=context)
+        accepted, in_doubt = journal.recover(cr, uid, unnumbered, context)
+
+        self._write_sent(cr, uid, [
+            (invoice_id, values['nfse_numero'],
+             values['nfse_codigo_verificacao'])
+            for invoice_id, values in accepted.items()
+            ], context)
+        recovered_ids = accepted.keys()
+
+        invoices = inv_obj.browse(cr, uid, in_doubt, context=context)
+        found = []
+        not_found = {}
+
+        for inv, success, res, message in self._call_per_invoice(
+                cr, uid, ids, invoices, 'consultar_nfse',
+                self._rps_check_request):
+            nfe = success and res.NFe and res.NFe[0]
+
+            if nfe:
+                found.append((inv.id, int(nfe.ChaveNFe.NumeroNFe),
+                              nfe.ChaveNFe.CodigoVerificacao))
+            else:
+                # Unknown to the prefeitura or not verifiable: send again,
+                # a duplicated RPS would be rejected by the prefeitura
+                message = message or u'RPS não encontrado na prefeitura.'
+                not_found.setdefault(message, []).append(inv.id)
+
+        self._write_sent(cr, uid, found, context)
+        journal.settle_sent(cr, uid, [key[0] for key in found],
+                            context=context)
+        recovered_ids += [key[0] for key in found]
+
+        for message, invoice_ids in not_found.items():
+            journal.settle(cr, uid, invoice_ids,
+                           {'state': 'error', 'message': message}, context)
+
+        return recovered_ids
+
+    def _journal_failures(self, cr, uid, batch, outcome, context=None):
+        """Record the outcome of the RPS of a batch that were not accepted
+
+        Attempts interrupted by a communication or unexpected error keep no
+        outcome, so the next attempt checks them at the prefeitura first.
+        """
+        journal = self.pool.get('l10n_br_nfse.transmission')
+        handled = set(outcome['sent_ids'] + outcome['submitted_ids'])
+        rejected = {}
+
+        for chave, errors in outcome['errors'].items():
+            invoice = batch['invoice_rps'].get(str(chave.NumeroRPS))
+            if invoice and invoice['id'] not in handled:
+                handled.add(invoice['id'])
+                message = self._format_messages({}, {chave: errors})
+                rejected.setdefault(message, []).append(invoice['id'])
+
+        for message, invoice_ids in rejected.items():
+            journal.settle(cr, uid, invoice_ids, {
+                'state': 'rejected',
+                'message': message,
+                }, context)
+
+        pending = [inv['id'] for inv in batch['invoice_rps'].values()
+                   if inv['id'] not in handled]
+
+        if outcome['communication_error']:
+            e = outcome['communication_error']
+            journal.settle(cr, uid, pending, {
+                'message': u'Código: {}\nDescrição: {}'.format(e.status,
+                                                              e.reason),
+                }, context)
+        elif not outcome['exc_info']:
+            journal.settle(cr, uid, pending, {
+                'state': 'rejected',
+                'message': u'Lote rejeitado pela prefeitura.',
+                }, context)
+
+    def _send_window(self, cr, uid, ids, invoice_ids, test=False,
+                     context=None, invalid=None, stopped=None):
+        """Read, build and transmit one window of invoices
+
+        Returns a list of ``(batch, outcome)``, one per company. Companies
+        in ``stopped`` are not transmitted: their batch gets the outcome of
+        the failure that stopped them.
+        """
+        journal = self.pool.get('l10n_br_nfse.transmission')
+        stopped = stopped or {}
+
+        batches = self._prepare_batches(cr, uid, ids, invoice_ids, context,
+                                        invalid, stopped)
+        skipped = [b for b in batches if b['company']['id'] in stopped]
+        batches = [b for b in batches if b['company']['id'] not in stopped]
+
+        if not test:
+            journal.start(cr, uid, [inv for b in batches
+                                    for inv in b['invoice_rps'].values()],
+                          context)
+
+        outcomes = run_concurrently(
+            lambda batch: self._transmit_batch(batch, test), batches,
+            get_param('max_company_workers', 4),
+            )
 
-            proc = ProcessadorNFSeSP(
-                cert_file,
-                cert_password,
-                )
+        results = []
 
-            if self._check_server(cr, uid, ids, proc.servidor):
+        for batch, outcome, exc_info in outcomes:
+            if exc_info:
+                outcome = dict(self._empty_outcome(), success=False,
+                               exc_info=exc_info)
 
-                data_emissao = inv.date_invoice
+            if not test:
+                for protocol, count, sent in outcome['responses']:
+                    with span('write_back', count):
+                        sent_ids = self._write_send_result(
+                            cr, uid, sent, batch['invoice_rps'], context
+                            )
+                    journal.settle_sent(cr, uid, sent_ids, protocol, context)
+                    outcome['sent_ids'] += sent_ids
+
+                for protocol, lote in outcome['protocols']:
+                    lot_ids = [batch['invoice_rps'][rps['NumeroRPS']]['id']
+                               for rps in lote]
+                    self.pool.get('l10n_br_nfse.lot').register(
+                        cr, uid, batch['company']['id'], protocol, lot_ids,
+                        context
+                        )
+                    journal.settle(cr, uid, lot_ids, {'lot': protocol},
+                                   context)
+                    outcome['submitted_ids'] += lot_ids
+
+                self._journal_failures(cr, uid, batch, outcome, context)
+                self._archive_exchanges(cr, uid, batch, outcome, context)
+
+            results.append((batch, outcome))
+
+        for batch in skipped:
+            stop = stopped[batch['company']['id']]
+            results.append((batch, dict(
+                self._empty_outcome(), success=False,
+                communication_error=stop['communication_error'],
+                exc_info=stop['exc_info'],
+                )))
+
+        return results
+
+    def _archive_exchanges(self, cr, uid, batch, outcome, context=None):
+        """Keep the signed XML exchanged for each lot of a batch"""
+        if not get_param('archive_xml', True):
+            return
+        archive_obj = self.pool.get('l10n_br_nfse.archive')
+
+        for lote, success, protocol, request_xml, response_xml in \
+                outcome['exchanges']:
+            with span('archive', len(lote)):
+                archive_obj.store(
+                    cr, uid, batch['company']['id'], protocol,
+                    request_xml, response_xml,
+                    [batch['invoice_rps'][rps['NumeroRPS']]['id']
+                     for rps in lote],
+                    success, context
+                    )
 
-                if partner_addr.l10n_br_city_id and partner_addr.state_id:
-                    city_ibge_code = str(partner_addr.state_id.ibge_code) + \
-                        str(partner_addr.l10n_br_city_id.ibge_code)
-                else:
-                    city_ibge_code = None
+    def _merge_result(self, merged, batch, outcome):
+        """Fold the result of a window into the result of its company
 
-                valor_servicos = inv.amount_untaxed
-                valor_deducoes = 0
-                if inv.amount_tax < 0:
-                    valor_deducoes = inv.amount_tax * -1
+        Only the id and number of the invoices are kept; the responses and
+        lots, already written back, are dropped.
+        """
+        merged_batch, merged_outcome = merged
 
-                valor_total_servicos += valor_servicos
-                valor_total_deducoes += valor_deducoes
+        for numero_rps, inv in batch['invoice_rps'].items():
+            merged_batch['invoice_rps'][numero_rps] = {
+                'id': inv['id'],
+                'number': inv['number'],
+                }
 
-                impostos = ('pis', 'cofins', 'inss', 'ir', 'csll', 'iss',
-                            'iss_retido')
-                valores = {x: 0 for x in impostos}
-                aliquota = 0
+        merged_outcome['success'] = merged_outcome['success'] and \
+            outcome['success']
+        for key in ('warnings', 'errors'):
+            merged_outcome[key].update(outcome[key])
+        for key in ('communication_error', 'exc_info'):
+            merged_outcome[key] = merged_outcome[key] or outcome[key]
+        for key in ('sent_ids', 'submitted_ids'):
+            merged_outcome[key] += outcome[key]
+
+    def _send_invoices(self, cr, uid, ids, invoice_ids, test=False,
+                       context=None, invalid=None, recovered=None):
+        """Transmit the given invoices and store the accepted NFS-e
+
+        Returns a list of ``(batch, outcome)``, one per company, where the
+        outcome also holds the ids written as sent (``sent_ids``), the ids
+        submitted in asynchronous lots (``submitted_ids``) and the
+        ``exc_info`` of an unexpected failure of the batch, if any. When
+        ``recovered`` is a list, the ids of invoices found to be already
+        accepted, and therefore not sent again, are added to it.
+
+        Invoices are read, built and sent in windows of at most
+        l10n_br_nfse_send_window invoices, so memory does not grow with the
+        selection. Once a company fails to transmit, its invoices in the
+        following windows are not sent.
+        """
+        if not test:
+            recovered_ids = self._recover_sent(cr, uid, ids, invoice_ids,
+                                               context)
+            if recovered is not None:
+                recovered.extend(recovered_ids)
+            recovered_ids = set(recovered_ids)
+            invoice_ids = [i for i in invoice_ids if i not in recovered_ids]
+
+        results = []
+        merged = {}
+        stopped = {}
+
+        for window_ids in windows(invoice_ids, get_param('send_window', 500)):
+            for batch, outcome in self._send_window(
+                    cr, uid, ids, window_ids, test, context, invalid,
+                    stopped):
+                company = batch['company']
+
+                if company['id'] not in merged:
+                    merged[company['id']] = (
+                        {'company': company, 'invoice_rps': {}},
+                        self._empty_outcome(),
+                        )
+                    results.append(merged[company['id']])
+                self._merge_result(merged[company['id']], batch, outcome)
 
-                for inv_tax in inv.tax_line:
-                    if inv_tax.tax_code_id.domain in impostos:
-                        valores[inv_tax.tax_code_id.domain] += \
-                            round(inv_tax.amount, 2)
-                        if inv_tax.tax_code_id.domain == 'iss':
-                            aliquota = round(inv_tax.aliquota, 2)
+                if outcome['communication_error'] or outcome['exc_info']:
+                    stopped.setdefault(company['id'], outcome)
 
-                iss_retido = valores['iss_retido'] < 0
+        return results
 
-                discriminacoes = []
+    def _send_nfse(self, cr, uid, ids, context, test=True):
+        """Test NFS-e dispatch"""
+        result = {}
 
-                for inv_line in inv.invoice_line:
-                    discriminacoes.append(inv_line.name)
+        inv_obj = self.pool.get('account.invoice')
+        invoices_to_send = self._get_invoices_to_send(cr, uid, ids, context)
 
-                discriminacao = '|'.join(discriminacoes)
+        recovered = []
+        results = self._send_invoices(cr, uid, ids, invoices_to_send, test,
+                                      context, recovered=recovered)
 
-                inscricao_municipal_tomador = inv.partner_id.inscr_mun
+        if not len(results):
+            self.write(cr, uid, ids,
+                       {'state': recovered and 'done' or 'nothing'})
+            return True
 
-                # São Paulo
-                if company_addr.l10n_br_city_id.ibge_code == '50308':                
-                    if partner_addr.l10n_br_city_id.ibge_code == '50308' and \
-                        not inscricao_municipal_tomador:
-                        raise osv.except_osv(
-                            u'Faltam dados no cadastro do tomador.',
-                            u'Informe a inscrição municipal do parceiro %s.' %
-                            inv.partner_id.name,
-                            )
-                    elif partner_addr.l10n_br_city_id.ibge_code != '50308':
-                        inscricao_municipal_tomador = None
+        all_success = True
+        communication_errors = []
+        messages = []
 
-                service_code = inv.fiscal_operation_id.code
+        # Asynchronously submitted lots count as sent: they must be kept
+        sent = bool(recovered) or any(
+            outcome['sent_ids'] or outcome['submitted_ids']
+            for batch, outcome in results
+            )
+        only_submitted = not recovered and not any(
+            outcome['sent_ids'] for batch, outcome in results
+            )
 
-                if inv.partner_id.cnpj_cpf:
-                    cnpj_tomador = re.sub('[^0-9]', '', inv.partner_id.cnpj_cpf)
-                else:
-                    raise osv.except_osv(
-                        u'Faltam dados no cadastro do cliente.',
-                        u'O CNPJ do cliente %s é obrigatório.' %
-                        inv.partner_id.name,
-                        )
+        for batch, outcome in results:
+            if outcome['exc_info']:
+                if sent:
+                    self.write(cr, uid, ids, {'state': 'failed'})
+                    cr.commit()
+                reraise(outcome['exc_info'])
 
-                lote_rps.append({
-                    # FIXME: por enquanto somente RPS suportado
-                    'TipoRPS': 'RPS',
-                    'DataEmissao': data_emissao,
-                    # TODO: tpStatusNFe
-                    'StatusRPS': 'N',
-                    'TributacaoRPS': company.tributacao or 'T',
-                    'ValorServicos': valor_servicos,
-                    'ValorDeducoes': valor_deducoes,
-                    'ValorPIS': valores['pis'],
-                    'ValorCOFINS': valores['cofins'],
-                    'ValorINSS': valores['inss'],
-                    'ValorIR': valores['ir'],
-                    'ValorCSLL': valores['csll'],
-                    'CodigoServico': int(service_code),
-                    'AliquotaServicos': aliquota,
-                    'ISSRetido': iss_retido,
-                    'CPFCNPJTomador': cnpj_tomador,
-                    'TipoInscricaoTomador': inv.partner_id.tipo_pessoa,
-                    'InscricaoMunicipalTomador': inscricao_municipal_tomador,
-                    'InscricaoEstadualTomador': inv.partner_id.inscr_est or None,
-                    'RazaoSocialTomador': inv.partner_id.legal_name,
-                    'Logradouro': partner_addr.street,
-                    'NumeroEndereco': partner_addr.number,
-                    'ComplementoEndereco': partner_addr.street2,
-                    'Bairro': partner_addr.district,
-                    'Cidade': city_ibge_code,
-                    'UF': partner_addr.state_id and \
-                        partner_addr.state_id.code or None,
-                    'CEP': partner_addr.zip,
-                    'EmailTomador': partner_addr.email,
-                    'Discriminacao': discriminacao,
-                    'SerieRPS': int(inv.document_serie_id.code),
-                    'NumeroRPS': inv.internal_number,
-                    })
-
-                datas.append(data_emissao)
-                invoice_rps[inv.internal_number] = inv
-
-        if len(lote_rps):
-            datas.sort()
-            if company.cnpj:
-                cnpj_remetente = re.sub('[^0-9]', '', company.cnpj)
-            else:
-                raise osv.except_osv(
-                    u'Faltam dados no cadastro da empresa.',
-                    u'O CNPJ da empresa %s é obrigatório.' %
-                    company.name,
-                    )
-            cabecalho = {
-                'CPFCNPJRemetente': cnpj_remetente,
-                'InscricaoMunicipalPrestador': re.sub(
-                    '[^0-9]', '', company.inscr_mun
-                    ),
-                'transacao': True,
-                'dtInicio': datas[0],
-                'dtFim': datas[-1],
-                'QtdRPS': len(lote_rps),
-                'ValorTotalServicos': valor_total_servicos,
-                'ValorTotalDeducoes': valor_total_deducoes,
-                'Versao': 1,
-                }
+            all_success = all_success and outcome['success']
 
-            try:
-                if test:
-                    success, res, warnings, errors = proc.testar_envio_lote_rps(
-                        cabecalho=cabecalho,
-                        lote_rps=lote_rps
-                        )
-                else:
-                    success, res, warnings, errors = proc.enviar_lote_rps(
-                        cabecalho=cabecalho,
-                        lote_rps=lote_rps
-                        )
-            except CommunicationError, e:
-                raise osv.except_osv(
-                    u'Ocorreu um erro de comunicação.',
-                    u'Código: {}\nDescrição: {}'.format(e.status, e.reason)
+            if outcome['communication_error']:
+                communication_errors.append(
+                    (batch['company'], outcome['communication_error'])
                     )
 
-            if len(warnings) == 0 and success and test:
-                raise osv.except_osv(
-                    u'Aviso',
-                    u'Os dados foram validados com sucesso.'
+            if len(outcome['warnings']) or len(outcome['errors']):
+                message = self._format_warnings_and_errors(
+                    batch['invoice_rps'], outcome['warnings'],
+                    outcome['errors']
                     )
-
-            elif not test and success:
-                chave_nfe_rps = res.ChaveNFeRPS
-
-                for chave in chave_nfe_rps:
-                    chave_nfe = chave.ChaveNFe
-                    chave_rps = chave.ChaveRPS
-
-                    numero_rps = chave_rps.NumeroRPS
-                    invoice = invoice_rps[numero_rps]
-
-                    numero_nfe = chave_nfe.NumeroNFe
-                    codigo_ver = chave_nfe.CodigoVerificacao
-
-                    data = {
-                        'nfse_status': NFSE_STATUS['send_ok'],
-                        'nfse_numero': int(numero_nfe),
-                        'nfse_codigo_verificacao': codigo_ver,
-                        }
-                    inv_obj.write(cr, uid, invoice.id, data, context=context)
-                    result = {'state': 'done'}
-
-                    for chave in warnings:
-                        for code, warning in warnings[chave]:
-                            if code == '208':
-                                invoice = invoice_rps[
-                                    chave.NumeroRPS
-                                    ]
-                                data = {'nfse_retorno': warning}
-                                inv_obj.write(
-                                    cr, uid, invoice.id, data, context=context
-                                    )
-                                self.write(cr, uid, ids, result)
-                                cr.commit()
-                                raise osv.except_osv(
-                                    u'Alíquotas divergentes!',
-                                    u'Para evitar a inconsistência dos ' + \
-                                    u'dados no sistema, cancele a NFS-e ' + \
-                                    u'(número {}) '.format(invoice.number) + \
-                                    u'e corrija a alíquota.\nRetorno do ' + \
-                                    u'sistema da prefeitura:\n\n"' + \
-                                    warning + '"'
-                                    )
-
-                if len(warnings):
-                    self._show_warnings_and_errors(
-                        invoice_rps, warnings, errors
+                if len(results) > 1:
+                    message = u'Empresa {}:\n'.format(
+                        batch['company']['name']
+                        ) + message
+                messages.append(message)
+
+        if communication_errors:
+            if sent:
+                # Keep the lots the prefeitura already accepted
+                self.write(cr, uid, ids, {'state': 'failed'})
+                cr.commit()
+            raise osv.except_osv(
+                u'Ocorreu um erro de comunicação.',
+                '\n'.join(
+                    u'{}Código: {}\nDescrição: {}'.format(
+                        len(results) > 1 and company['name'] + u'\n' or u'',
+                        e.status, e.reason
                         )
+                    for company, e in communication_errors
+                    )
+                )
 
-            else:
-                self._show_warnings_and_errors(invoice_rps, warnings, errors)
+        if sent:
+            result = {'state': only_submitted and 'queued' or 'done'}
+
+            for batch, outcome in results:
+                warnings = outcome['warnings']
+                for chave in warnings:
+                    for code, warning in warnings[chave]:
+                        if code == '208':
+                            invoice = batch['invoice_rps'][chave.NumeroRPS]
+                            data = {'nfse_retorno': warning}
+                            inv_obj.write(
+                                cr, uid, invoice['id'], data, context=context
+                                )
+                            self.write(cr, uid, ids, result)
+                            cr.commit()
+                            raise osv.except_osv(
+                                u'Alíquotas divergentes!',
+                                self._divergent_rates_message(invoice,
+                                                              warning)
+                                )
+
+            if len(messages):
+                if not all_success:
+                    result = {'state': 'failed'}
+                self.write(cr, uid, ids, result)
+                cr.commit()
+
+        elif test and all_success and len(messages) == 0:
+            raise osv.except_osv(
+                u'Aviso',
+                u'Os dados foram validados com sucesso.'
+                )
 
-        else:
-            result = {'state': 'nothing'}
+        if len(messages) or not all_success:
+            raise osv.except_osv(
+                u'O sistema da prefeitura verificou problemas nos ' + \
+                u'dados informados',
+                '\n'.join(messages)
+                )
 
         self.write(cr, uid, ids, result)
 
         return True
 
+    def _write_sent(self, cr, uid, keys, context=None):
+        """Mark invoices as sent with their NFS-e number and code
+
+        ``keys`` is a list of ``(invoice_id, numero, codigo_verificacao)``.
+        The status is written to all of them in one call and the numbers
+        and codes with one set-based update.
+        """
+        if not keys:
+            return
+        self.pool.get('account.invoice').write(
+            cr, uid, [key[0] for key in keys],
+            {'nfse_status': 'sent'}, context=context
+            )
+        update_rows(cr, 'account_invoice',
+                    [('nfse_numero', 'integer'),
+                     ('nfse_codigo_verificacao', 'varchar')],
+                    keys)
+
+    def _write_send_result(self, cr, uid, sent, invoice_rps, context=None):
+        """Store the NFS-e number and verification code of a sent lot
+
+        ``sent`` yields ``(numero_rps, numero_nfe, codigo_verificacao)``,
+        as iter_sent does; it is written in windows while it is read.
+        Returns the ids of the invoices written.
+        """
+        sent_ids = []
+        for window in windows(sent, get_param('writeback_window', 500)):
+            keys = [(invoice_rps[numero_rps]['id'], numero_nfe, codigo)
+                    for numero_rps, numero_nfe, codigo in window]
+            self._write_sent(cr, uid, keys, context)
+            sent_ids += [key[0] for key in keys]
+        return sent_ids
+
+    def _get_invoices_to_send(self, cr, uid, ids, context=None):
+        inv_obj = self.pool.get('account.invoice')
+        active_ids = [i.id for i in
+                      self.browse(cr, uid, ids[0]).selected_invoices]
+
+        if len(active_ids) == 0:
+            raise osv.except_osv(
+                u'Atenção!',
+                u'Não há notas confirmadas para efetuar o envio.'
+                )
+
+        conditions = [('id', 'in', active_ids),
+                      '|', ('nfse_status', '=', False),
+                      ('nfse_status', 'in', UNSENT_STATES)]
+        return inv_obj.search(cr, uid, conditions)
+
+    def _validate_locally(self, cr, uid, ids, context=None):
+        """Check the selected invoices offline, reporting every problem"""
+        invoice_ids = self._get_invoices_to_send(cr, uid, ids, context)
+        messages = []
+
+        for window_ids in windows(invoice_ids, get_param('send_window', 500)):
+            with span('db_read', len(window_ids)):
+                prefetched = prefetch_send_data(self.pool, cr, uid,
+                                                window_ids, context=context)
+            invoices = [prefetched['invoices'][i] for i in window_ids]
+
+            with span('build', len(invoices)):
+                problems = validate_batch(invoices)
+
+            messages.extend(
+                u'Nota Fiscal {}:\n'.format(inv['number']) +
+                '\n'.join(problems[inv['id']]) + '\n'
+                for inv in invoices if inv['id'] in problems
+                )
+
+        if messages:
+            raise osv.except_osv(
+                u'Foram encontrados problemas nos dados informados',
+                '\n'.join(messages)
+                )
+
+        return invoice_ids
+
+    @instrumented('test')
     def test_send_nfse(self, cr, uid, ids, context=None):
-        return self._send_nfse(cr, uid, ids, context, True)
+        """Validate the selected invoices
 
+        Validation is local; the prefeitura's test service is only called
+        when the remote_test option of the wizard is checked.
+        """
+        invoice_ids = self._validate_locally(cr, uid, ids, context)
+
+        if not len(invoice_ids):
+            self.write(cr, uid, ids, {'state': 'nothing'})
+            return True
+
+        if self.browse(cr, uid, ids[0], context=context).remote_test:
+            return self._send_nfse(cr, uid, ids, context, True)
+
+        raise osv.except_osv(
+            u'Aviso',
+            u'Os dados foram validados com sucesso.'
+            )
+
+    @instrumented('send')
     def send_nfse(self, cr, uid, ids, context=None):
-        """Send one or many NFS-e"""
-        return self._send_nfse(cr, uid, ids, context, False)
+        """Send one or many NFS-e
 
+        Unless the l10n_br_nfse_queue_send option is turned off, invoices
+        are only queued here and sent by the l10n_br_nfse.queue cron job.
+        """
+        if not get_param('queue_send', True):
+            return self._send_nfse(cr, uid, ids, context, False)
+
+        invoices_to_send = self._get_invoices_to_send(cr, uid, ids, context)
+        invoices = self.pool.get('account.invoice').browse(
+            cr, uid, invoices_to_send, context=context
+            )
+
+        if not self._check_invoices_are_services(invoices):
+            raise osv.except_osv(
+                u'Não foi possível completar a operação.',
+                u'Uma ou mais faturas não são de serviço.',
+                )
+
+        if not len(invoices_to_send):
+            self.write(cr, uid, ids, {'state': 'nothing'})
+            return True
+
+        self.pool.get('l10n_br_nfse.queue').enqueue(
+            cr, uid, invoices_to_send, context=context
+            )
+        self.write(cr, uid, ids, {'state': 'queued'})
+
+        return True
+
+    def _divergent_rates_message(self, invoice, warning):
+        """Explain the 208 warning: the NFS-e was issued with the rate of
+        the prefeitura, not the one of the invoice"""
+        return u'Para evitar a inconsistência dos dados no sistema, ' + \
+            u'cancele a NFS-e (número {}) '.format(invoice['number']) + \
+            u'e corrija a alíquota.\nRetorno do sistema da ' + \
+            u'prefeitura:\n\n"' + warning + '"'
+
+    def _write_warnings(self, cr, uid, invoice_rps, warnings, context=None):
+        """Store the warnings of sent RPS in the nfse_retorno of their
+        invoices
+
+        A 208 warning (divergent rates) is stored as returned, as
+        send_nfse does. Returns ``{invoice_id: message}``, the message of
+        a 208 warning explaining that the NFS-e must be cancelled.
+        """
+        inv_obj = self.pool.get('account.invoice')
+        messages = {}
+
+        for chave in warnings:
+            invoice = invoice_rps.get(str(chave.NumeroRPS))
+            if not invoice:
+                continue
+            message = retorno = self._format_messages(
+                {chave: warnings[chave]}, {}
+                )
+            for code, warning in warnings[chave]:
+                if code == '208':
+                    retorno = warning
+                    message = u'Alíquotas divergentes!\n' + \
+                        self._divergent_rates_message(invoice, warning)
+            inv_obj.write(cr, uid, [invoice['id']],
+                          {'nfse_retorno': retorno[:256]}, context=context)
+            messages[invoice['id']] = message
+
+        return messages
+
+    def _format_messages(self, warnings, errors):
+        return '\n'.join(
+            u'{} - {}'.format(code, desc)
+            for messages in (warnings, errors)
+            for chave in messages
+            for code, desc in messages[chave]
+            )
+
+    def _call_per_invoice(self, cr, uid, ids, invoices, method,
+                          build_request):
+        """Call ``method`` of the processor once per invoice, concurrently
+
+        Requests are built on the main thread with ``build_request(inv)``;
+        only the SOAP calls run in the worker pool, whose size is given by
+        the l10n_br_nfse_max_workers option. Returns a list of
+        ``(invoice, success, res, message)``; a failed call is reported
+        there instead of interrupting the others, and so is a company whose
+        processor cannot be built, e.g. for lack of a valid certificate, on
+        each of its invoices. An unavailable server still interrupts all.
+        """
+        processors = {}
+        company_errors = {}
+        calls = []
+        outcomes = []
+
+        for inv in invoices:
+            company = inv.company_id
+            if company.id not in processors and \
+                    company.id not in company_errors:
+                try:
+                    processors[company.id] = self._get_processor(company)
+                except osv.except_osv, e:
+                    company_errors[company.id] = e.value
+                except Exception, e:
+                    _logger.error('NFS-e processor of company %s could not '
+                                  'be built', company.id, exc_info=True)
+                    company_errors[company.id] = unicode(e)
+                else:
+                    self._check_server(cr, uid, ids,
+                                       processors[company.id].servidor)
+
+            if company.id in company_errors:
+                outcomes.append((inv, False, None,
+                                 company_errors[company.id]))
+                continue
+            calls.append((inv, processors[company.id], build_request(inv)))
+
+        def call(item):
+            inv, processor, request = item
+            with span('transmit'):
+                return throttled(processor, method, request)
+
+        for item, response, exc_info in run_concurrently(
+                call, calls, get_param('max_workers', 8)):
+            inv = item[0]
+
+            if exc_info:
+                e = exc_info[1]
+                if isinstance(e, pysped.CommunicationError):
+                    message = u'Erro de comunicação. ' + \
+                        u'Código: {}\nDescrição: {}'.format(e.status,
+                                                             e.reason)
+                else:
+                    _logger.error('NFS-e %s failed for invoice %s', method,
+                                  inv.id, exc_info=exc_info)
+                    message = unicode(e)
+                outcomes.append((inv, False, None, message))
+                continue
+
+            success, res, warnings, errors = response
+            outcomes.append((inv, success, res,
+                             self._format_messages(warnings, errors)))
+
+        return outcomes
+
+    def _cancel_request(self, inv):
+        company = inv.company_id
+        return {
+            'CPFCNPJRemetente': re.sub('[^0-9]', '', company.cnpj),
+            'InscricaoPrestador': company.inscr_mun,
+            'InscricaoTomador': inv.partner_id.inscr_mun,
+            'NumeroRPS': inv.internal_number,
+            'SerieRPS': inv.document_serie_id.code,
+            'NumeroNFe': inv.nfse_numero,
+            'CodigoVerificacao': inv.nfse_codigo_verificacao,
+            'Versao': 1,
+            }
+
+    def _check_request(self, inv):
+        company = inv.company_id
+        return {
+            'CPFCNPJRemetente': re.sub('[^0-9]', '', company.cnpj),
+            'InscricaoPrestador': company.inscr_mun,
+            'NumeroNFe': inv.nfse_numero,
+            'CodigoVerificacao': inv.nfse_codigo_verificacao,
+            'Versao': 1,
+            }
+
+    def _write_failures(self, cr, uid, failed_invoices, context=None):
+        """Store the failure messages, one write per distinct message"""
+        inv_obj = self.pool.get('account.invoice')
+        by_message = {}
+        for inv_id, message in failed_invoices:
+            by_message.setdefault(message[:256], []).append(inv_id)
+        for message, invoice_ids in by_message.items():
+            inv_obj.write(cr, uid, invoice_ids, {'nfse_retorno': message},
+                          context=context)
+
+    @instrumented('cancel')
     def cancel_nfse(self, cr, uid, ids, context=None):
         """Cancel one or many NFS-e"""
 
@@ -453,7 +1032,7 @@ class manage_nfse(osv.osv_memory):
                 )
 
         conditions = [('id', 'in', active_ids),
-                      ('nfse_status', '=', NFSE_STATUS['send_ok'])]
+                      ('nfse_status', '=', 'sent')]
         invoices_to_cancel = inv_obj.search(cr, uid, conditions)
 
         if len(invoices_to_cancel) == 0:
@@ -463,62 +1042,32 @@ class manage_nfse(osv.osv_memory):
                 u'possível cancela-la.'
                 )
 
+        invoices = []
+
         for inv in inv_obj.browse(cr, uid, invoices_to_cancel,
                                   context=context):
-
             if not inv.nfse_numero or not inv.nfse_codigo_verificacao:
-                raise osv.except_osv(
-                    u'Não foi possível cancelar a nota fiscal',
-                    u'A nota fiscal de número {} ainda '.format(inv.number) + \
-                    u'não foi enviada, portanto não é possível cancela-la.'
-                    )
-
-            company = self.pool.get('res.company').browse(
-                cr, uid, inv.company_id.id
-                )
-            self._check_certificate(company)
-            cert_file_content = base64.decodestring(company.nfse_cert_file)
-
-            caminho_temporario = u'/tmp/'
-            cert_file = caminho_temporario + uuid4().hex
-            arq_tmp = open(cert_file, 'w')
-            arq_tmp.write(cert_file_content)
-            arq_tmp.close()
-
-            cert_password = company.nfse_cert_password
-
-            processor = ProcessadorNFSeSP(cert_file, cert_password)
-
-            self._check_server(cr, uid, ids, processor.servidor)
-
-            try:
-                success, res, warnings, errors = processor.cancelar_nfse({
-                    'CPFCNPJRemetente': re.sub('[^0-9]', '', company.cnpj),
-                    'InscricaoPrestador': company.inscr_mun,
-                    'InscricaoTomador': inv.partner_id.inscr_mun,
-                    'NumeroRPS': inv.internal_number,
-                    'SerieRPS': inv.document_serie_id.code,
-                    'NumeroNFe': inv.nfse_numero,
-                    'CodigoVerificacao': inv.nfse_codigo_verificacao,
-                    'Versao': 1,
-                    })
-            except CommunicationError, e:
-                raise osv.except_osv(
-                    u'Ocorreu um erro de comunicação.',
-                    u'Código: {}\nDescrição: {}'.format(e.status, e.reason)
-                    )
+                failed_invoices.append((
+                    inv.id,
+                    u'A nota fiscal ainda não foi enviada, portanto não ' + \
+                    u'é possível cancela-la.'
+                    ))
+            else:
+                invoices.append(inv)
 
+        for inv, success, res, message in self._call_per_invoice(
+                cr, uid, ids, invoices, 'cancelar_nfse', self._cancel_request):
             if success:
                 canceled_invoices.append(inv.id)
-
-                data = {'nfse_status': NFSE_STATUS['cancel_ok']}
-
             else:
-                self._show_warnings_and_errors(warnings, errors)
+                failed_invoices.append((inv.id, message))
 
-            self.pool.get('account.invoice').write(
-                cr, uid, inv.id, data, context=context
-                )
+        with span('write_back', len(invoices_to_cancel)):
+            if len(canceled_invoices):
+                inv_obj.write(cr, uid, canceled_invoices,
+                              {'nfse_status': 'cancelled'},
+                              context=context)
+            self._write_failures(cr, uid, failed_invoices, context)
 
         if len(canceled_invoices) == 0 and len(failed_invoices) == 0:
             result = {'state': 'nothing'}
@@ -531,9 +1080,13 @@ class manage_nfse(osv.osv_memory):
 
         return True
 
+    @instrumented('check')
     def check_nfse(self, cr, uid, ids, context=None):
         """Check one or many NFS-e"""
 
+        checked_invoices = []
+        failed_invoices = []
+
         inv_obj = self.pool.get('account.invoice')
         active_ids = [i.id for i in
                       self.browse(cr, uid, ids[0]).selected_invoices]
@@ -545,64 +1098,50 @@ class manage_nfse(osv.osv_memory):
                 )
 
         conditions = [('id', 'in', active_ids)]
-        invoices = inv_obj.search(cr, uid, conditions)
+        invoices_to_check = inv_obj.search(cr, uid, conditions)
+
+        invoices = []
 
-        for inv in inv_obj.browse(cr, uid, invoices, context=context):
+        for inv in inv_obj.browse(cr, uid, invoices_to_check,
+                                  context=context):
             if not inv.nfse_numero or not inv.nfse_codigo_verificacao:
-                raise osv.except_osv(
-                    u'Não foi possível consultar a nota fiscal',
-                    u'A nota fiscal de número {} ainda '.format(inv.number) + \
-                    u'não foi enviada, portanto não é possível consulta-la.'
+                failed_invoices.append((
+                    inv.id,
+                    u'A nota fiscal ainda não foi enviada, portanto não ' + \
+                    u'é possível consulta-la.'
+                    ))
+            else:
+                invoices.append(inv)
+
+        for inv, success, res, message in self._call_per_invoice(
+                cr, uid, ids, invoices, 'consultar_nfse', self._check_request):
+            if not success:
+                failed_invoices.append((inv.id, message))
+                continue
+
+            nfe = res.NFe[0]
+            if nfe.StatusNFe == 'C':
+                failed_invoices.append(
+                    (inv.id, u'Nota fiscal consta como cancelada.')
                     )
-
-            company = self.pool.get('res.company').browse(
-                cr, uid, inv.company_id.id
-                )
-            self._check_certificate(company)
-            cert_file_content = base64.decodestring(company.nfse_cert_file)
-
-            caminho_temporario = u'/tmp/'
-            cert_file = caminho_temporario + uuid4().hex
-            arq_tmp = open(cert_file, 'w')
-            arq_tmp.write(cert_file_content)
-            arq_tmp.close()
-
-            cert_password = company.nfse_cert_password
-
-            processor = ProcessadorNFSeSP(cert_file, cert_password)
-
-            self._check_server(cr, uid, ids, processor.servidor)
-
-            try:
-                success, res, warnings, errors = processor.consultar_nfse({
-                    'CPFCNPJRemetente': re.sub('[^0-9]', '', company.cnpj),
-                    'InscricaoPrestador': company.inscr_mun,
-                    'NumeroNFe': inv.nfse_numero,
-                    'CodigoVerificacao': inv.nfse_codigo_verificacao,
-                    'Versao': 1,
-                    })
-            except CommunicationError, e:
-                raise osv.except_osv(
-                    u'Ocorreu um erro de comunicação.',
-                    u'Código: {}\nDescrição: {}'.format(e.status, e.reason)
+            elif nfe.StatusNFe == 'E':
+                failed_invoices.append(
+                    (inv.id, u'Nota fiscal consta como extraviada.')
                     )
+            else:
+                checked_invoices.append(inv.id)
 
-            if success:
-                
-                nfe = res.NFe[0]
-                if nfe.StatusNFe == 'C':
-                    raise osv.except_osv(
-                        u'Aviso',
-                        u'Nota fiscal consta como cancelada.'
-                        )
-                elif nfe.StatusNFe == 'E':
-                    raise osv.except_osv(
-                        u'Aviso',
-                        u'Nota fiscal consta como extraviada.'
-                        )
+        with span('write_back', len(failed_invoices)):
+            self._write_failures(cr, uid, failed_invoices, context)
 
-            else:
-                self._show_warnings_and_errors(warnings, errors)
+        if len(checked_invoices) == 0 and len(failed_invoices) == 0:
+            result = {'state': 'nothing'}
+        elif len(failed_invoices) > 0:
+            result = {'state': 'failed'}
+        else:
+            result = {'state': 'done'}
+
+        self.write(cr, uid, ids, result)
 
         return True
 
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#                                                                            #
+#  Copyright (C) 2012 Proge Informática Ltda (<http://www.proge.com.br>).    #
+#                                                                            #
+#  Author Daniel Hartmann <daniel@proge.com.br>                              #
+#                                                                            #
+#  This program is free software: you can redistribute it and/or modify      #
+#  it under the terms of the GNU Affero General Public License as            #
+#  published by the Free Software Foundation, either version 3 of the        #
+#  License, or (at your option) any later version.                           #
+#                                                                            #
+#  This program is distributed in the hope that it will be useful,           #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU Affero General Public License for more details.                       #
+#                                                                            #
+#  You should have received a copy of the GNU Affero General Public License  #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                            #
+##############################################################################
+
+from osv import fields, osv
+from ..nfse.lazy import pysped
+from ..nfse.rps import only_digits
+from ..nfse.scheduler import throttled
+from ..nfse.timing import instrumented, span
+import datetime
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Notes returned per page by ConsultaNFeEmitidas
+PAGE_SIZE = 50
+
+STATUS_NFE = {
+    'N': 'sent',
+    'C': 'cancelled',
+    }
+
+
+class reconcile_nfse(osv.osv_memory):
+    """Reconcile NFS-e status by period
+
+    Fetches every NFS-e issued by the company over a date range, a page at a
+    time, and updates the invoices whose status, number or verification code
+    differ from what the prefeitura reports.
+
+    States:
+    - init: wizard just opened
+    - done: reconciliation finished
+    """
+
+    _name = "l10n_br_nfse.reconcile_nfse"
+    _description = "Reconcile NFS-e"
+    _columns = {
+        'company_id': fields.many2one('res.company', u'Empresa',
+                                      required=True),
+        'date_start': fields.date(u'Data inicial', required=True),
+        'date_end': fields.date(u'Data final', required=True),
+        'state': fields.selection([('init', 'init'),
+                                   ('done', 'done'),
+                                   ], 'state', readonly=True),
+        'fetched': fields.integer(u'Notas consultadas', readonly=True),
+        'updated': fields.integer(u'Faturas atualizadas', readonly=True),
+        }
+    _defaults = {
+        'state': 'init',
+        'company_id': lambda self, cr, uid, c: self.pool.get(
+            'res.company'
+            )._company_default_get(cr, uid, 'account.invoice', context=c),
+        'date_start': lambda *a: (
+            datetime.date.today() - datetime.timedelta(days=30)
+            ).strftime('%Y-%m-%d'),
+        'date_end': lambda *a: datetime.date.today().strftime('%Y-%m-%d'),
+        }
+
+    def _fetch_issued(self, cr, uid, company, date_start, date_end):
+        """Return every NFe issued by ``company`` in the period"""
+        manage_obj = self.pool.get('l10n_br_nfse.manage_nfse')
+        processor = manage_obj._get_processor(company)
+        manage_obj._check_server(cr, uid, None, processor.servidor)
+
+        if not hasattr(processor, 'consultar_nfse_emitidas'):
+            raise osv.except_osv(
+                u'Operação não suportada.',
+                u'A versão instalada do pysped_nfse não permite ' + \
+                u'consultar as notas emitidas por período.'
+                )
+
+        notes = []
+        page = 1
+
+        while True:
+            try:
+                with span('transmit'):
+                    success, res, warnings, errors = throttled(
+                        processor, 'consultar_nfse_emitidas', {
+                            'CPFCNPJRemetente': only_digits(company.cnpj),
+                            'CPFCNPJ': only_digits(company.cnpj),
+                            'Inscricao': only_digits(company.inscr_mun),
+                            'dtInicio': date_start,
+                            'dtFim': date_end,
+                            'NumeroPagina': page,
+                            'Versao': 1,
+                            })
+            except pysped.CommunicationError, e:
+                raise osv.except_osv(
+                    u'Ocorreu um erro de comunicação.',
+                    u'Código: {}\nDescrição: {}'.format(e.status, e.reason)
+                    )
+
+            if not success:
+                raise osv.except_osv(
+                    u'O sistema da prefeitura verificou problemas nos ' + \
+                    u'dados informados',
+                    manage_obj._format_messages(warnings, errors)
+                    )
+
+            page_notes = res.NFe or []
+            notes.extend(page_notes)
+
+            if len(page_notes) < PAGE_SIZE:
+                break
+            page += 1
+
+        return notes
+
+    @instrumented('reconcile')
+    def _reconcile_company(self, cr, uid, company, date_start, date_end,
+                           context=None):
+        """Return ``(fetched, updated)`` for one company"""
+        inv_obj = self.pool.get('account.invoice')
+        notes = self._fetch_issued(cr, uid, company, date_start, date_end)
+
+        by_numero = {}
+        by_rps = {}
+        for nfe in notes:
+            by_numero[int(nfe.ChaveNFe.NumeroNFe)] = nfe
+            if nfe.ChaveRPS is not None:
+                by_rps[str(nfe.ChaveRPS.NumeroRPS)] = nfe
+
+        invoice_ids = inv_obj.search(cr, uid, [
+            ('company_id', '=', company.id),
+            ('fiscal_type', '=', 'service'),
+            '|', ('nfse_numero', 'in', by_numero.keys() or [0]),
+            ('internal_number', 'in', by_rps.keys() or ['']),
+            ], context=context)
+        invoices = inv_obj.read(cr, uid, invoice_ids, [
+            'internal_number', 'nfse_numero', 'nfse_codigo_verificacao',
+            'nfse_status', 'nfse_retorno',
+            ], context=context)
+
+        # Invoices sharing the same new values are written together
+        updates = {}
+
+        for inv in invoices:
+            nfe = by_numero.get(inv['nfse_numero']) or \
+                by_rps.get(inv['internal_number'])
+            if nfe is None:
+                continue
+
+            expected = {
+                'nfse_numero': int(nfe.ChaveNFe.NumeroNFe),
+                'nfse_codigo_verificacao': nfe.ChaveNFe.CodigoVerificacao,
+                }
+            if nfe.StatusNFe in STATUS_NFE:
+                expected['nfse_status'] = STATUS_NFE[nfe.StatusNFe]
+            else:
+                expected['nfse_retorno'] = \
+                    u'Nota fiscal consta como extraviada.'
+
+            if any(inv.get(field) != value
+                   for field, value in expected.items()):
+                key = tuple(sorted(expected.items()))
+                updates.setdefault(key, []).append(inv['id'])
+
+        updated = 0
+        for values, ids in updates.items():
+            inv_obj.write(cr, uid, ids, dict(values), context=context)
+            updated += len(ids)
+
+        return len(notes), updated
+
+    def reconcile(self, cr, uid, ids, context=None):
+        wizard = self.browse(cr, uid, ids[0], context=context)
+        fetched, updated = self._reconcile_company(
+            cr, uid, wizard.company_id, wizard.date_start, wizard.date_end,
+            context
+            )
+        self.write(cr, uid, ids, {
+            'state': 'done',
+            'fetched': fetched,
+            'updated': updated,
+            })
+        return True
+
+    def run_reconciliation(self, cr, uid, days=1, context=None):
+        """Cron job: reconcile the last ``days`` days of every company with
+        an NFS-e certificate"""
+        company_obj = self.pool.get('res.company')
+        date_end = datetime.date.today()
+        date_start = date_end - datetime.timedelta(days=days)
+
+        company_ids = company_obj.search(cr, uid, [], context=context)
+        for company in company_obj.browse(cr, uid, company_ids,
+                                          context=context):
+            if not company.nfse_cert_file or not company.nfse_cert_password:
+                continue
+            try:
+                fetched, updated = self._reconcile_company(
+                    cr, uid, company, date_start.strftime('%Y-%m-%d'),
+                    date_end.strftime('%Y-%m-%d'), context
+                    )
+                cr.commit()
+                _logger.info('NFS-e reconciliation of %s: %d notes, '
+                             '%d invoices updated', company.name, fetched,
+                             updated)
+            except osv.except_osv, e:
+                cr.rollback()
+                _logger.warning('NFS-e reconciliation of %s failed: %s',
+                                company.name, e.value)
+
+        return True
+
+
+reconcile_nfse()